@@ -9,17 +9,38 @@
 
 # stdlib imports
 import signal
+import sys
+import time
 
-# our app imports
-from .appsetup import setup_parser
-from .broadcast import BroadcastListener, BroadcastServer
-from .helpers import ServiceExit
-from .multicast import MulticastListener, MulticastServer
+# --startup-timing counts from here
+STARTED = time.perf_counter()
+
+# our app imports. only what every run needs is imported here; the modules
+# behind an option (asyncio, http.server, multiprocessing, NumPy, ...) are
+# imported where the option is handled, so short scripted runs start fast
+from .appsetup import setup_analyze_parser, setup_parser  # noqa: E402
+from .helpers import ServiceExit, send_guard  # noqa: E402
+from .output import Output  # noqa: E402
+from .stages import StartupTimer  # noqa: E402
 
 
 def _shutdown(signal, frame):
-    print("\nStop requested ...")
-    raise ServiceExit
+    print("\nStop requested ...", file=sys.stderr)
+    if not send_guard.defer():
+        raise ServiceExit
+
+
+def _ignore_stops():
+    # once shutdown has begun, further stop requests are ignored: raised
+    # inside a join they would end the run in a traceback, before the
+    # output threads have written out what is queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _call(function, *args):
+    # stand-in for Profiler.run without --profile
+    return function(*args)
 
 
 # register event handlers to trigger shutdown request
@@ -27,72 +48,430 @@ signal.signal(signal.SIGINT, _shutdown)
 signal.signal(signal.SIGTERM, _shutdown)
 
 
+def analyze_main(argv):
+    # bcmc analyze FILE [FILE ...] [options]
+    from .analyze import AnalyzeError, analyze
+    from .pcap import PcapError
+
+    parser = setup_analyze_parser()
+    args = parser.parse_args(argv)
+    try:
+        output = Output(args.format, args.output)
+    except OSError as error:
+        print("bcmc: cannot open output file - {0}".format(error))
+        exit(1)
+    # nothing runs alongside, so the output is written out at the end
+    # rather than by its threads
+    status = 0
+    try:
+        analyze(args.files, output, args.window, args.chunk, args.long_run)
+    except (AnalyzeError, PcapError, OSError) as error:
+        print("bcmc: {0}".format(error))
+        status = 1
+    except ServiceExit:
+        status = 1
+    finally:
+        _ignore_stops()
+        output.close()
+    exit(status)
+
+
 def main():
+    if sys.argv[1:2] == ["analyze"]:
+        analyze_main(sys.argv[2:])
+    timer = StartupTimer(STARTED)
+    timer.mark("imports")
     parser = setup_parser()
     args = parser.parse_args()
+    timer.mark("arguments")
     if not args.client and not args.server:
         print("bcmc: argument error - must either be a client (-c) or server (-s)")
         print("")
         parser.print_help()
         exit(1)
-    if not args.broadcast and not args.multicast:
+    if not args.broadcast and not args.multicast and not (args.connect or args.streams):
         print(
             "bcmc: argument error - must specify either broadcast (-bc) or multicast (-mc)"
         )
         print("")
         parser.print_help()
         exit(1)
+    if args.asyncio and args.workers > 1:
+        print("bcmc: argument error - --workers cannot be combined with --asyncio")
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.connect and not args.client:
+        print("bcmc: argument error - --connect requires client mode (-c)")
+        print("")
+        parser.print_help()
+        exit(1)
+    if (args.control or args.receivers) and not args.server:
+        print(
+            "bcmc: argument error - --control and --receivers require server mode (-s)"
+        )
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.replay and (args.asyncio or args.workers > 1):
+        print(
+            "bcmc: argument error - --replay cannot be combined with --asyncio or --workers"
+        )
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.traffic and (
+        args.rate or args.bandwidth or args.replay or args.workers > 1
+    ):
+        print(
+            "bcmc: argument error - --traffic cannot be combined with --rate, --bandwidth, --replay or --workers"
+        )
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.streams and not args.server:
+        print("bcmc: argument error - --streams requires server mode (-s)")
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.streams and (
+        args.broadcast
+        or args.multicast
+        or args.asyncio
+        or args.workers > 1
+        or args.replay
+        or args.traffic
+        or args.control
+    ):
+        print(
+            "bcmc: argument error - --streams cannot be combined with -bc, -mc, --asyncio, --workers, --replay, --traffic or --control"
+        )
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.metrics and args.workers > 1:
+        print("bcmc: argument error - --metrics cannot see the processes of --workers")
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.soak and not args.client:
+        print("bcmc: argument error - --soak requires client mode (-c)")
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.soak and (args.verbose or args.packet_log or args.pcap):
+        print(
+            "bcmc: argument error - --soak cannot be combined with --verbose, --packet-log or --pcap, which grow with every packet"
+        )
+        print("")
+        parser.print_help()
+        exit(1)
+    if args.soak and not args.report_interval:
+        print("bcmc: argument error - --soak needs a --report-interval above 0")
+        print("")
+        parser.print_help()
+        exit(1)
     threads = []
+    engine = None
+    if args.asyncio:
+        from .aio import AsyncEngine
+
+        engine = AsyncEngine()
+    # console and result output is written by its own threads so a slow
+    # terminal or disk never stalls the send and receive loops
+    try:
+        output = Output(args.format, args.output, args.packet_log)
+    except OSError as error:
+        print("bcmc: cannot open output file - {0}".format(error))
+        exit(1)
+    output.start()
+    timer.mark("output")
+    capture = None
+    if args.pcap and args.client:
+        from .pcap import PcapWriter
+
+        try:
+            capture = PcapWriter(
+                args.pcap, args.pcap_rotate_size, args.pcap_rotate_time
+            )
+        except OSError as error:
+            print("bcmc: cannot open pcap file - {0}".format(error))
+            output.close()
+            exit(1)
+        capture.start()
+    # the control channel: as a client, register and take the test
+    # parameters from the server; as a server, hand them out
+    control_client = None
+    control_server = None
+    if args.connect or args.control:
+        from .control import ControlClient, ControlError, ControlServer
+
+        try:
+            if args.connect:
+                control_client = ControlClient(args.connect, args.control_port, output)
+            if args.control:
+                control_server = ControlServer(
+                    args.control_port,
+                    args.host,
+                    dict(
+                        kinds=[
+                            kind
+                            for kind, enabled in (
+                                ("broadcast", args.broadcast),
+                                ("multicast", args.multicast),
+                            )
+                            if enabled
+                        ],
+                        groups=args.group,
+                        port=args.port,
+                        header=args.header,
+                        rate=args.rate,
+                        bandwidth=args.bandwidth,
+                        interval=args.interval,
+                        stream_id=args.stream_id,
+                    ),
+                    output,
+                )
+        except ControlError as error:
+            print("bcmc: {0}".format(error))
+            if capture is not None:
+                capture.close()
+            output.close()
+            exit(1)
+    if control_client is not None:
+        params = control_client.params
+        args.broadcast = "broadcast" in params["kinds"]
+        args.multicast = "multicast" in params["kinds"]
+        args.group = params["groups"]
+        args.port = params["port"]
+        output.write(
+            "Test parameters from {0}: {1} on port {2}, {3} group(s), header {4}".format(
+                args.connect,
+                " and ".join(params["kinds"]),
+                args.port,
+                len(args.group),
+                "on" if params["header"] else "off",
+            )
+        )
+        output.observe(control_client.observe)
+        control_client.start()
+    if control_server is not None:
+        output.observe(control_server.observe)
+        control_server.start()
+    reporting = dict(
+        verbose=args.verbose,
+        report_interval=args.report_interval,
+        output=output,
+        stats_detail=args.stats_detail,
+    )
+    soak = None
+    if args.soak:
+        from .soak import SoakMonitor
+
+        try:
+            soak = SoakMonitor(
+                args.soak, output.emit, args.soak_gap, args.checkpoint_interval
+            )
+        except ValueError as error:
+            print("bcmc: {0}".format(error))
+            output.close()
+            exit(1)
+        if soak.resumed:
+            output.write("Soak: resuming the totals saved in {0}".format(args.soak))
+    metrics = None
+    if args.metrics:
+        from .metrics import MetricsServer
+
+        try:
+            metrics = MetricsServer(args.metrics[1], args.metrics[0])
+        except OSError as error:
+            print("bcmc: cannot serve metrics - {0}".format(error))
+            output.close()
+            exit(1)
+        metrics.start()
+        output.write(
+            "Metrics: http://{0}:{1}/metrics".format(args.metrics[0], args.metrics[1])
+        )
+    profiler = None
+    if args.profile is not None:
+        from .profiling import Profiler
+
+        profiler = Profiler(args.profile)
+    run = profiler.run if profiler is not None else _call
+    listening = dict(
+        reporting,
+        host=args.host,
+        capture=capture,
+        kernel_timestamps=args.kernel_timestamps,
+        rcvbuf=args.rcvbuf,
+        flows=args.flows,
+        flow_idle=args.flow_idle,
+        soak=soak,
+    )
     try:
         if args.client:
             # do client mode stuff.
             if args.broadcast:
                 # do client broadcast stuff.
-                bc_rx = BroadcastListener(args.port, args.debug)
+                from .broadcast import BroadcastListener
+
+                bc_rx = BroadcastListener(args.port, args.debug, **listening)
                 threads.append(bc_rx)
+                if metrics is not None:
+                    metrics.add_listener(bc_rx, "broadcast")
             if args.multicast:
                 # do client multicast stuff.
-                mc_rx = MulticastListener(args.group, args.port, args.debug)
+                from .multicast import MulticastListener
+
+                mc_rx = MulticastListener(
+                    args.group, args.port, args.debug, **listening
+                )
                 threads.append(mc_rx)
-            # start threads
+                if metrics is not None:
+                    metrics.add_listener(mc_rx, "multicast")
+            # start threads, or hand the listeners to the event loop
             for t in threads:
-                t.start()
+                if engine:
+                    engine.add_listener(t)
+                else:
+                    if profiler is not None:
+                        profiler.attach(t)
+                    t.start()
+            if engine:
+                threads = []
+            timer.mark("listening")
 
         if args.server:
             # do server mode stuff
-            if args.broadcast:
-                # do server broadcast stuff.
-                bc_tx = BroadcastServer(
-                    args.port,
-                    args.padding,
-                    args.interval,
-                    dscp=args.dscp,
-                    debug=args.debug,
+            if control_server is not None and args.receivers:
+                control_server.wait_for(args.receivers)
+            options = dict(
+                port=args.port,
+                padding=args.padding,
+                interval=args.interval,
+                dscp=args.dscp,
+                debug=args.debug,
+                host=args.host,
+                payload=args.payload,
+                header=args.header,
+                stream_id=args.stream_id,
+                rate=args.rate,
+                bandwidth=args.bandwidth,
+                burst=args.burst,
+                sndbuf=args.sndbuf,
+                **reporting,
+            )
+            if args.streams:
+                from .streams import StreamServer
+
+                streams = StreamServer(
+                    args.streams,
                     host=args.host,
-                    payload=args.payload,
+                    header=args.header,
+                    stream_id=args.stream_id,
+                    verbose=args.verbose,
+                    report_interval=args.report_interval,
+                    output=output,
+                    sndbuf=args.sndbuf,
                 )
-                bc_tx.broadcast()
+                if metrics is not None:
+                    metrics.add_streams(streams)
+                timer.watch(streams)
+                run(streams.serve)
+            if args.replay and not (args.rate or args.bandwidth):
+                # the capture timestamps pace the replay, not --interval
+                options["interval"] = 0
+            if args.traffic:
+                # the profile sets every deadline
+                options.update(interval=0, traffic=args.traffic)
+            if args.broadcast:
+                # do server broadcast stuff.
+                if args.workers > 1:
+                    from .workers import run_workers
+
+                    run(
+                        run_workers,
+                        "broadcast",
+                        options,
+                        args.workers,
+                        args.report_interval,
+                        output,
+                    )
+                else:
+                    from .broadcast import BroadcastServer
+
+                    bc_tx = BroadcastServer(**options)
+                    timer.watch(bc_tx.pacer)
+                    if metrics is not None:
+                        metrics.add_server(bc_tx, "broadcast")
+                    if args.replay:
+                        from .replay import replay
+
+                        run(replay, bc_tx, args.replay, args.replay_speed)
+                    elif engine:
+                        engine.add_server(bc_tx)
+                    else:
+                        run(bc_tx.broadcast)
             if args.multicast:
                 # do server multicast stuff.
-                mc_tx = MulticastServer(
-                    args.group,
-                    args.port,
-                    args.padding,
-                    args.interval,
-                    args.ttl,
-                    dscp=args.dscp,
-                    debug=args.debug,
-                    host=args.host,
-                    payload=args.payload,
-                )
-                mc_tx.multicast()
+                options.update(group=args.group, ttl=args.ttl)
+                if args.workers > 1:
+                    from .workers import run_workers
 
-        # loop until shutdown is triggered
-        while True:
-            pass
+                    run(
+                        run_workers,
+                        "multicast",
+                        options,
+                        args.workers,
+                        args.report_interval,
+                        output,
+                    )
+                else:
+                    from .multicast import MulticastServer
+
+                    mc_tx = MulticastServer(**options)
+                    timer.watch(mc_tx.pacer)
+                    if metrics is not None:
+                        metrics.add_server(mc_tx, "multicast")
+                    if args.replay:
+                        from .replay import replay
+
+                        run(replay, mc_tx, args.replay, args.replay_speed)
+                    elif engine:
+                        engine.add_server(mc_tx)
+                    else:
+                        run(mc_tx.multicast)
+
+        if engine:
+            run(engine.run)
+
+        # wait until shutdown is triggered. sleep rather than a timed join():
+        # a signal handler raising inside join() can mark a thread finished
+        # while it is still running, and then its shutdown output is lost
+        while any(t.is_alive() for t in threads):
+            time.sleep(1.0)
     except ServiceExit:
+        _ignore_stops()
+        for t in threads:
+            t.stop()
         for t in threads:
-            t.stop_event.set()
+            t.join()
+    finally:
+        _ignore_stops()
+        if capture is not None:
+            capture.close()
+            output.write(capture.summary())
+        if control_client is not None:
+            control_client.close()
+        if control_server is not None:
+            control_server.finish()
+        if metrics is not None:
+            metrics.close()
+        if profiler is not None:
+            output.write(profiler.report())
+        if args.startup_timing:
+            timer.emit(output.emit)
+        output.close()
 
 
 if __name__ == "__main__":
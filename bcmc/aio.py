@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# aio.py: provide the asyncio engine that runs bcmc servers and listeners
+
+# stdlib imports
+import asyncio
+import signal
+import sys
+import time
+
+# app imports
+from .broadcast import BroadcastServer
+from .stages import PACE, REPORT
+
+
+class ListenerProtocol(asyncio.DatagramProtocol):
+    # feed datagrams from one listener socket into the listener's on_packet()
+
+    def __init__(self, listener, sock):
+        self.listener = listener
+        self.sock = sock
+
+    def datagram_received(self, data, addr):
+        # the event loop gives no ancillary data, so the destination group
+        # is only known for sockets that joined a single group
+        receiver = self.listener.receiver
+        receiver.sock = self.sock
+        receiver.destination = 0
+        self.listener.on_packet(data, len(data), addr)
+
+
+class AsyncEngine:
+    # run any mix of broadcast/multicast servers and listeners on one event
+    # loop; the server and listener objects still own their sockets, payload
+    # buffers, pacers and counters, the engine only drives them
+
+    # a server that is behind schedule yields to the loop after this many
+    # back to back sends so listeners on the same loop are not starved
+    yield_every = 32
+
+    def __init__(self):
+        self.servers = []
+        self.listeners = []
+        self.main = None
+
+    def add_server(self, server):
+        self.servers.append(server)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def run(self):
+        asyncio.run(self._main())
+
+    def stop(self):
+        # cancel everything; the tasks report in their finally blocks
+        print("\nStop requested ...", file=sys.stderr)
+        if self.main is not None:
+            self.main.cancel()
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self.main = asyncio.current_task()
+        installed = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+                installed.append(signum)
+            except (NotImplementedError, RuntimeError):
+                # Windows: the process-wide handlers raise ServiceExit instead
+                pass
+        tasks = [
+            asyncio.ensure_future(self._listen(listener)) for listener in self.listeners
+        ]
+        tasks += [asyncio.ensure_future(self._serve(server)) for server in self.servers]
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for signum in installed:
+                loop.remove_signal_handler(signum)
+
+    async def _listen(self, listener):
+        loop = asyncio.get_running_loop()
+        transports = []
+        # no ancillary data here, so no kernel timestamps or drop counts
+        listener.kernel_timestamps = False
+        try:
+            for sock in listener.sockets:
+                transport, _protocol = await loop.create_datagram_endpoint(
+                    lambda sock=sock: ListenerProtocol(listener, sock), sock=sock
+                )
+                transports.append(transport)
+            listener.announce()
+            listener.reporter.start()
+            if listener.report_interval:
+                stages = listener.stages
+                while True:
+                    await asyncio.sleep(listener.report_interval)
+                    if stages is not None:
+                        begin = time.perf_counter_ns()
+                    listener.tick()
+                    if stages is not None:
+                        stages.add(REPORT, time.perf_counter_ns() - begin)
+            else:
+                await asyncio.Event().wait()
+        finally:
+            for transport in transports:
+                transport.close()
+            listener.receiver.close()
+            listener.report()
+
+    async def _serve(self, server):
+        loop = asyncio.get_running_loop()
+        if isinstance(server, BroadcastServer):
+            sock, kind = server.bc_server_sock, "broadcast"
+        else:
+            sock, kind = server.mc_server_sock, "multicast"
+        transport, _protocol = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, sock=sock
+        )
+        # the payload text names the group, so datagram sizes differ by group
+        targets = [
+            (
+                [packet.buffer for packet in packets],
+                packets,
+                sender.destination,
+                packets[0].size,
+            )
+            for packets, sender in server.targets
+        ]
+        turns = len(targets)
+        turn = 0
+        step = server.sequence_step
+        sequences = [server.sequence_start - step] * turns
+        burst = server.burst
+        pacer = server.pacer
+        sendto = transport.sendto
+        time_ns = time.time_ns
+        streak = 0
+        write = server.write
+        reporter = server.reporter
+        stages = server.stages
+        traffic = server.traffic
+        clock = time.perf_counter_ns
+        pacer.start()
+        report_at = reporter.start(time_ns())
+        if stages is not None:
+            stages.start()
+        try:
+            while True:
+                if stages is not None:
+                    begin = clock()
+                if traffic is not None and not traffic.advance(pacer):
+                    break
+                delay = pacer.delay()
+                if delay > 0:
+                    streak = 0
+                    await asyncio.sleep(delay)
+                else:
+                    streak += 1
+                    if streak >= self.yield_every:
+                        streak = 0
+                        await asyncio.sleep(0)
+                if stages is not None:
+                    paced = clock()
+                buffers, packets, destination, size = targets[turn]
+                now = time_ns()
+                sequence = sequences[turn]
+                for packet in packets:
+                    sequence += step
+                    packet.update(sequence, now)
+                sequences[turn] = sequence
+                if stages is not None:
+                    built = clock()
+                # the transport copies a buffer only if it has to queue it
+                for buffer in buffers:
+                    sendto(buffer, destination)
+                if stages is not None:
+                    stages.lap(PACE, begin, paced, built, clock())
+                pacer.sent(size, burst)
+                if turns > 1:
+                    turn = (turn + 1) % turns
+                if report_at and now >= report_at:
+                    report_at = reporter.tick(pacer, now)
+                if server.verbose:
+                    write(
+                        "Sending {0} ({1} bytes) -> {2}".format(
+                            kind, size, packets[0].message()
+                        )
+                    )
+        finally:
+            transport.close()
+            server.output.emit(
+                pacer.summary_record(),
+                pacer.summary(traffic.label() if traffic is not None else None),
+            )
+            if traffic is not None:
+                traffic.report(pacer, server.output.emit)
+            if stages is not None:
+                stages.emit(server.output.emit)
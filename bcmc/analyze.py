@@ -0,0 +1,1101 @@
+# -*- coding: utf-8 -*-
+#
+# analyze.py: provide the offline analyzer for bcmc captures and packet logs
+#
+# bcmc analyze reads pcap captures (e.g. from --pcap) and binary packet logs
+# (--packet-log FILE.bin) and reports delivery, loss runs, reordering,
+# inter-arrival gaps and one-way delay per stream, plus throughput and loss
+# per time window and group. files are memory-mapped and decoded into NumPy
+# columns a batch of records at a time, and every statistic is computed
+# with array operations, so captures of tens of millions of packets take
+# seconds rather than minutes. NumPy is only needed for this subcommand
+
+# stdlib imports
+import mmap
+import socket
+import struct
+import sys
+import time
+from array import array
+
+# app imports
+from .header import HEADER_MAGIC, HEADER_SIZE, HEADER_VERSION
+from .histogram import LogHistogram, format_percentiles, format_usec
+from .output import (
+    FLAG_HEADER,
+    PACKET_LOG_HEADER,
+    PACKET_LOG_MAGIC,
+    PACKET_LOG_VERSION,
+    PACKET_RECORD,
+)
+from .pcap import (
+    LINKTYPE_ETHERNET,
+    LINKTYPE_IPV4,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_LINUX_SLL2,
+    LINKTYPE_LOOP,
+    LINKTYPE_NULL,
+    LINKTYPE_RAW,
+    PCAP_HEADER,
+    RECORD_HEADER,
+    PcapReader,
+)
+from .report import STREAM_LINE_LIMIT, format_bytes
+from .soak import format_time
+from .stats import REORDER_WINDOW
+
+# records decoded per batch; bounds the index arrays of the gathers
+DECODE_ROWS = 1 << 18
+
+# records whose lengths are walked one at a time once a run of equal
+# lengths turns out short
+WALK_ROWS = 4096
+
+# value ranges up to this size are coded with a lookup table instead of a
+# sort, as are the (group, window) cells of a chunk
+DENSE_RANGE = 1 << 22
+
+# streams that get their own gap and delay histograms; further streams only
+# count towards the totals
+MAX_HISTOGRAMS = 1024
+
+# length of the link-layer header in front of the IPv4 header
+_LINK_LENGTHS = {
+    LINKTYPE_RAW: 0,
+    LINKTYPE_IPV4: 0,
+    LINKTYPE_ETHERNET: 14,
+    LINKTYPE_LINUX_SLL: 16,
+    LINKTYPE_LINUX_SLL2: 20,
+    LINKTYPE_NULL: 4,
+    LINKTYPE_LOOP: 4,
+}
+_VLAN_ETHERTYPES = (0x8100, 0x88A8, 0x9100)
+
+# columns that tell streams apart
+_KEY_COLUMNS = ("group", "source", "port", "stream")
+
+# per stream state kept between chunks, and its initial value
+_STATE = (
+    ("highest", -1),
+    ("lowest", -1),
+    ("first_ns", 0),
+    ("last_ns", 0),
+    ("packets", 0),
+    ("bytes", 0),
+    ("duplicates", 0),
+    ("out_of_order", 0),
+    ("reorder_max", 0),
+    ("lost", 0),
+    ("loss_runs", 0),
+    ("long_runs", 0),
+    ("longest_run", 0),
+    ("gap_max", 0),
+    ("delay_max", 0),
+)
+
+
+class AnalyzeError(Exception):
+    """
+    Exception raised for files bcmc analyze cannot read
+    """
+
+
+def load_numpy():
+    # NumPy is an optional dependency, imported only when analyzing
+    try:
+        import numpy  # type: ignore[import-not-found]
+    except ImportError:
+        raise AnalyzeError(
+            "analyze needs NumPy; install it with: pip install numpy"
+        ) from None
+    return numpy
+
+
+def format_address(value):
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+
+def format_group(value):
+    # broadcast listeners log the group as 0.0.0.0
+    return format_address(value) if value else "broadcast"
+
+
+def _gather(np, buffer, positions, dtype):
+    # the dtype.itemsize bytes at every position of buffer, as one record of
+    # dtype each. positions past the end are clamped; callers mask those
+    # rows out
+    dtype = np.dtype(dtype)
+    positions = np.clip(positions, 0, len(buffer) - dtype.itemsize)
+    if len(positions) > 1:
+        step = int(positions[1] - positions[0])
+        if step > 0 and (np.diff(positions) == step).all():
+            # records of equal length: a strided view into the mapping,
+            # which the decoded columns are copied from
+            return np.ndarray(
+                (len(positions),),
+                dtype=dtype,
+                buffer=buffer,
+                offset=int(positions[0]),
+                strides=(step,),
+            )
+    index = positions[:, None] + np.arange(dtype.itemsize)
+    return buffer[index].view(dtype)[:, 0]
+
+
+def _codes(np, values):
+    # the distinct values in order, and the index into them of every value.
+    # addresses, ports, stream ids and windows mostly span a small range,
+    # where a presence table replaces the sort np.unique() does
+    low = int(values.min())
+    high = int(values.max())
+    if high - low < DENSE_RANGE:
+        present = np.zeros(high - low + 1, dtype=bool)
+        present[values - low] = True
+        distinct = np.flatnonzero(present)
+        table = np.cumsum(present) - 1
+        return distinct + low, table[values - low]
+    distinct, codes = np.unique(values, return_inverse=True)
+    return distinct, codes.ravel()
+
+
+def _concatenate(np, parts):
+    if len(parts) == 1:
+        return parts[0]
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+class PcapColumns:
+    # the UDP/IPv4 datagrams of a pcap capture as columns. record offsets are
+    # found a run at a time: in a run of records of equal length every
+    # record is where the lengths before it put it, so one strided compare
+    # of the length fields finds where the run ends. captures of a few
+    # payload sizes are walked in a handful of steps; records of varying
+    # lengths are walked one at a time. the headers are then read with one
+    # gather per protocol layer
+
+    def __init__(self, np, path):
+        self.np = np
+        self.path = path
+        self.reader = PcapReader(path)
+        linktype = self.reader.linktype
+        if linktype not in _LINK_LENGTHS:
+            self.reader.close()
+            raise AnalyzeError(
+                "{0} has link type {1}, which bcmc analyze cannot decode".format(
+                    path, linktype
+                )
+            )
+        self.order = self.reader.record_header.format[0]
+        self.scale = 1000000000 // self.reader.ticks
+        self.map = self.reader.map
+        self.buffer = np.frombuffer(self.map, dtype=np.uint8)
+        self.length_at = struct.Struct(self.order + "I").unpack_from
+        self.record_dtype = np.dtype(
+            [
+                ("seconds", self.order + "u4"),
+                ("fraction", self.order + "u4"),
+                ("captured", self.order + "u4"),
+                ("original", self.order + "u4"),
+            ]
+        )
+        self.ip_dtype = np.dtype(
+            [
+                ("version", "u1"),
+                ("tos", "u1"),
+                ("length", ">u2"),
+                ("id", ">u2"),
+                ("fragment", ">u2"),
+                ("ttl", "u1"),
+                ("protocol", "u1"),
+                ("checksum", ">u2"),
+                ("source", ">u4"),
+                ("destination", ">u4"),
+            ]
+        )
+        self.udp_dtype = np.dtype(
+            [
+                ("source", ">u2"),
+                ("destination", ">u2"),
+                ("length", ">u2"),
+                ("checksum", ">u2"),
+            ]
+        )
+        self.header_dtype = np.dtype(
+            [
+                ("magic", "S2"),
+                ("version", "u1"),
+                ("flags", "u1"),
+                ("stream", ">u4"),
+                ("sequence", ">u8"),
+                ("timestamp", ">u8"),
+                ("length", ">u4"),
+            ]
+        )
+        self.offset = PCAP_HEADER.size
+        # records read, and records that were not a complete UDP/IPv4 datagram
+        self.records = 0
+        self.skipped = 0
+
+    def offsets(self, limit):
+        # start offsets of up to limit further records
+        np = self.np
+        data = self.map
+        end = len(data)
+        length_at = self.length_at
+        runs = []
+        found = 0
+        offset = self.offset
+        scan = WALK_ROWS
+        while found < limit and offset + RECORD_HEADER.size <= end:
+            stride = RECORD_HEADER.size + length_at(data, offset + 8)[0]
+            count = min(limit - found, scan, (end - offset) // stride)
+            if not count:
+                # the capture was cut off mid-record
+                break
+            lengths = np.ndarray(
+                (count,),
+                dtype=self.order + "u4",
+                buffer=data,
+                offset=offset + 8,
+                strides=(stride,),
+            )
+            changed = np.flatnonzero(lengths != stride - RECORD_HEADER.size)
+            run = int(changed[0]) if len(changed) else count
+            del lengths
+            runs.append(offset + stride * np.arange(run, dtype=np.int64))
+            found += run
+            offset += stride * run
+            if run == count:
+                scan *= 2
+                continue
+            scan = WALK_ROWS
+            if run >= 16:
+                continue
+            walked = array("q")
+            while (
+                found + len(walked) < limit
+                and len(walked) < WALK_ROWS
+                and offset + RECORD_HEADER.size <= end
+            ):
+                following = offset + RECORD_HEADER.size + length_at(data, offset + 8)[0]
+                if following > end:
+                    break
+                walked.append(offset)
+                offset = following
+            runs.append(np.array(walked, dtype=np.int64))
+            found += len(walked)
+        self.offset = offset
+        if not runs:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(runs)
+
+    def network(self, starts, captured):
+        # offset of the IPv4 header of every record starting at starts, -1
+        # where there is none
+        np = self.np
+        buffer = self.buffer
+        linktype = self.reader.linktype
+        ip = starts + _LINK_LENGTHS[linktype]
+        if linktype == LINKTYPE_ETHERNET:
+            ethertype = _gather(np, buffer, starts + 12, ">u2")
+            # one VLAN tag is decoded here; stacked tags are skipped
+            tagged = np.isin(ethertype, _VLAN_ETHERTYPES)
+            ethertype = np.where(
+                tagged, _gather(np, buffer, starts + 16, ">u2"), ethertype
+            )
+            ip = np.where(tagged, ip + 4, ip)
+            valid = ethertype == 0x0800
+        elif linktype == LINKTYPE_LINUX_SLL:
+            valid = _gather(np, buffer, starts + 14, ">u2") == 0x0800
+        elif linktype == LINKTYPE_LINUX_SLL2:
+            valid = _gather(np, buffer, starts, ">u2") == 0x0800
+        elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+            # address family in host (NULL) or network (LOOP) byte order
+            valid = np.isin(_gather(np, buffer, starts, "<u4"), (2, 0x02000000))
+        else:
+            valid = np.ones(len(starts), dtype=bool)
+        valid &= ip - starts <= captured
+        return np.where(valid, ip, -1)
+
+    def decode(self, starts):
+        np = self.np
+        buffer = self.buffer
+        records = _gather(np, buffer, starts, self.record_dtype)
+        captured = records["captured"].astype(np.int64)
+        data = starts + RECORD_HEADER.size
+        stop = data + captured
+        ip = self.network(data, captured)
+        valid = (ip >= 0) & (ip + 20 <= stop) & (captured == records["original"])
+        headers = _gather(np, buffer, ip, self.ip_dtype)
+        udp = ip + (headers["version"] & 0x0F).astype(np.int64) * 4
+        valid &= (
+            (headers["version"] >> 4 == 4)
+            & (headers["version"] & 0x0F >= 5)
+            & (headers["protocol"] == socket.IPPROTO_UDP)
+            & (headers["fragment"] & 0x3FFF == 0)
+            & (udp + 8 <= stop)
+        )
+        datagrams = _gather(np, buffer, udp, self.udp_dtype)
+        size = datagrams["length"].astype(np.int64) - 8
+        valid &= (size >= 0) & (udp + 8 + size <= stop)
+        bcmc = _gather(np, buffer, udp + 8, self.header_dtype)
+        header = (
+            valid
+            & (size >= HEADER_SIZE)
+            & (bcmc["magic"] == HEADER_MAGIC)
+            & (bcmc["version"] == HEADER_VERSION)
+        )
+        self.records += len(starts)
+        self.skipped += len(starts) - int(np.count_nonzero(valid))
+        arrival = records["seconds"].astype(np.int64) * 1000000000 + records[
+            "fraction"
+        ].astype(np.int64) * np.int64(self.scale)
+        columns = {
+            "arrival": arrival,
+            "sent": np.where(header, bcmc["timestamp"].astype(np.int64), 0),
+            "sequence": np.where(header, bcmc["sequence"].astype(np.int64), 0),
+            "stream": np.where(header, bcmc["stream"].astype(np.int64), 0),
+            "size": size,
+            "source": headers["source"].astype(np.int64),
+            "port": datagrams["source"].astype(np.int64),
+            "group": headers["destination"].astype(np.int64),
+            "header": header,
+        }
+        if valid.all():
+            return columns
+        return {name: column[valid] for name, column in columns.items()}
+
+    def read(self, limit):
+        # columns of up to limit further records, None at the end
+        parts = []
+        while limit > 0:
+            starts = self.offsets(min(limit, DECODE_ROWS))
+            if not len(starts):
+                break
+            parts.append(self.decode(starts))
+            limit -= len(starts)
+        if not parts:
+            return None
+        return _concatenate(self.np, parts)
+
+    def close(self):
+        # the mapping cannot close while arrays still point into it
+        self.buffer = None
+        self.reader.close()
+
+
+class PacketLogColumns:
+    # the records of a binary packet log as columns; the fixed-size records
+    # are read straight from the mapping as a structured array
+
+    def __init__(self, np, path):
+        self.np = np
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise AnalyzeError("{0} is empty".format(path))
+        magic, version, size = PACKET_LOG_HEADER.unpack_from(self.map, 0)
+        if (
+            magic != PACKET_LOG_MAGIC
+            or version != PACKET_LOG_VERSION
+            or size != PACKET_RECORD.size
+        ):
+            self.close()
+            raise AnalyzeError(
+                "{0} is not a bcmc packet log of version {1}".format(
+                    path, PACKET_LOG_VERSION
+                )
+            )
+        self.dtype = np.dtype(
+            [
+                ("arrival", "<i8"),
+                ("sent", "<i8"),
+                ("sequence", "<u8"),
+                ("stream", "<u4"),
+                ("size", "<u4"),
+                ("source", ">u4"),
+                ("group", ">u4"),
+                ("port", "<u2"),
+                ("flags", "<u2"),
+                ("reserved", "V4"),
+            ]
+        )
+        # a record cut off by a crash is left out
+        self.count = (len(self.map) - PACKET_LOG_HEADER.size) // size
+        self.position = 0
+        self.records = 0
+        self.skipped = 0
+
+    def read(self, limit):
+        np = self.np
+        count = min(limit, self.count - self.position)
+        if count <= 0:
+            return None
+        rows = np.frombuffer(
+            self.map,
+            dtype=self.dtype,
+            count=count,
+            offset=PACKET_LOG_HEADER.size + self.position * self.dtype.itemsize,
+        )
+        self.position += count
+        self.records += count
+        columns = {
+            name: rows[name].astype(np.int64)
+            for name in (
+                "arrival",
+                "sent",
+                "sequence",
+                "stream",
+                "size",
+                "source",
+                "port",
+                "group",
+            )
+        }
+        columns["header"] = (rows["flags"] & FLAG_HEADER) != 0
+        del rows
+        return columns
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def open_columns(np, path):
+    # a column reader for a binary packet log or a pcap capture
+    with open(path, "rb") as source:
+        start = source.read(len(PACKET_LOG_MAGIC))
+    if start == PACKET_LOG_MAGIC:
+        return PacketLogColumns(np, path)
+    if start.startswith((b"arrival_ns", b"{")):
+        raise AnalyzeError(
+            "{0} is a text packet log; record a binary one with --packet-log FILE.bin".format(
+                path
+            )
+        )
+    return PcapColumns(np, path)
+
+
+class Analysis:
+    # delivery statistics over the columns of one or more files. add() takes
+    # a chunk of columns in arrival order; the per stream state it carries
+    # over (highest sequence, last arrival, counters) is kept in arrays
+    # indexed by stream number, along with which of the REORDER_WINDOW
+    # sequence numbers up to the highest have been seen. a single chunk
+    # gives exact results. with several, a packet that arrives a chunk or
+    # more after its successors is a duplicate if seen before and otherwise
+    # fills a gap counted earlier, so loss and duplicates stay exact, but
+    # loss runs it splits are counted whole. a packet further back than the
+    # window is taken as a fill, and one below all earlier ones as late
+    # without adding the gap it opens to the loss
+
+    def __init__(self, np, window=1.0, long_run=5):
+        self.np = np
+        self.window_ns = max(1, int(window * 1e9))
+        self.long_run = long_run
+        # (group, source, port, stream id) -> stream number
+        self.keys = {}
+        self.streams = []
+        self.state = {name: np.zeros(0, dtype=np.int64) for name, _value in _STATE}
+        # per stream, whether sequence s was seen, at column s % REORDER_WINDOW
+        # for s from highest - REORDER_WINDOW + 1 up to highest
+        self.seen = np.zeros((0, REORDER_WINDOW), dtype=bool)
+        template = LogHistogram()
+        self.significant_bits = template.significant_bits
+        self.sub_buckets = template.sub_buckets
+        self.half = template.half
+        self.highest_value = template.highest
+        self.buckets = len(template.counts)
+        # gap and delay histograms in microseconds, per stream and in total
+        self.histograms = {
+            "gap": np.zeros((0, self.buckets), dtype=np.int64),
+            "delay": np.zeros((0, self.buckets), dtype=np.int64),
+        }
+        self.totals = {
+            "gap": np.zeros(self.buckets, dtype=np.int64),
+            "delay": np.zeros(self.buckets, dtype=np.int64),
+        }
+        self.maxima = {"gap": 0, "delay": 0}
+        # loss runs by bit length of their length: 1, 2-3, 4-7, ...
+        self.run_lengths = np.zeros(64, dtype=np.int64)
+        # (group << 32 | window) -> [packets, bytes, lost]
+        self.windows = {}
+        # arrival of the first packet, start of window 0
+        self.origin = None
+        self.packets = 0
+        self.bytes = 0
+        self.bare = 0
+        self.first_ns = None
+        self.last_ns = None
+
+    def grow(self):
+        # make room in the state arrays for every stream seen so far
+        np = self.np
+        count = len(self.streams)
+        size = len(self.state["highest"])
+        if count <= size:
+            return
+        size = max(count, 2 * size, 64)
+        for name, value in _STATE:
+            column = np.full(size, value, dtype=np.int64)
+            column[: len(self.state[name])] = self.state[name]
+            self.state[name] = column
+        seen = np.zeros((size, REORDER_WINDOW), dtype=bool)
+        seen[: len(self.seen)] = self.seen
+        self.seen = seen
+        tracked = min(size, MAX_HISTOGRAMS)
+        for name, histograms in self.histograms.items():
+            if len(histograms) < tracked:
+                grown = np.zeros((tracked, self.buckets), dtype=np.int64)
+                grown[: len(histograms)] = histograms
+                self.histograms[name] = grown
+
+    def bucket(self, values):
+        # LogHistogram.index() of every non-negative value
+        np = self.np
+        values = np.minimum(values, self.highest_value)
+        bits = np.frexp(values.astype(np.float64))[1]
+        shift = np.maximum(bits - self.significant_bits, 0)
+        return np.where(
+            values < self.sub_buckets, values, (shift << self.half) + (values >> shift)
+        )
+
+    def record(self, name, streams, values, mask):
+        # add values (us) of packets of the given stream numbers to the
+        # stream and total histograms, where mask is set
+        np = self.np
+        if not mask.all():
+            streams = streams[mask]
+            values = values[mask]
+        if not len(values):
+            return
+        buckets = self.bucket(values)
+        self.totals[name] += np.bincount(buckets, minlength=self.buckets)
+        self.maxima[name] = max(self.maxima[name], int(values.max()))
+        histograms = self.histograms[name]
+        if len(self.streams) > len(histograms):
+            tracked = streams < len(histograms)
+            streams = streams[tracked]
+            buckets = buckets[tracked]
+        counts = np.bincount(
+            streams * self.buckets + buckets, minlength=histograms.size
+        )
+        histograms += counts.reshape(histograms.shape)
+
+    def histogram(self, counts, maximum):
+        # a LogHistogram with the given bucket counts, for its percentiles
+        histogram = LogHistogram()
+        histogram.counts = array("Q", counts.tolist())
+        histogram.count = int(counts.sum())
+        histogram.max = min(int(maximum), self.highest_value)
+        return histogram
+
+    def tally(self, group, window, *sums):
+        # add to the (group, window) cells: sums are (column, weights) with
+        # weights None to count rows
+        np = self.np
+        if not len(group):
+            return
+        low = int(group.min())
+        windows = int(window.max()) + 1
+        cells = (group - low) * windows + window
+        size = (int(group.max()) - low + 1) * windows
+        keys = None
+        if size > DENSE_RANGE:
+            keys, cells = _codes(np, cells)
+            size = len(keys)
+        results = [
+            np.bincount(cells, weights=weights, minlength=size)
+            for _column, weights in sums
+        ]
+        used = np.flatnonzero(np.logical_or.reduce([result != 0 for result in results]))
+        keys = used if keys is None else keys[used]
+        group_of = (keys // windows + low).tolist()
+        window_of = (keys % windows).tolist()
+        values = [result[used].tolist() for result in results]
+        cells = self.windows
+        for position, (group, window) in enumerate(zip(group_of, window_of)):
+            key = (group << 32) | window
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = [0, 0, 0]
+            for (column, _weights), value in zip(sums, values):
+                cell[column] += int(round(value[position]))
+
+    def numbers(self, columns):
+        # the stream number of every row, adding new streams
+        np = self.np
+        combined = np.zeros(len(columns["group"]), dtype=np.int64)
+        radix = 1
+        for name in _KEY_COLUMNS:
+            column = columns[name]
+            low = int(column.min())
+            count = int(column.max()) - low + 1
+            if count == 1:
+                continue
+            if count <= DENSE_RANGE:
+                codes = column - low
+            else:
+                distinct, codes = _codes(np, column)
+                count = len(distinct)
+            if radix * count >= 1 << 62:
+                distinct, combined = _codes(np, combined)
+                radix = len(distinct)
+            combined = combined * count + codes
+            radix *= count
+        distinct, combined = _codes(np, combined)
+        # a row of each distinct key, to read the key from
+        rows = np.empty(len(distinct), dtype=np.int64)
+        rows[combined] = np.arange(len(combined))
+        lookup = np.empty(len(distinct), dtype=np.int64)
+        key_columns = [columns[name][rows].tolist() for name in _KEY_COLUMNS]
+        for position, key in enumerate(zip(*key_columns)):
+            number = self.keys.get(key)
+            if number is None:
+                number = self.keys[key] = len(self.streams)
+                self.streams.append(key)
+            lookup[position] = number
+        self.grow()
+        return lookup[combined]
+
+    def add(self, columns):
+        # account for a chunk of datagrams in arrival order
+        np = self.np
+        arrival = columns["arrival"]
+        if not len(arrival):
+            return
+        if self.origin is None:
+            self.origin = int(arrival.min())
+            self.first_ns = self.origin
+        self.last_ns = max(self.last_ns or 0, int(arrival.max()))
+        self.packets += len(arrival)
+        self.bytes += int(columns["size"].sum())
+        window = np.maximum((arrival - self.origin) // self.window_ns, 0)
+        self.tally(columns["group"], window, (0, None), (1, columns["size"]))
+        header = columns["header"]
+        stamped = int(np.count_nonzero(header))
+        self.bare += len(arrival) - stamped
+        if stamped == len(arrival):
+            self.add_streams(columns, window)
+        elif stamped:
+            self.add_streams(
+                {name: column[header] for name, column in columns.items()},
+                window[header],
+            )
+
+    def add_streams(self, columns, window):
+        np = self.np
+        state = self.state
+        numbers = self.numbers(columns)
+        # stream by stream, in arrival order within each
+        if len(self.streams) <= 1 << 16:
+            # a radix sort for 16-bit keys
+            order = np.argsort(numbers.astype(np.uint16), kind="stable")
+        else:
+            order = np.argsort(numbers, kind="stable")
+        numbers = numbers[order]
+        sequence = columns["sequence"][order]
+        arrival = columns["arrival"][order]
+        sent = columns["sent"][order]
+        size = columns["size"][order]
+        group = columns["group"][order]
+        window = window[order]
+        rows = len(numbers)
+        first = np.flatnonzero(np.concatenate(([True], numbers[1:] != numbers[:-1])))
+        present = numbers[first]
+        segment = np.repeat(
+            np.arange(len(first)), np.diff(np.concatenate((first, [rows])))
+        )
+        segments = len(first)
+        # the highest sequence before each packet, including earlier chunks
+        carry = state["highest"][present][segment]
+        base = int(sequence.min())
+        span = int(sequence.max()) - base + 1
+        if segments * span < 1 << 62:
+            # segments are offset so the running maximum cannot cross them
+            offset = segment * span
+            key = sequence - base + offset
+            running = np.maximum.accumulate(key) - offset + base
+            # sequences mostly arrive in order, which the merge sort of a
+            # stable argsort finds as long sorted runs
+            by_sequence = np.argsort(key, kind="stable")
+            del key, offset
+        else:
+            running = np.empty_like(sequence)
+            ends = np.concatenate((first[1:], [rows]))
+            for start, end in zip(first.tolist(), ends.tolist()):
+                running[start:end] = np.maximum.accumulate(sequence[start:end])
+            by_sequence = np.lexsort((sequence, segment))
+        previous = np.empty_like(running)
+        previous[1:] = running[:-1]
+        previous[first] = -1
+        previous = np.maximum(previous, carry)
+        advance = sequence - previous
+        # repeats of a sequence number, in order of sequence then arrival
+        ordered = sequence[by_sequence]
+        ordered_segment = segment[by_sequence]
+        repeat = np.zeros(rows, dtype=bool)
+        repeat[1:] = (ordered[1:] == ordered[:-1]) & (
+            ordered_segment[1:] == ordered_segment[:-1]
+        )
+        duplicate = np.empty(rows, dtype=bool)
+        duplicate[by_sequence] = repeat
+        # the first of a chunk at or below what an earlier chunk saw is a
+        # duplicate if seen there, and otherwise fills a gap counted there
+        behind = carry - sequence
+        earlier = (behind >= 0) & ~duplicate
+        recent = np.flatnonzero(earlier & (behind < REORDER_WINDOW))
+        seen = np.zeros(rows, dtype=bool)
+        seen[recent] = self.seen[numbers[recent], sequence[recent] % REORDER_WINDOW]
+        duplicate |= seen
+        late = (advance < 0) & ~duplicate
+        fills = late & earlier & (sequence > state["lowest"][present][segment])
+        # gaps between the distinct sequence numbers above the carry
+        fresh = ~repeat & (ordered > carry[by_sequence])
+        fresh_rows = by_sequence[fresh]
+        fresh_sequence = ordered[fresh]
+        fresh_segment = ordered_segment[fresh]
+        below = np.empty_like(fresh_sequence)
+        below[1:] = fresh_sequence[:-1]
+        starts = np.ones(len(fresh_sequence), dtype=bool)
+        starts[1:] = fresh_segment[1:] != fresh_segment[:-1]
+        below[starts] = carry[fresh_rows][starts]
+        holes = np.where(below >= 0, fresh_sequence - below - 1, 0)
+        runs = holes > 0
+        run_lengths = holes[runs]
+        run_segment = fresh_segment[runs]
+        if len(run_lengths):
+            self.run_lengths += np.bincount(
+                np.frexp(run_lengths.astype(np.float64))[1], minlength=64
+            )[:64]
+            self.tally(
+                group[fresh_rows][runs], window[fresh_rows][runs], (2, run_lengths)
+            )
+        if fills.any():
+            self.tally(group[fills], window[fills], (2, -np.ones(int(fills.sum()))))
+
+        def per_segment(values=None, mask=None):
+            # sum of values (or count of rows) per segment
+            index = segment if mask is None else segment[mask]
+            if values is not None and mask is not None:
+                values = values[mask]
+            return np.bincount(index, weights=values, minlength=segments).astype(
+                np.int64
+            )
+
+        state["packets"][present] += per_segment()
+        state["bytes"][present] += per_segment(size)
+        state["duplicates"][present] += per_segment(mask=duplicate)
+        state["out_of_order"][present] += per_segment(mask=late)
+        state["reorder_max"][present] = np.maximum(
+            state["reorder_max"][present],
+            np.maximum.reduceat(np.where(late, -advance, 0), first),
+        )
+        state["lost"][present] += np.bincount(
+            fresh_segment, weights=holes, minlength=segments
+        ).astype(np.int64) - per_segment(mask=fills)
+        state["loss_runs"][present] += np.bincount(run_segment, minlength=segments)
+        state["long_runs"][present] += np.bincount(
+            run_segment[run_lengths > self.long_run], minlength=segments
+        )
+        longest = np.zeros(segments, dtype=np.int64)
+        np.maximum.at(longest, run_segment, run_lengths)
+        state["longest_run"][present] = np.maximum(
+            state["longest_run"][present], longest
+        )
+        # inter-arrival gaps, the first against the previous chunk
+        last = state["last_ns"][present]
+        gap = np.empty_like(arrival)
+        gap[1:] = arrival[1:] - arrival[:-1]
+        gap[first] = arrival[first] - last
+        measured = np.ones(rows, dtype=bool)
+        measured[first] = last > 0
+        gap = np.maximum(gap, 0) // 1000
+        self.record("gap", numbers, gap, measured)
+        state["gap_max"][present] = np.maximum(
+            state["gap_max"][present],
+            np.maximum.reduceat(np.where(measured, gap, 0), first),
+        )
+        # one-way delay of the packets the sender stamped
+        stamped = sent > 0
+        delay = np.maximum(arrival - sent, 0) // 1000
+        self.record("delay", numbers, delay, stamped)
+        state["delay_max"][present] = np.maximum(
+            state["delay_max"][present],
+            np.maximum.reduceat(np.where(stamped, delay, 0), first),
+        )
+        highest = np.maximum.reduceat(sequence, first)
+        lowest = np.minimum.reduceat(sequence, first)
+        self.remember(present, highest, segment, numbers, sequence)
+        known = state["lowest"][present] >= 0
+        state["lowest"][present] = np.where(
+            known, np.minimum(state["lowest"][present], lowest), lowest
+        )
+        state["highest"][present] = np.maximum(state["highest"][present], highest)
+        first_ns = np.minimum.reduceat(arrival, first)
+        state["first_ns"][present] = np.where(
+            last > 0, np.minimum(state["first_ns"][present], first_ns), first_ns
+        )
+        state["last_ns"][present] = np.maximum(
+            last, np.maximum.reduceat(arrival, first)
+        )
+
+    def remember(self, present, highest, segment, numbers, sequence):
+        # move the seen window of the present streams up to the highest
+        # sequence of this chunk and mark the chunk's sequences in it
+        np = self.np
+        carry = self.state["highest"][present]
+        top = np.maximum(carry, highest)
+        # the columns of the sequences above carry now stand for new ones
+        column = np.arange(REORDER_WINDOW)
+        stale = (column - carry[:, None] - 1) % REORDER_WINDOW < (top - carry)[:, None]
+        stale[(carry < 0) | (top - carry >= REORDER_WINDOW)] = True
+        seen = self.seen[present]
+        seen[stale] = False
+        self.seen[present] = seen
+        inside = sequence > top[segment] - REORDER_WINDOW
+        self.seen[numbers[inside], sequence[inside] % REORDER_WINDOW] = True
+
+    def stream_record(self, number):
+        group, source, port, stream_id = self.streams[number]
+        state = {name: int(self.state[name][number]) for name, _value in _STATE}
+        seconds = (state["last_ns"] - state["first_ns"]) / 1e9
+        packets = state["packets"]
+        lost = max(state["lost"], 0)
+        expected = packets - state["duplicates"] + lost
+        record = {
+            "type": "summary",
+            "role": "stream",
+            "stream": stream_id,
+            "group": format_group(group),
+            "source": "{0}:{1}".format(format_address(source), port),
+            "seconds": round(seconds, 6),
+            "packets": packets,
+            "bytes": state["bytes"],
+            "pps": (packets - 1) / seconds if seconds > 0 else 0.0,
+            "lost": lost,
+            "loss_pct": 100.0 * lost / expected if expected > 0 else 0.0,
+            "duplicates": state["duplicates"],
+            "out_of_order": state["out_of_order"],
+            "reorder_max": state["reorder_max"],
+            "loss_runs": state["loss_runs"],
+            "long_runs": state["long_runs"],
+            "longest_run": state["longest_run"],
+        }
+        if number < len(self.histograms["gap"]):
+            gaps = self.histogram(self.histograms["gap"][number], state["gap_max"])
+            if gaps.count:
+                record.update(
+                    gap_p50_us=gaps.percentile(50.0),
+                    gap_p99_us=gaps.percentile(99.0),
+                )
+            delay = self.histogram(self.histograms["delay"][number], state["delay_max"])
+            if delay.count:
+                record.update(
+                    delay_p50_us=delay.percentile(50.0),
+                    delay_p99_us=delay.percentile(99.0),
+                    delay_p999_us=delay.percentile(99.9),
+                )
+        record["gap_max_us"] = state["gap_max"]
+        if "delay_p50_us" in record or state["delay_max"]:
+            record["delay_max_us"] = state["delay_max"]
+        return record
+
+    def stream_text(self, record):
+        text = "stream {0} {1} from {2}: received {3} ({4}) {5:.1f} pps lost {6} ({7:.2f}%)".format(
+            record["stream"],
+            record["group"],
+            record["source"],
+            record["packets"],
+            format_bytes(record["bytes"]),
+            record["pps"],
+            record["lost"],
+            record["loss_pct"],
+        )
+        if record["loss_runs"]:
+            text += " in {0} run(s), longest {1}, {2} over {3}".format(
+                record["loss_runs"],
+                record["longest_run"],
+                record["long_runs"],
+                self.long_run,
+            )
+        text += ", {0} out of order (depth up to {1}), {2} duplicate".format(
+            record["out_of_order"], record["reorder_max"], record["duplicates"]
+        )
+        if "gap_p50_us" in record:
+            text += "; gaps p50 {0} p99 {1} max {2}".format(
+                format_usec(record["gap_p50_us"]),
+                format_usec(record["gap_p99_us"]),
+                format_usec(record["gap_max_us"]),
+            )
+        if "delay_p50_us" in record:
+            text += "; delay p50 {0} p99 {1} p99.9 {2} max {3}".format(
+                format_usec(record["delay_p50_us"]),
+                format_usec(record["delay_p99_us"]),
+                format_usec(record["delay_p999_us"]),
+                format_usec(record["delay_max_us"]),
+            )
+        return text
+
+    def report_windows(self, output):
+        # a record per group and window, and one line per group: the range
+        # of rates over its windows and the window with the most loss
+        seconds = self.window_ns / 1e9
+        by_group = {}
+        for key in self.windows:
+            by_group.setdefault(key >> 32, []).append(key & 0xFFFFFFFF)
+        lines = 0
+        for group in sorted(by_group):
+            indexes = by_group[group]
+            first = min(indexes)
+            last = max(indexes)
+            rates = []
+            lossy = 0
+            worst = None
+            for index in range(first, last + 1):
+                # windows without a packet are part of the run too
+                packets, nbytes, lost = self.windows.get(
+                    (group << 32) | index, (0, 0, 0)
+                )
+                lost = max(lost, 0)
+                rates.append(packets / seconds)
+                expected = packets + lost
+                record = {
+                    "type": "window",
+                    "role": "group",
+                    "group": format_group(group),
+                    "start": format_time(self.origin + index * self.window_ns),
+                    "seconds": seconds,
+                    "packets": packets,
+                    "bytes": nbytes,
+                    "pps": packets / seconds,
+                    "bps": nbytes * 8 / seconds,
+                    "lost": lost,
+                    "loss_pct": 100.0 * lost / expected if expected else 0.0,
+                }
+                if lost:
+                    lossy += 1
+                    if worst is None or lost > worst["lost"]:
+                        worst = record
+                output.emit(record, None)
+                lines += 1
+                if lines % 10000 == 0:
+                    output.flush()
+            rates.sort()
+            text = "group {0}: {1} windows of {2}, {3:.1f}-{4:.1f} pps (median {5:.1f}), {6} with loss".format(
+                format_group(group),
+                len(rates),
+                format_usec(seconds * 1e6),
+                rates[0],
+                rates[-1],
+                rates[len(rates) // 2],
+                lossy,
+            )
+            if worst is not None:
+                text += ", worst {0} lost ({1:.2f}%) at {2}".format(
+                    worst["lost"], worst["loss_pct"], worst["start"]
+                )
+            output.write(text)
+
+    def report(self, output, files, records, skipped, elapsed):
+        np = self.np
+        order = sorted(
+            range(len(self.streams)), key=lambda number: self.streams[number]
+        )
+        lost = 0
+        for number in order:
+            record = self.stream_record(number)
+            lost += record["lost"]
+            text = None
+            if len(order) <= STREAM_LINE_LIMIT:
+                text = self.stream_text(record)
+            output.emit(record, text)
+        self.report_windows(output)
+        if self.run_lengths.any():
+            # runs of 1, 2-3, 4-7, ... packets
+            parts = []
+            for bits in np.flatnonzero(self.run_lengths).tolist():
+                low = 1 << (bits - 1)
+                high = (1 << bits) - 1
+                parts.append(
+                    "{0}: {1}".format(
+                        low if low == high else "{0}-{1}".format(low, high),
+                        int(self.run_lengths[bits]),
+                    )
+                )
+            output.write("loss runs by length: {0}".format(", ".join(parts)))
+        seconds = (self.last_ns - self.first_ns) / 1e9 if self.packets else 0.0
+        record = {
+            "type": "summary",
+            "role": "capture",
+            "file": " ".join(files),
+            "seconds": round(seconds, 6),
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "pps": self.packets / seconds if seconds > 0 else 0.0,
+            "lost": lost,
+            "flows": len(self.streams),
+            "skipped": skipped,
+        }
+        gaps = self.histogram(self.totals["gap"], self.maxima["gap"])
+        delay = self.histogram(self.totals["delay"], self.maxima["delay"])
+        if delay.count:
+            record.update(
+                delay_p50_us=delay.percentile(50.0),
+                delay_p99_us=delay.percentile(99.0),
+                delay_p999_us=delay.percentile(99.9),
+                delay_max_us=delay.max,
+            )
+        text = "{0} packets ({1}) of {2} stream(s) over {3:.3f}s, lost {4}".format(
+            self.packets, format_bytes(self.bytes), len(self.streams), seconds, lost
+        )
+        if self.bare:
+            text += ", {0} without a bcmc header".format(self.bare)
+        if skipped:
+            text += ", {0} of {1} records not UDP/IPv4 skipped".format(skipped, records)
+        if gaps.count:
+            text += "; gaps {0}".format(format_percentiles(gaps))
+        if delay.count:
+            text += "; delay {0}".format(format_percentiles(delay))
+        output.emit(record, text)
+        output.write(
+            "analyzed {0} records in {1:.2f}s ({2:.2f} M records/s)".format(
+                records, elapsed, records / elapsed / 1e6 if elapsed > 0 else 0.0
+            )
+        )
+
+
+def analyze(paths, output, window=1.0, chunk=0, long_run=5):
+    # analyze the files as one run, in order. with chunk, at most chunk
+    # records are held in memory at a time; otherwise all of them are
+    # decoded first and analyzed in one pass, which is exact
+    np = load_numpy()
+    started = time.perf_counter()
+    analysis = Analysis(np, window, long_run)
+    parts = []
+    records = 0
+    skipped = 0
+    for path in paths:
+        source = open_columns(np, path)
+        try:
+            while True:
+                columns = source.read(chunk or sys.maxsize)
+                if columns is None:
+                    break
+                if chunk:
+                    analysis.add(columns)
+                else:
+                    parts.append(columns)
+        finally:
+            source.close()
+        records += source.records
+        skipped += source.skipped
+    if parts:
+        analysis.add(_concatenate(np, parts))
+        del parts
+    if not analysis.packets:
+        raise AnalyzeError("no UDP/IPv4 datagrams in {0}".format(" ".join(paths)))
+    analysis.report(output, paths, records, skipped, time.perf_counter() - started)
@@ -4,10 +4,41 @@
 
 
 import argparse
+import os
+import sys
 
+from .groups import expand_groups
+from .helpers import DEFAULT_CONTROL_PORT
 from .version import __version__
 
 
+class HelpFormatter(argparse.RawDescriptionHelpFormatter):
+    # argparse builds a formatter for every add_argument() and sizes it to
+    # the terminal with shutil, whose imports (bz2, lzma, ...) take longer
+    # than building and parsing the whole command line; ask os instead
+
+    def __init__(self, prog, indent_increment=2, max_help_position=24, width=None):
+        if width is None:
+            width = terminal_width() - 2
+        argparse.RawDescriptionHelpFormatter.__init__(
+            self, prog, indent_increment, max_help_position, width
+        )
+
+
+def terminal_width():
+    # shutil.get_terminal_size().columns: $COLUMNS, the terminal, or 80
+    try:
+        columns = int(os.environ["COLUMNS"])
+    except (KeyError, ValueError):
+        columns = 0
+    if columns <= 0:
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 0
+    return columns or 80
+
+
 def port(value):
     # validate user port input is between 0 and 65535
 
@@ -30,6 +61,267 @@ def interval(value):
         raise argparse.ArgumentTypeError("interval must be an number like 1 or 0.5")
 
 
+_SI_SCALE = {"k": 1e3, "m": 1e6, "g": 1e9}
+
+
+def _si_number(value, units):
+    # parse numbers like 20000, 20k or 1.5M with an optional trailing unit
+
+    text = value.strip().lower()
+    for unit in units:
+        if text.endswith(unit):
+            text = text[: -len(unit)]
+            break
+    scale = 1
+    if text[-1:] in _SI_SCALE:
+        scale = _SI_SCALE[text[-1:]]
+        text = text[:-1]
+    return float(text) * scale
+
+
+def rate(value):
+    # validate user rate input like 20000pps, 20kpps or 500
+
+    try:
+        rate = _si_number(value, ("pps",))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "rate must be a number of packets per second like 500, 20000pps or 20kpps"
+        )
+    if rate <= 0:
+        raise argparse.ArgumentTypeError("rate must be greater than 0")
+    return rate
+
+
+def bandwidth(value):
+    # validate user bandwidth input like 50M, 1.5Mbps or 800k (bits per second)
+
+    try:
+        bandwidth = _si_number(value, ("bps", "bit/s", "bits", "bit", "b"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "bandwidth must be a number of bits per second like 800k, 50M or 1G"
+        )
+    if bandwidth <= 0:
+        raise argparse.ArgumentTypeError("bandwidth must be greater than 0")
+    return bandwidth
+
+
+def burst(value):
+    # validate user burst input is a positive number of packets
+
+    try:
+        burst = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("burst must be an integer")
+    if burst < 1 or burst > 1024:
+        raise argparse.ArgumentTypeError("burst must be between 1 and 1024")
+    return burst
+
+
+def workers(value):
+    # validate user workers input is a positive number of processes
+
+    try:
+        workers = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("workers must be an integer")
+    if workers < 1 or workers > 256:
+        raise argparse.ArgumentTypeError("workers must be between 1 and 256")
+    return workers
+
+
+def receivers(value):
+    # validate user receivers input is a positive number of clients
+
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("receivers must be an integer")
+    if count < 1 or count > 10000:
+        raise argparse.ArgumentTypeError("receivers must be between 1 and 10000")
+    return count
+
+
+def report_interval(value):
+    # validate user report interval input is a non-negative number of seconds
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "report interval must be a number of seconds like 1 or 0.5"
+        )
+    if seconds < 0:
+        raise argparse.ArgumentTypeError("report interval must not be negative")
+    return seconds
+
+
+def flow_idle(value):
+    # validate user flow idle timeout input is a positive number of seconds
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "flow idle timeout must be a number of seconds like 30"
+        )
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError("flow idle timeout must be greater than 0")
+    return seconds
+
+
+def soak_gap(value):
+    # validate user outage threshold input is a number of packet spacings
+
+    try:
+        spacings = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "soak gap must be a number of packet spacings like 10"
+        )
+    if spacings <= 1:
+        raise argparse.ArgumentTypeError("soak gap must be greater than 1")
+    return spacings
+
+
+def checkpoint_interval(value):
+    # validate user checkpoint interval input is a positive number of seconds
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "checkpoint interval must be a number of seconds like 60"
+        )
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError("checkpoint interval must be greater than 0")
+    return seconds
+
+
+def metrics_address(value):
+    # validate user metrics endpoint input like 9102 or 0.0.0.0:9102
+
+    host, _, number = value.rpartition(":")
+    try:
+        number = int(number)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "metrics address must be a port like 9102 or host:port"
+        )
+    if not 0 < number < 65536:
+        raise argparse.ArgumentTypeError("metrics port must be between 1 and 65535")
+    return host or "127.0.0.1", number
+
+
+def window(value):
+    # validate user analysis window input is a positive number of seconds
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "window must be a number of seconds like 1 or 0.1"
+        )
+    if seconds < 0.000001:
+        raise argparse.ArgumentTypeError("window must be at least 1 microsecond")
+    return seconds
+
+
+def chunk(value):
+    # validate user chunk input like 1M (records)
+
+    try:
+        records = _si_number(value, ())
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "chunk must be a number of records like 500k or 2M"
+        )
+    if records < 1000:
+        raise argparse.ArgumentTypeError("chunk must be at least 1k records")
+    return int(records)
+
+
+def long_run(value):
+    # validate user loss run threshold input is a positive number of packets
+
+    try:
+        packets = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("long run must be a number of packets")
+    if packets < 1:
+        raise argparse.ArgumentTypeError("long run must be at least 1 packet")
+    return packets
+
+
+def rotate_size(value):
+    # validate user pcap rotation size input like 100M or 1G (bytes)
+
+    try:
+        size = _si_number(value, ("bytes", "byte", "b"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "rotation size must be a number of bytes like 500k, 100M or 1G"
+        )
+    if size < 1024:
+        raise argparse.ArgumentTypeError("rotation size must be at least 1k")
+    return int(size)
+
+
+def buffer_size(value):
+    # validate user socket buffer size input like 4M (bytes)
+
+    try:
+        size = _si_number(value, ("bytes", "byte", "b"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "buffer size must be a number of bytes like 256k or 8M"
+        )
+    if size < 1024 or size > 2**31 - 1:
+        raise argparse.ArgumentTypeError("buffer size must be between 1k and 2G")
+    return int(size)
+
+
+def traffic(value):
+    # validate a traffic profile file or shorthand
+    from .traffic import load_profile
+
+    try:
+        return load_profile(value)
+    except (OSError, ValueError) as error:
+        raise argparse.ArgumentTypeError(
+            "invalid traffic profile {0!r}: {1}".format(value, error)
+        )
+
+
+def streams(value):
+    # validate a stream config file
+    from .streams import load_streams
+
+    try:
+        return load_streams(value)
+    except (OSError, ValueError) as error:
+        raise argparse.ArgumentTypeError(
+            "invalid stream config {0!r}: {1}".format(value, error)
+        )
+
+
+def replay_speed(value):
+    # validate user replay speed input like 1, 0.5, 10 or max
+
+    if value.strip().lower() in ("max", "0"):
+        return 0.0
+    try:
+        speed = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "replay speed must be a multiplier like 1, 0.5 or 10, or max"
+        )
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("replay speed must be greater than 0")
+    return speed
+
+
 def dscp(value):
     # validate user dscp input is between 0 and 63
 
@@ -48,6 +340,18 @@ def ttl(value):
     return ttl
 
 
+def stream_id(value):
+    # validate user stream id input fits in the 32-bit header field
+
+    try:
+        stream_id = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("stream id must be an integer")
+    if stream_id > 0xFFFFFFFF or stream_id < 0:
+        raise argparse.ArgumentTypeError("stream id must be between 0 and 4294967295")
+    return stream_id
+
+
 def isIPv4(ip):
     if ip:
         if str(int(ip)) == ip and 0 <= int(ip) <= 255:
@@ -71,6 +375,27 @@ def ip(ip):
     raise argparse.ArgumentTypeError("IP must be a valid IPv4 IP Address")
 
 
+def groups(value):
+    # validate user group input is one or more multicast addresses or ranges;
+    # single addresses accept the same shorthand as ip()
+
+    items = []
+    for item in value.split(","):
+        item = item.strip()
+        if "/" in item or "-" in item:
+            items.append(item)
+        elif item:
+            items.append(ip(item))
+    try:
+        return expand_groups(",".join(items))
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+            "group must be a multicast address, list or range like 239.1.0.0/20 or 239.1.0.1-239.1.0.50 ({0})".format(
+                error
+            )
+        )
+
+
 def setup_parser():
     # setup the argument parser for the application
 
@@ -79,11 +404,12 @@ def setup_parser():
     desc = "%(tag)s\r\n\r\n%(info)s" % locals()
 
     usage_head = "bcmc [-s|-c] [-bc|-mc] [options]"
+    usage_analyze = "       bcmc analyze FILE [FILE ...] [options]"
     usage_foot = "       bcmc [-h|--help] [-v|--version]"
-    usage_blurb = "%(usage_head)s\r\n%(usage_foot)s" % locals()
+    usage_blurb = "%(usage_head)s\r\n%(usage_analyze)s\r\n%(usage_foot)s" % locals()
 
     parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
+        formatter_class=HelpFormatter,
         description=desc,
         epilog="Made with Python ♥",
         fromfile_prefix_chars="@",
@@ -155,13 +481,20 @@ def setup_parser():
         default=False,
         help="set traffic type to multicast",
     )
+    parser.add_argument(
+        "--asyncio",
+        dest="asyncio",
+        action="store_true",
+        default=False,
+        help="run servers and listeners on one asyncio event loop instead of threads",
+    )
     parser.add_argument(
         "--group",
         dest="group",
         metavar="239.0.0.2",
-        type=ip,
-        default="239.0.0.2",
-        help="multicast group address (239.0.0.2 by default)",
+        type=groups,
+        default=["239.0.0.2"],
+        help="multicast group address (239.0.0.2 by default); also a comma separated list or range like 239.1.0.0/20 or 239.1.0.1-239.1.0.50, which servers send to round robin",
     )
     parser.add_argument(
         "-i",
@@ -172,6 +505,77 @@ def setup_parser():
         default="1",
         help="interval to send multicast packets",
     )
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        metavar="20000pps",
+        type=rate,
+        default=None,
+        help="send at a fixed packet rate in server mode (overrides --interval)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        dest="bandwidth",
+        metavar="50M",
+        type=bandwidth,
+        default=None,
+        help="send at a fixed payload bit rate in server mode (overrides --interval)",
+    )
+    parser.add_argument(
+        "--traffic",
+        dest="traffic",
+        metavar="PROFILE",
+        type=traffic,
+        default=None,
+        help="in server mode, send following a scripted profile from a .json/.toml file or shorthand like constant:1k:10,ramp:100-5k:30,burst:20k:0.1/0.9:10,poisson:1k:10[:SEED][,repeat] (rates in pps, times in seconds); stops at its end unless it repeats",
+    )
+    parser.add_argument(
+        "--burst",
+        dest="burst",
+        metavar="1",
+        type=burst,
+        default=1,
+        help="number of packets sent back to back per pacing tick in server mode, batched with sendmmsg on Linux",
+    )
+    parser.add_argument(
+        "--streams",
+        dest="streams",
+        metavar="FILE",
+        type=streams,
+        default=None,
+        help="in server mode, send every stream of a .json/.toml FILE, broadcast and multicast, each with its own group, port, rate, DSCP, TTL and payload (-bc/-mc are not needed)",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        metavar="1",
+        type=workers,
+        default=1,
+        help="split the offered load in server mode across this many processes, by group when there are enough groups or else by sequence number",
+    )
+    parser.add_argument(
+        "--rcvbuf",
+        dest="rcvbuf",
+        metavar="8M",
+        type=buffer_size,
+        default=0,
+        help="request this socket receive buffer size in client mode and report the size granted",
+    )
+    parser.add_argument(
+        "--sndbuf",
+        dest="sndbuf",
+        metavar="1M",
+        type=buffer_size,
+        default=0,
+        help="request this socket send buffer size in server mode and report the size granted",
+    )
+    parser.add_argument(
+        "--no-kernel-timestamps",
+        dest="kernel_timestamps",
+        action="store_false",
+        default=True,
+        help="time arrivals in user space instead of with Linux SO_TIMESTAMPNS, and do not count socket drops with SO_RXQ_OVFL",
+    )
     parser.add_argument(
         "--ttl",
         dest="ttl",
@@ -202,4 +606,252 @@ def setup_parser():
         default="",
         help="add an arbitrary payload which is sent in server mode",
     )
+    parser.add_argument(
+        "--header",
+        dest="header",
+        action="store_true",
+        default=False,
+        help="prepend a binary sequence header to payloads sent in server mode so clients can count loss, duplicates and reordering and measure one-way delay and jitter",
+    )
+    parser.add_argument(
+        "--stream-id",
+        dest="stream_id",
+        metavar="0",
+        type=stream_id,
+        default=0,
+        help="stream id written in the sequence header (0 by default)",
+    )
+    parser.add_argument(
+        "--report-interval",
+        dest="report_interval",
+        metavar="1",
+        type=report_interval,
+        default=1.0,
+        help="seconds between summary lines of packets, rate, loss and jitter; 0 disables them (1 by default)",
+    )
+    parser.add_argument(
+        "--flows",
+        dest="flows",
+        action="store_true",
+        default=False,
+        help="in client mode, keep delivery stats per sender (source address, source port and stream id) and report rate, loss and jitter of each",
+    )
+    parser.add_argument(
+        "--flow-idle",
+        dest="flow_idle",
+        metavar="30",
+        type=flow_idle,
+        default=30.0,
+        help="seconds without packets after which a sender's flow is reported and forgotten (30 by default)",
+    )
+    parser.add_argument(
+        "--soak",
+        dest="soak",
+        metavar="FILE",
+        default=None,
+        help="in client mode, run for days in bounded memory: keep rolling one-hour windows, report outages and checkpoint the totals to FILE, resuming from it on restart",
+    )
+    parser.add_argument(
+        "--soak-gap",
+        dest="soak_gap",
+        metavar="10",
+        type=soak_gap,
+        default=10.0,
+        help="with --soak, a silence longer than this many typical packet spacings (and at least 50 ms) is an outage (10 by default)",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        metavar="60",
+        type=checkpoint_interval,
+        default=60.0,
+        help="with --soak, seconds between checkpoints and status lines (60 by default)",
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        choices=("text", "json", "csv"),
+        default="text",
+        help="format of interval and final results: text, JSON Lines or CSV (text by default)",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        metavar="FILE",
+        default=None,
+        help="append results to FILE instead of printing them",
+    )
+    parser.add_argument(
+        "--packet-log",
+        dest="packet_log",
+        metavar="FILE",
+        default=None,
+        help="in client mode, append one record per received packet to FILE (CSV, JSON Lines with --format json, or a compact binary log for bcmc analyze if FILE ends in .bin)",
+    )
+    parser.add_argument(
+        "--pcap",
+        dest="pcap",
+        metavar="FILE",
+        default=None,
+        help="in client mode, capture every received datagram to a pcap FILE",
+    )
+    parser.add_argument(
+        "--pcap-rotate-size",
+        dest="pcap_rotate_size",
+        metavar="100M",
+        type=rotate_size,
+        default=0,
+        help="start a new numbered pcap file once the current one reaches this size",
+    )
+    parser.add_argument(
+        "--pcap-rotate-time",
+        dest="pcap_rotate_time",
+        metavar="3600",
+        type=report_interval,
+        default=0,
+        help="start a new numbered pcap file every this many seconds",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay",
+        metavar="FILE",
+        default=None,
+        help="in server mode, send the UDP datagrams of a pcap FILE instead of generated payloads",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        dest="replay_speed",
+        metavar="1",
+        type=replay_speed,
+        default=1.0,
+        help="replay at this multiple of the captured timing, or max for as fast as possible (1 by default; --rate/--bandwidth override it)",
+    )
+    parser.add_argument(
+        "--control",
+        dest="control",
+        action="store_true",
+        default=False,
+        help="in server mode, accept receivers on a TCP control channel, send them the test parameters and print their results when stopped",
+    )
+    parser.add_argument(
+        "--connect",
+        dest="connect",
+        metavar="<server>",
+        default=None,
+        help="in client mode, register with the control channel of the server at <server> and take -bc/-mc, --group and --port from it",
+    )
+    parser.add_argument(
+        "--control-port",
+        dest="control_port",
+        metavar=str(DEFAULT_CONTROL_PORT),
+        type=port,
+        default=DEFAULT_CONTROL_PORT,
+        help="TCP port of the control channel ({0} by default)".format(
+            DEFAULT_CONTROL_PORT
+        ),
+    )
+    parser.add_argument(
+        "--receivers",
+        dest="receivers",
+        metavar="N",
+        type=receivers,
+        default=0,
+        help="with --control, wait for N receivers to register before sending",
+    )
+    parser.add_argument(
+        "--stats-detail",
+        dest="stats_detail",
+        action="store_true",
+        default=False,
+        help="time each stage of the send loop (pace, build, send) and receive loop (wait, recv, parse, record, report) and report the totals at shutdown",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        metavar="[HOST:]PORT",
+        type=metrics_address,
+        default=None,
+        help="serve live packet, byte, loss, jitter, delay, kernel drop and pacing counters of every stream in the Prometheus text format at http://HOST:PORT/metrics (HOST is 127.0.0.1 by default)",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        default=None,
+        help="run under cProfile and print the top functions at shutdown, or save the stats to FILE (the parent process only with --workers)",
+    )
+    parser.add_argument(
+        "--startup-timing",
+        dest="startup_timing",
+        action="store_true",
+        default=False,
+        help="report at shutdown how long start-up took: imports, argument parsing, output setup, until groups were joined (client) and until the first packet was sent (server)",
+    )
+    parser.add_argument(
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="print every packet sent or received",
+    )
+    return parser
+
+
+def setup_analyze_parser():
+    # setup the argument parser for the analyze subcommand
+
+    desc = "analyze pcap captures (--pcap) and binary packet logs (--packet-log FILE.bin) after a run: loss, loss runs, reordering, gaps and delay per stream, and throughput and loss per window and group. needs NumPy."
+
+    parser = argparse.ArgumentParser(
+        prog="bcmc analyze",
+        formatter_class=HelpFormatter,
+        description=desc,
+        usage="bcmc analyze FILE [FILE ...] [options]",
+    )
+    parser.add_argument(
+        "files",
+        metavar="FILE",
+        nargs="+",
+        help="pcap captures or binary packet logs of one run, in order (e.g. rotated captures)",
+    )
+    parser.add_argument(
+        "--window",
+        dest="window",
+        metavar="1",
+        type=window,
+        default=1.0,
+        help="seconds per throughput and loss window (1 by default)",
+    )
+    parser.add_argument(
+        "--long-run",
+        dest="long_run",
+        metavar="5",
+        type=long_run,
+        default=5,
+        help="count the loss runs of more than this many consecutive packets separately (5 by default)",
+    )
+    parser.add_argument(
+        "--chunk",
+        dest="chunk",
+        metavar="4M",
+        type=chunk,
+        default=0,
+        help="hold at most this many records in memory, for files larger than RAM; loss runs split by packets arriving a chunk late are counted whole",
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        choices=("text", "json", "csv"),
+        default="text",
+        help="format of the results: text, JSON Lines or CSV with a record per stream and per window (text by default)",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        metavar="FILE",
+        default=None,
+        help="append results to FILE instead of printing them",
+    )
     return parser
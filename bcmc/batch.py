@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# batch.py: provide batched datagram transmission for bcmc servers
+
+# stdlib imports
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+
+# app imports
+from .mmsg import IOVec, MMsgHdr, sendmmsg
+
+
+def sockaddr_in(address):
+    # pack an (ip, port) tuple as a struct sockaddr_in
+    host, port = address
+    return (
+        struct.pack("=H", socket.AF_INET)
+        + struct.pack("!H", port)
+        + socket.inet_aton(host)
+        + b"\x00" * 8
+    )
+
+
+class BatchSender:
+    # send a fixed set of preallocated buffers to one destination, with a
+    # single sendmmsg() syscall on Linux or a tight sendto() loop elsewhere
+
+    def __init__(self, sock, destination, buffers, use_sendmmsg=True):
+        self.sock = sock
+        self.destination = destination
+        self.buffers = list(buffers)
+        self.count = len(self.buffers)
+        self.packets = 0
+        self.syscalls = 0
+        self.method = "sendto"
+        self._messages = None
+        if use_sendmmsg and sendmmsg is not None and self.count > 1:
+            self._setup_sendmmsg()
+
+    def _setup_sendmmsg(self):
+        count = self.count
+        self._name = ctypes.create_string_buffer(sockaddr_in(self.destination), 16)
+        self._iovecs = (IOVec * count)()
+        self._messages = (MMsgHdr * count)()
+        # keep the ctypes views alive; they pin the bytearrays in place
+        self._views = []
+        for index, buffer in enumerate(self.buffers):
+            view = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+            self._views.append(view)
+            self._iovecs[index].iov_base = ctypes.addressof(view)
+            self._iovecs[index].iov_len = len(buffer)
+            header = self._messages[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._name)
+            header.msg_namelen = 16
+            header.msg_iov = ctypes.pointer(self._iovecs[index])
+            header.msg_iovlen = 1
+        self._fd = self.sock.fileno()
+        self.method = "sendmmsg"
+
+    def send(self):
+        # send every buffer once and return the number of syscalls it took
+        if self._messages is None:
+            sendto = self.sock.sendto
+            destination = self.destination
+            for buffer in self.buffers:
+                sendto(buffer, destination)
+            calls = self.count
+        else:
+            calls = self._send_mmsg()
+        self.packets += self.count
+        self.syscalls += calls
+        return calls
+
+    def _send_mmsg(self):
+        messages = self._messages
+        sent = 0
+        calls = 0
+        while sent < self.count:
+            calls += 1
+            result = sendmmsg(
+                self._fd,
+                ctypes.byref(messages[sent]),
+                self.count - sent,
+                0,
+            )
+            if result < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # the socket send buffer is full; wait for room like
+                    # a blocking sendto() with the socket timeout would
+                    select.select([], [self.sock], [], self.sock.gettimeout())
+                    continue
+                if error == errno.EINTR:
+                    continue
+                raise OSError(error, os.strerror(error))
+            sent += result
+        return calls
+
+    def summary(self):
+        return "Burst mode ({0}): {1} packets in {2} send calls, {3} syscalls saved".format(
+            self.method,
+            self.packets,
+            self.syscalls,
+            self.packets - self.syscalls,
+        )
@@ -3,15 +3,31 @@
 # broadcast.py: provide broadcast class for bcmc
 
 # stdlib imports
-import platform
 import socket
 import sys
 import threading
 import time
-from datetime import datetime
 
 # app imports
-from .helpers import ServiceExit
+from .batch import BatchSender
+from .flows import DEFAULT_IDLE, FlowTable
+from .header import HEADER_SIZE, parse_header
+from .helpers import (
+    SYSTEM,
+    SendGuard,
+    ServiceExit,
+    format_clock,
+    local_address,
+    set_buffer_size,
+)
+from .output import PrintOutput
+from .pacer import Pacer
+from .payload import PayloadBuffer
+from .pcap import BROADCAST_KEY
+from .receiver import KERNEL_CONTROL_SIZE, ReceiveLoop, enable_kernel_stamps
+from .report import ListenerReport, ServerReport
+from .stages import PACE, PARSE, RECEIVE_STAGES, REPORT, SEND_STAGES, StageTimer
+from .stats import StreamTable
 
 
 class BroadcastServer:
@@ -26,6 +42,20 @@ class BroadcastServer:
         family=socket.AF_INET,
         host=None,
         payload=None,
+        header=False,
+        stream_id=0,
+        rate=None,
+        bandwidth=None,
+        burst=1,
+        sequence_start=1,
+        sequence_step=1,
+        verbose=True,
+        counters=None,
+        report_interval=0,
+        output=None,
+        stats_detail=False,
+        sndbuf=0,
+        traffic=None,
     ):
         self.port = int(port)
         self.padding = 2 * int(padding)
@@ -40,6 +70,36 @@ class BroadcastServer:
             self.host = socket.gethostname()
         self.stop_event = threading.Event()
         self.payload = payload
+        self.header = header
+        self.stream_id = int(stream_id)
+        self.pacer = Pacer.from_args(self.interval, rate, bandwidth)
+        self.burst = max(1, int(burst))
+        # workers interleave one sequence space with start/step
+        self.sequence_start = int(sequence_start)
+        self.sequence_step = int(sequence_step)
+        self.verbose = verbose
+        # optional (memoryview, slot) that packet and byte totals are
+        # published to, see workers.py
+        self.counters = counters
+        # text and result records go through an output.Output when given
+        self.output = output or PrintOutput()
+        self.write = self.output.write
+        self.reporter = ServerReport(self.output.emit, float(report_interval or 0))
+        # per-stage timers of the send loop with --stats-detail
+        self.stages = StageTimer("server", SEND_STAGES) if stats_detail else None
+        # a scripted traffic profile (see traffic.py) sets every deadline
+        self.traffic = None
+        if traffic is not None:
+            from .traffic import TrafficSchedule
+
+            self.traffic = TrafficSchedule(traffic, self.burst)
+            self.write(
+                "Traffic profile: {0} phases, {1} deadlines precomputed in {2:.1f} ms".format(
+                    len(self.traffic.phases),
+                    len(self.traffic),
+                    self.traffic.build_time * 1000,
+                )
+            )
 
         try:
             # AF_INET is a socket for IP packets
@@ -52,11 +112,29 @@ class BroadcastServer:
 
         self.set_platform_socket_options()
 
+        if sndbuf:
+            self.write(
+                "Send buffer: {0} bytes requested, {1} bytes effective".format(
+                    sndbuf,
+                    set_buffer_size(self.bc_server_sock, socket.SO_SNDBUF, sndbuf),
+                )
+            )
+
         # Set timeout so the socket does not block indefinitely.
         self.bc_server_sock.settimeout(0.2)
 
+        # one preallocated buffer per packet of a burst
+        self.packets = [self.build_payload() for _ in range(self.burst)]
+        self.packet = self.packets[0]
+        self.sender = BatchSender(
+            self.bc_server_sock,
+            (self.broadcast_address, self.port),
+            [packet.buffer for packet in self.packets],
+        )
+        self.targets = [(self.packets, self.sender)]
+
         if self.pyv == 3:
-            print("Sending with socket: {0}".format(self.bc_server_sock))
+            self.write("Sending with socket: {0}".format(self.bc_server_sock))
 
     def set_platform_socket_options(self):
         # Set socket to broadcasting mode
@@ -64,7 +142,7 @@ class BroadcastServer:
 
         if self.dscp > 0:
             self.tos = int(self.dscp) << 2
-            print(
+            self.write(
                 "Attempt to apply markings to broadcast server socket with DSCP ({0}) and TOS ({1})".format(
                     self.dscp, self.tos
                 )
@@ -80,76 +158,122 @@ class BroadcastServer:
             else:
                 raise ValueError("Invalid family %d" % self.family)
 
-        if platform.system() == "Windows":
+        if SYSTEM == "Windows":
             return
 
-        if platform.system() == "Linux":
+        if SYSTEM == "Linux":
             # Enable port reuse so we can run multiple clients and servers on single (host, port).
             self.bc_server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             return
 
-        if platform.system() == "Darwin":
+        if SYSTEM == "Darwin":
             # Enable port reuse so we can run multiple clients and servers on single (host, port).
             self.bc_server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             return
 
         raise ValueError(
-            "{0} does not appear to be a supported platform".format(platform.system())
+            "{0} does not appear to be a supported platform".format(SYSTEM)
+        )
+
+    def build_payload(self):
+        # resolve everything that does not change per packet once, up front
+        if self.debug:
+            origin = "broadcast from {0} ({1}) to {2}:{3}".format(
+                self.host,
+                socket.inet_ntoa(
+                    self.bc_server_sock.getsockopt(
+                        socket.IPPROTO_IP, socket.IP_MULTICAST_IF, 4
+                    )
+                ),
+                self.broadcast_address,
+                self.port,
+            )
+        else:
+            origin = "broadcast from {0} to {1}:{2}".format(
+                self.host, self.broadcast_address, self.port
+            )
+        return PayloadBuffer(
+            origin,
+            padding=self.padding,
+            payload=self.payload,
+            header=self.header,
+            stream_id=self.stream_id,
         )
 
     def broadcast(self):
-        counter = 0
+        step = self.sequence_step
+        sequence = self.sequence_start - step
+        packets = self.packets
+        burst = self.burst
+        size = self.packet.size
+        send = self.sender.send
+        pacer = self.pacer
+        verbose = self.verbose
+        counters, slot = self.counters or (None, 0)
+        write = self.write
+        reporter = self.reporter
+        time_ns = time.time_ns
+        stages = self.stages
+        traffic = self.traffic
+        clock = time.perf_counter_ns
+        guard = SendGuard.acquire(self.stop_event)
+        pacer.start()
+        report_at = reporter.start(time_ns())
+        if stages is not None:
+            stages.start()
         try:
             while not self.stop_event.is_set():
-                counter += 1
-                extra = ""
-                if self.padding:
-                    extra = " " * self.padding
-                now = datetime.now().strftime("%H:%M:%S.%f")[:-2]
-
-                if self.debug:
-                    payload_message = (
-                        "broadcast from {0} ({1}) to {2}:{3} message {4} at {5}".format(
-                            self.host,
-                            socket.inet_ntoa(
-                                self.bc_server_sock.getsockopt(
-                                    socket.IPPROTO_IP, socket.IP_MULTICAST_IF, 4
-                                )
-                            ),
-                            self.broadcast_address,
-                            self.port,
-                            counter,
-                            now,
+                if stages is not None:
+                    begin = clock()
+                if traffic is not None and not traffic.advance(pacer):
+                    break
+                pacer.wait()
+                if stages is not None:
+                    paced = clock()
+                now = time_ns()
+                for packet in packets:
+                    sequence += step
+                    packet.update(sequence, now)
+                if stages is not None:
+                    built = clock()
+                # a stop arriving from here on waits until the send is counted
+                guard.held = True
+                send()
+                if stages is not None:
+                    stages.lap(PACE, begin, paced, built, clock())
+                pacer.sent(size, burst)
+                if counters is not None:
+                    counters[slot] = pacer.packets
+                    counters[slot + 1] = pacer.bytes
+                guard.held = False
+                if report_at and now >= report_at:
+                    report_at = reporter.tick(pacer, now)
+                if not verbose:
+                    continue
+                if burst == 1:
+                    write(
+                        "Sending broadcast ({0} bytes) -> {1}".format(
+                            size, self.packet.message()
                         )
                     )
                 else:
-                    payload_message = (
-                        "broadcast from {0} to {1}:{2} message {3} at {4}".format(
-                            self.host, self.broadcast_address, self.port, counter, now
+                    write(
+                        "Sending broadcast burst of {0} ({1} bytes each) -> {2}".format(
+                            burst, size, self.packet.message()
                         )
                     )
-                if self.payload:
-                    payload = self.payload
-                else:
-                    payload = payload_message + "{0}".format(extra)
-                self.bc_server_sock.sendto(
-                    payload.encode(), (self.broadcast_address, self.port)
-                )
-                print(
-                    "Sending broadcast ({0} bytes) -> {1}".format(
-                        len(payload), payload_message
-                    )
-                )
-                time.sleep(self.interval)
+            if guard.deferred:
+                # stopped during a send: end the run as the signal would have
+                raise ServiceExit
         except socket.error as error:
             if "too long" in str(error).lower():
-                print(
+                self.write(
                     "Error: message with payload size of {0} bytes is too long to send.".format(
-                        len(payload)
+                        self.packet.size
                     )
                 )
             else:
-                print(
+                self.write(
                     "Error: {0} on interface for {1}".format(
                         error,
                         socket.inet_ntoa(
@@ -161,21 +285,68 @@ class BroadcastServer:
                 )
             raise ServiceExit
         finally:
+            guard.release()
             self.bc_server_sock.close()
+            if self.traffic is not None:
+                self.output.emit(
+                    self.pacer.summary_record(),
+                    self.pacer.summary(self.traffic.label()),
+                )
+                self.traffic.report(self.pacer, self.output.emit)
+            else:
+                self.output.emit(self.pacer.summary_record(), self.pacer.summary())
+            if self.stages is not None:
+                self.stages.emit(self.output.emit)
+            if self.burst > 1:
+                self.write(self.sender.summary())
 
 
 class BroadcastListener(threading.Thread):
-    def __init__(self, port, debug=False, host=None):
+    def __init__(
+        self,
+        port,
+        debug=False,
+        host=None,
+        verbose=True,
+        report_interval=0,
+        output=None,
+        capture=None,
+        stats_detail=False,
+        kernel_timestamps=True,
+        rcvbuf=0,
+        flows=False,
+        flow_idle=DEFAULT_IDLE,
+        soak=None,
+    ):
         threading.Thread.__init__(self)
         self.port = int(port)
         self.host = host
         self.debug = debug
         if not self.host:
-            self.host = socket.gethostbyname(socket.gethostname())
+            self.host = local_address()
         self.buffer_size = 10240
         self.horizontal_rule = 0
         self.stop_event = threading.Event()
         self.pyv = sys.version_info.major
+        self.streams = StreamTable()
+        # per-packet lines only when verbose; otherwise a summary line per
+        # report_interval seconds
+        self.verbose = verbose
+        self.report_interval = float(report_interval or 0)
+        self.output = output or PrintOutput()
+        self.write = self.output.write
+        self.reporter = ListenerReport(self.output.emit, self.streams)
+        self.packet_log = self.output.packet_log
+        # optional pcap.PcapWriter receiving a copy of every datagram
+        self.capture = capture
+        self.received = 0
+        self.received_bytes = 0
+        # per-stage timers of the receive loop with --stats-detail
+        self.stages = StageTimer("listener", RECEIVE_STAGES) if stats_detail else None
+        # per (source, source port, stream id) counters with --flows
+        self.flows = FlowTable(self.output.emit, flow_idle) if flows else None
+        # optional soak.SoakMonitor for --soak
+        self.soak = soak
 
         # Setup socket
         self.bc_client_sock = socket.socket(
@@ -191,50 +362,169 @@ class BroadcastListener(threading.Thread):
         self.bc_client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
         self.bc_client_sock.bind(("", self.port))
+        self.sockets = [self.bc_client_sock]
+
+        if rcvbuf:
+            self.write(
+                "Receive buffer: {0} bytes requested, {1} bytes effective".format(
+                    rcvbuf,
+                    set_buffer_size(self.bc_client_sock, socket.SO_RCVBUF, rcvbuf),
+                )
+            )
+        # on Linux take arrival times and socket drop counts from the kernel
+        self.kernel_timestamps = kernel_timestamps and enable_kernel_stamps(
+            self.bc_client_sock
+        )
+
+        self.receiver = ReceiveLoop(
+            self.sockets,
+            self.on_packet,
+            self.buffer_size,
+            control_size=KERNEL_CONTROL_SIZE if self.kernel_timestamps else 0,
+            on_tick=self.tick,
+            # a capture is flushed from tick(), interval reports or not
+            tick_interval=self.report_interval
+            or (capture.flush_ns / 1e9 if capture is not None else 0),
+            stages=self.stages,
+        )
 
         if self.pyv == 3:
-            print("Sending with socket: {0}".format(self.bc_client_sock))
+            self.write("Sending with socket: {0}".format(self.bc_client_sock))
 
     def set_platform_socket_options(self):
-        if platform.system() == "Windows":
+        if SYSTEM == "Windows":
             return
 
-        if platform.system() == "Linux":
+        if SYSTEM == "Linux":
             # Enable port reuse so we can run multiple clients and servers on single (host, port).
             self.bc_client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             return
 
-        if platform.system() == "Linux" or platform.system() == "Darwin":
+        if SYSTEM == "Linux" or SYSTEM == "Darwin":
             # Enable port reuse so we can run multiple clients and servers on single (host, port).
             self.bc_client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             return
 
         raise ValueError(
-            "{0} does not appear to be a supported platform".format(platform.system())
+            "{0} does not appear to be a supported platform".format(SYSTEM)
         )
 
     def start(self):
-        self.thread = threading.Thread(target=self.run)
-        self.thread.start()
+        threading.Thread.start(self)
+        self.announce()
+
+    def announce(self):
         header = "Listening for broadcasts on port {0}".format(self.port)
         self.horizontal_rule = "-" * len(header)
-        print(header)
-        print(self.horizontal_rule)
+        self.write(header)
+        self.write(self.horizontal_rule)
 
     def run(self):
-        while not self.stop_event.is_set():
-            try:
-                payload, address = self.bc_client_sock.recvfrom(self.buffer_size)
-                self.on_packet(payload, address)
-            except socket.error:
-                pass
-        self.bc_client_sock.close()
-
-    def on_packet(self, payload, address):
-        now = datetime.now().strftime("%H:%M:%S.%f")[:-2]
-        data = payload.decode()
-        print(
-            "Receiving ({0} bytes) time {1} from {2}:{3}:\n -> {4}\n".format(
-                len(data), now, address[0], address[1], data.strip()
+        try:
+            self.reporter.start()
+            self.receiver.run()
+        finally:
+            self.bc_client_sock.close()
+            self.report()
+
+    def tick(self):
+        if self.report_interval:
+            self.reporter.tick(
+                self.received, self.received_bytes, drops=self.kernel_drops()
+            )
+        if self.flows is not None:
+            self.flows.expire(time.time_ns())
+        if self.capture is not None:
+            self.capture.expire(time.time_ns())
+        if self.soak is not None:
+            self.soak.tick(time.time_ns(), self.streams.lost())
+
+    def kernel_drops(self):
+        # None unless the kernel reports socket drops
+        if not self.kernel_timestamps:
+            return None
+        return self.receiver.kernel_drops()
+
+    def report(self):
+        self.reporter.summary(
+            self.received, self.received_bytes, drops=self.kernel_drops()
+        )
+        if self.stages is not None:
+            self.stages.emit(self.output.emit)
+        if self.flows is not None:
+            self.flows.report()
+        if self.soak is not None:
+            self.soak.report(self.streams.lost())
+        for stats in self.streams:
+            stats.roll()
+            text = stats.summary()
+            latency = stats.latency_summary()
+            if latency:
+                text += "\n" + latency
+            self.output.emit(stats.summary_record(), text)
+
+    def stop(self):
+        self.stop_event.set()
+        self.receiver.stop()
+
+    def on_packet(self, view, nbytes, address):
+        # view is a receive ring slot holding nbytes of datagram
+        stages = self.stages
+        if stages is not None:
+            begin = time.perf_counter_ns()
+        self.received += 1
+        self.received_bytes += nbytes
+        arrival_ns = self.receiver.arrival_ns or time.time_ns()
+        header = parse_header(view, nbytes)
+        if stages is not None:
+            parsed = time.perf_counter_ns()
+        if self.capture is not None:
+            self.capture.write(
+                arrival_ns, view, nbytes, address, BROADCAST_KEY, self.port
+            )
+        packet_log = self.packet_log
+        if header:
+            stream_id, sequence, timestamp_ns, _length = header
+            stats = self.streams.record(stream_id, sequence, nbytes, timestamp_ns)
+            if timestamp_ns:
+                stats.record_transit(timestamp_ns, arrival_ns)
+            if packet_log is not None:
+                packet_log.log(
+                    arrival_ns, address, 0, stream_id, sequence, timestamp_ns, nbytes
+                )
+            if self.flows is not None:
+                self.flows.record(
+                    address, stream_id, sequence, nbytes, timestamp_ns, arrival_ns
+                )
+        else:
+            if packet_log is not None:
+                packet_log.log(arrival_ns, address, 0, None, None, None, nbytes)
+            if self.flows is not None:
+                self.flows.record(address, None, None, nbytes, 0, arrival_ns)
+        if self.soak is not None:
+            self.soak.record(
+                arrival_ns,
+                nbytes,
+                arrival_ns - header[2] if header and header[2] else None,
+            )
+        if stages is not None:
+            recorded = time.perf_counter_ns()
+            stages.lap(PARSE, begin, parsed, recorded)
+        if not self.verbose:
+            return
+        if header:
+            offset = HEADER_SIZE
+            label = " stream {0} seq {1}".format(stream_id, sequence)
+        else:
+            offset = 0
+            label = ""
+        # decode only for display
+        now = format_clock(arrival_ns)
+        data = bytes(view[offset:nbytes]).decode(errors="replace")
+        self.write(
+            "Receiving ({0} bytes) time {1} from {2}:{3}{4}:\n -> {5}\n".format(
+                nbytes, now, address[0], address[1], label, data.strip()
             )
         )
+        if stages is not None:
+            stages.add(REPORT, time.perf_counter_ns() - recorded)
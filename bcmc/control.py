@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+#
+# control.py: provide the TCP control channel between bcmc servers and clients
+#
+# messages are JSON objects, one per line:
+#   client -> server  {"type": "hello", "protocol": 1, "version": ..., "name": ...}
+#   server -> client  {"type": "params", ...} or {"type": "error", "message": ...}
+#   client -> server  {"type": "record", "record": {...}} per result record
+#   server -> client  {"type": "stop"} once the server has stopped sending
+#   client -> server  {"type": "bye"} after its final records
+
+# stdlib imports
+import json
+import queue
+import selectors
+import signal
+import socket
+import threading
+import time
+
+# app imports
+from .histogram import format_usec
+from .version import __version__
+
+CONTROL_PROTOCOL = 1
+
+# a peer sending a longer line than this is disconnected
+MAX_LINE = 1 << 20
+
+# result records clients forward to the server
+FORWARDED_ROLES = ("listener", "stream")
+
+# records a client holds for a server that does not keep up; further
+# records are dropped rather than stall the listener emitting them
+MAX_QUEUED = 4096
+
+
+class ControlError(Exception):
+    """
+    Exception raised when the control channel cannot be set up
+    """
+
+
+def encode(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+
+class RemoteReceiver:
+    # what the server knows about one connected client
+
+    __slots__ = (
+        "sock",
+        "address",
+        "name",
+        "buffer",
+        "outbox",
+        "registered",
+        "done",
+        "connected",
+        "summary",
+        "streams",
+    )
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.name = None
+        self.buffer = b""
+        self.outbox = b""
+        self.registered = False
+        self.done = False
+        self.connected = True
+        # final listener record and stream id -> final stream record
+        self.summary = None
+        self.streams = {}
+
+    def label(self):
+        return "{0} ({1}:{2})".format(self.name or "?", *self.address)
+
+
+class ControlServer(threading.Thread):
+    # accept receivers on a TCP port, hand them the test parameters and
+    # collect their interval and final records. one thread multiplexes all
+    # connections with a selector and is the only one touching them; the
+    # send loops are not involved beyond the records they emit anyway,
+    # seen through Output.observe()
+
+    def __init__(self, port, host=None, params=None, output=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = int(port)
+        self.params = dict(params or {}, type="params")
+        self.output = output
+        self.write = output.write
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # set by finish(): tell the receivers the test is over
+        self.stopping = threading.Event()
+        self.stop_sent = False
+        self.receivers = []
+        # packets the servers in this process sent, from their summaries
+        self.sent = 0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.listener.bind((host or "", self.port))
+        except OSError as error:
+            self.listener.close()
+            raise ControlError(
+                "cannot listen on control port {0}: {1}".format(self.port, error)
+            )
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def start(self):
+        threading.Thread.start(self)
+        self.write("Control channel listening on TCP port {0}".format(self.port))
+
+    def observe(self, record):
+        # Output observer: count what this process's servers sent
+        if record.get("type") == "summary" and record.get("role") == "server":
+            with self.lock:
+                self.sent += record.get("packets", 0)
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                for key, mask in self.selector.select(0.2):
+                    if key.fileobj is self.listener:
+                        self.accept()
+                        continue
+                    receiver = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.read(receiver)
+                    if mask & selectors.EVENT_WRITE and receiver.connected:
+                        self.flush(receiver)
+                if self.stopping.is_set() and not self.stop_sent:
+                    self.stop_sent = True
+                    for receiver in self.receivers:
+                        if receiver.registered:
+                            self.send(receiver, {"type": "stop"})
+        finally:
+            for receiver in self.receivers:
+                self.disconnect(receiver)
+            self.selector.close()
+            self.listener.close()
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receiver = RemoteReceiver(sock, address)
+        with self.lock:
+            self.receivers.append(receiver)
+        self.selector.register(sock, selectors.EVENT_READ, receiver)
+
+    def read(self, receiver):
+        try:
+            data = receiver.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.disconnect(receiver)
+            if receiver.registered and not receiver.done:
+                self.write("Receiver {0} disconnected".format(receiver.label()))
+            return
+        receiver.buffer += data
+        *lines, receiver.buffer = receiver.buffer.split(b"\n")
+        if len(receiver.buffer) > MAX_LINE:
+            self.disconnect(receiver)
+            return
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(message, dict):
+                self.handle(receiver, message)
+
+    def handle(self, receiver, message):
+        kind = message.get("type")
+        if kind == "hello":
+            if message.get("protocol") != CONTROL_PROTOCOL:
+                self.send(
+                    receiver,
+                    {
+                        "type": "error",
+                        "message": "server speaks control protocol {0} (bcmc {1})".format(
+                            CONTROL_PROTOCOL, __version__
+                        ),
+                    },
+                )
+                return
+            receiver.name = str(message.get("name", "?"))
+            receiver.registered = True
+            self.send(receiver, self.params)
+            if self.stop_sent:
+                self.send(receiver, {"type": "stop"})
+            self.write(
+                "Receiver {0} registered (bcmc {1})".format(
+                    receiver.label(), message.get("version", "?")
+                )
+            )
+        elif kind == "record":
+            self.record(receiver, message.get("record") or {})
+        elif kind == "bye":
+            receiver.done = True
+
+    def record(self, receiver, record):
+        role = record.get("role")
+        if record.get("type") == "summary":
+            if role == "listener":
+                receiver.summary = record
+            elif role == "stream":
+                receiver.streams[record.get("stream")] = record
+        elif record.get("type") == "interval" and role == "listener":
+            record = dict(record, role="receiver", client=receiver.label())
+            text = "[{0:7.2f}-{1:7.2f} s] receiver {2}: {3} packets {4:.1f} pps".format(
+                record.get("start", 0.0),
+                record.get("end", 0.0),
+                receiver.label(),
+                record.get("packets", 0),
+                record.get("pps", 0.0),
+            )
+            if record.get("kernel_drops") is not None:
+                text += " kernel drops {0}".format(record["kernel_drops"])
+            self.output.emit(record, text)
+
+    def send(self, receiver, message):
+        if not receiver.connected:
+            return
+        receiver.outbox += encode(message)
+        self.flush(receiver)
+
+    def flush(self, receiver):
+        # write what the socket takes now; the rest goes out when the
+        # selector reports it writable
+        try:
+            sent = receiver.sock.send(receiver.outbox)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.disconnect(receiver)
+            return
+        receiver.outbox = receiver.outbox[sent:]
+        events = selectors.EVENT_READ
+        if receiver.outbox:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(receiver.sock, events, receiver)
+        except (KeyError, ValueError):
+            pass
+
+    def disconnect(self, receiver):
+        if not receiver.connected:
+            return
+        receiver.connected = False
+        try:
+            self.selector.unregister(receiver.sock)
+        except (KeyError, ValueError):
+            pass
+        receiver.sock.close()
+
+    def registered(self):
+        with self.lock:
+            return sum(1 for receiver in self.receivers if receiver.registered)
+
+    def wait_for(self, count):
+        # block until count receivers have registered
+        self.write("Waiting for {0} receivers to register".format(count))
+        while self.registered() < count:
+            time.sleep(0.1)
+
+    def finish(self, timeout=5.0):
+        # tell every receiver the test is over, give them timeout seconds to
+        # send their final records, then print the fan-out report
+        with self.lock:
+            receivers = [r for r in self.receivers if r.registered and r.connected]
+        self.stopping.set()
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline and any(
+            receiver.connected and not receiver.done for receiver in receivers
+        ):
+            time.sleep(0.05)
+        self.stop_event.set()
+        self.join()
+        self.report()
+
+    def report(self):
+        # imported here: only a server with --control gets this far
+        import statistics
+
+        with self.lock:
+            receivers = [r for r in self.receivers if r.registered]
+            sent = self.sent
+        emit = self.output.emit
+        emit(
+            {
+                "type": "fanout",
+                "role": "server",
+                "receivers": len(receivers),
+                "packets": sent,
+            },
+            "Fan-out: {0} receivers, {1} packets sent".format(len(receivers), sent),
+        )
+        ratios = []
+        for receiver in receivers:
+            if receiver.summary is None:
+                self.write("  receiver {0}: no final report".format(receiver.label()))
+                continue
+            record = self.receiver_record(receiver)
+            if record.get("delivery_pct") is not None:
+                ratios.append(record["delivery_pct"])
+            text = "  receiver {0}: received {1}".format(
+                receiver.label(), record["packets"]
+            )
+            if record.get("delivery_pct") is not None:
+                text += " ({0:.2f}%)".format(record["delivery_pct"])
+            text += " lost {0}".format(record["lost"])
+            if record.get("kernel_drops") is not None:
+                text += " kernel drops {0}".format(record["kernel_drops"])
+            if record.get("jitter_us") is not None:
+                text += " jitter {0} delay p99 {1}".format(
+                    format_usec(record["jitter_us"]),
+                    format_usec(record["delay_p99_us"]),
+                )
+            emit(record, text)
+        if ratios:
+            below = sum(1 for ratio in ratios if ratio < 100.0)
+            self.write(
+                "Delivery min {0:.2f}% median {1:.2f}% max {2:.2f}%, {3} of {4} receivers missed packets".format(
+                    min(ratios),
+                    statistics.median(ratios),
+                    max(ratios),
+                    below,
+                    len(ratios),
+                )
+            )
+
+    @staticmethod
+    def receiver_record(receiver):
+        # delivery is measured against what the receiver's own sequence
+        # numbers say it should have seen, so one that registered after the
+        # test started is not charged with the packets sent before it joined
+        summary = receiver.summary
+        streams = list(receiver.streams.values())
+        received = sum(stream.get("packets", 0) for stream in streams)
+        lost = sum(stream.get("lost", 0) for stream in streams)
+        expected = received + lost
+        record = {
+            "type": "fanout",
+            "role": "receiver",
+            "client": receiver.label(),
+            "packets": summary.get("packets", 0),
+            "bytes": summary.get("bytes", 0),
+            "lost": lost,
+            "delivery_pct": (
+                round(100.0 * received / expected, 3) if expected else None
+            ),
+        }
+        if summary.get("kernel_drops") is not None:
+            record["kernel_drops"] = summary["kernel_drops"]
+        timed = [stream for stream in streams if stream.get("jitter_us") is not None]
+        if timed:
+            record["jitter_us"] = max(stream["jitter_us"] for stream in timed)
+            record["delay_p99_us"] = max(stream["delay_p99_us"] for stream in timed)
+        return record
+
+
+class ControlClient(threading.Thread):
+    # register with a server's control channel, take the test parameters
+    # from it, forward this process's listener records and stop when the
+    # server says the test is over
+
+    def __init__(self, host, port, output, timeout=5.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.output = output
+        self.write = output.write
+        self.lock = threading.Lock()
+        self.closed = False
+        # messages for the server, written by the sender thread; None ends it
+        self.outbox = queue.Queue(MAX_QUEUED)
+        self.dropped = 0
+        self.sender = threading.Thread(target=self.forward, daemon=True)
+        try:
+            self.sock = socket.create_connection((host, int(port)), timeout)
+        except OSError as error:
+            raise ControlError(
+                "cannot reach control channel {0}:{1}: {2}".format(host, port, error)
+            )
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        try:
+            self.send(
+                {
+                    "type": "hello",
+                    "protocol": CONTROL_PROTOCOL,
+                    "version": __version__,
+                    "name": socket.gethostname(),
+                }
+            )
+            message = self.receive()
+        except (OSError, ValueError) as error:
+            self.sock.close()
+            raise ControlError("control channel handshake failed: {0}".format(error))
+        if message.get("type") != "params":
+            self.sock.close()
+            raise ControlError(message.get("message", "server refused registration"))
+        self.params = message
+        self.sock.settimeout(None)
+
+    def receive(self):
+        line = self.file.readline(MAX_LINE)
+        if not line:
+            raise ValueError("connection closed")
+        return json.loads(line)
+
+    def start(self):
+        threading.Thread.start(self)
+        self.sender.start()
+
+    def send(self, message):
+        # only the handshake and then the sender thread write to the socket
+        self.sock.sendall(encode(message))
+
+    def observe(self, record):
+        # Output observer: queue listener results for the server. this runs
+        # on the listener's thread, so it never waits for the socket: when
+        # the server falls behind by MAX_QUEUED records, records are dropped
+        if record.get("role") not in FORWARDED_ROLES:
+            return
+        try:
+            self.outbox.put_nowait({"type": "record", "record": record})
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def forward(self):
+        # sender thread: write the queued messages until close() ends it
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                return
+            try:
+                self.send(message)
+            except OSError:
+                return
+
+    def run(self):
+        while True:
+            try:
+                message = self.receive()
+            except (OSError, ValueError):
+                message = None
+            if message is None or message.get("type") == "stop":
+                break
+        if not self.closed:
+            self.write(
+                "Server ended the test"
+                if message is not None
+                else "Control channel closed by the server"
+            )
+            # stop the same way Ctrl-C does
+            signal.raise_signal(signal.SIGINT)
+
+    def close(self, timeout=5.0):
+        # call after the listeners have written their final records; they
+        # and a bye get timeout seconds to reach the server
+        deadline = time.perf_counter() + timeout
+        try:
+            for message in ({"type": "bye"}, None):
+                self.outbox.put(
+                    message, timeout=max(0.0, deadline - time.perf_counter())
+                )
+        except queue.Full:
+            pass
+        self.sender.join(max(0.0, deadline - time.perf_counter()))
+        if self.dropped:
+            self.write(
+                "Control channel: {0} records not forwarded, the server fell behind".format(
+                    self.dropped
+                )
+            )
+        with self.lock:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
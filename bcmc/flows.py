@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# flows.py: provide the per-source flow table for bcmc listeners
+
+# stdlib imports
+from array import array
+
+# app imports
+from .histogram import format_usec
+from .report import STREAM_LINE_LIMIT
+from .stats import REORDER_WINDOW
+
+# flows tracked at most; beyond this, packets of new flows are only counted
+MAX_FLOWS = 65536
+
+# seconds without a packet after which a flow is reported and forgotten
+DEFAULT_IDLE = 30.0
+
+_WINDOW_MASK = (1 << REORDER_WINDOW) - 1
+
+_COUNTERS = (
+    "received",
+    "bytes",
+    "counted",
+    "duplicates",
+    "lost_before",
+)
+_MARKS = (
+    "first_sequence",
+    "highest",
+    "first_ns",
+    "last_ns",
+    "transit",
+)
+
+
+class FlowTable:
+    # delivery counters per (source address, source port, stream id), so
+    # many senders to one group and port are told apart. the counters live
+    # in flat arrays indexed by a slot number found through one dict per
+    # source address; the received address tuple is the key, so a packet of
+    # a known flow allocates nothing. flows idle for longer than idle
+    # seconds are reported and their slots reused, and at most max_flows
+    # are tracked at once
+
+    def __init__(self, emit, idle=DEFAULT_IDLE, max_flows=MAX_FLOWS):
+        # emit(record, text) is Output.emit or a stand-in
+        self.emit = emit
+        self.idle_ns = int(idle * 1e9)
+        self.max_flows = max_flows
+        # address -> {stream id -> slot}
+        self.index = {}
+        # slot -> (address, stream id), None when free
+        self.keys = []
+        self.free = []
+        for name in _COUNTERS:
+            setattr(self, name, array("Q"))
+        for name in _MARKS:
+            setattr(self, name, array("q"))
+        self.jitter = array("d")
+        # slot -> reorder window as in StreamStats: bit n set means sequence
+        # (highest - n) has been received
+        self.window = []
+        self.active = 0
+        self.evicted = 0
+        # packets of flows that found the table full
+        self.untracked = 0
+        # the next idle sweep, in arrival time
+        self.sweep_at = 0
+
+    def __len__(self):
+        return self.active
+
+    def record(self, address, stream_id, sequence, size, sent_ns, arrival_ns):
+        # account for one datagram; stream_id and sequence are None and
+        # sent_ns 0 without a bcmc header
+        streams = self.index.get(address)
+        slot = streams.get(stream_id) if streams is not None else None
+        if slot is None:
+            slot = self.add(address, stream_id, arrival_ns)
+            if slot is None:
+                self.untracked += 1
+                return
+        received = self.received
+        received[slot] += 1
+        self.bytes[slot] += size
+        self.last_ns[slot] = arrival_ns
+        if sequence is not None:
+            highest = self.highest[slot]
+            if highest < 0 or sequence + REORDER_WINDOW <= highest:
+                # the first sequence number, or the sender restarted
+                if highest >= 0:
+                    self.lost_before[slot] = self.lost(slot)
+                self.first_sequence[slot] = sequence
+                self.highest[slot] = sequence
+                self.counted[slot] = 1
+                self.window[slot] = 1
+            elif sequence > highest:
+                shift = sequence - highest
+                if shift >= REORDER_WINDOW:
+                    self.window[slot] = 1
+                else:
+                    window = self.window[slot] << shift
+                    self.window[slot] = (window | 1) & _WINDOW_MASK
+                self.highest[slot] = sequence
+                self.counted[slot] += 1
+            else:
+                bit = 1 << (highest - sequence)
+                if self.window[slot] & bit:
+                    self.duplicates[slot] += 1
+                else:
+                    self.window[slot] |= bit
+                    if sequence > self.first_sequence[slot]:
+                        # a late packet within the expected range; one from
+                        # before the first was never expected
+                        self.counted[slot] += 1
+        if sent_ns:
+            # RFC 3550 interarrival jitter, as in StreamStats
+            transit = arrival_ns - sent_ns
+            if received[slot] > 1:
+                variation = transit - self.transit[slot]
+                if variation < 0:
+                    variation = -variation
+                jitter = self.jitter
+                jitter[slot] += (variation - jitter[slot]) / 16.0
+            self.transit[slot] = transit
+        if arrival_ns >= self.sweep_at:
+            self.sweep(arrival_ns)
+
+    def add(self, address, stream_id, arrival_ns):
+        # a slot for a new flow, None when the table is full
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = (address, stream_id)
+            for name in _COUNTERS:
+                getattr(self, name)[slot] = 0
+        elif len(self.keys) < self.max_flows:
+            slot = len(self.keys)
+            self.keys.append((address, stream_id))
+            for name in _COUNTERS + _MARKS:
+                getattr(self, name).append(0)
+            self.jitter.append(0.0)
+            self.window.append(0)
+        else:
+            return None
+        self.highest[slot] = -1
+        self.transit[slot] = 0
+        self.first_ns[slot] = arrival_ns
+        self.jitter[slot] = 0.0
+        self.window[slot] = 0
+        self.index.setdefault(address, {})[stream_id] = slot
+        self.active += 1
+        if not self.sweep_at:
+            self.sweep_at = arrival_ns + self.idle_ns // 4
+        return slot
+
+    def expire(self, now_ns):
+        # sweep when due, for callers outside the packet path
+        if self.sweep_at and now_ns >= self.sweep_at:
+            self.sweep(now_ns)
+
+    def lost(self, slot):
+        # packets missing from the flow's sequence, over all restarts;
+        # duplicates are not counted, so they cannot hide a loss
+        lost = self.lost_before[slot]
+        if self.highest[slot] >= 0:
+            expected = self.highest[slot] - self.first_sequence[slot] + 1
+            lost += max(0, expected - self.counted[slot])
+        return lost
+
+    def sweep(self, now_ns):
+        # report and forget the flows idle for longer than the timeout
+        self.sweep_at = now_ns + self.idle_ns // 4
+        oldest = now_ns - self.idle_ns
+        expired = [
+            slot
+            for slot, key in enumerate(self.keys)
+            if key is not None and self.last_ns[slot] < oldest
+        ]
+        for slot in expired:
+            self.emit(self.record_of(slot, "expired"), None)
+            address, stream_id = self.keys[slot]
+            streams = self.index[address]
+            del streams[stream_id]
+            if not streams:
+                del self.index[address]
+            self.keys[slot] = None
+            self.free.append(slot)
+        if expired:
+            self.active -= len(expired)
+            self.evicted += len(expired)
+            self.emit(
+                {
+                    "type": "expired",
+                    "role": "flows",
+                    "flows": len(expired),
+                },
+                "flows: {0} idle for {1:g}s expired, {2} active".format(
+                    len(expired), self.idle_ns / 1e9, self.active
+                ),
+            )
+
+    def record_of(self, slot, kind="summary"):
+        (host, port), stream_id = self.keys[slot]
+        received = self.received[slot]
+        seconds = (self.last_ns[slot] - self.first_ns[slot]) / 1e9
+        lost = self.lost(slot)
+        expected = self.counted[slot] + lost if self.highest[slot] >= 0 else 0
+        record = {
+            "type": kind,
+            "role": "flow",
+            "source": "{0}:{1}".format(host, port),
+            "stream": stream_id,
+            "seconds": round(seconds, 6),
+            "packets": received,
+            "bytes": self.bytes[slot],
+            "pps": (received - 1) / seconds if seconds > 0 else 0.0,
+            "lost": lost,
+            "loss_pct": 100.0 * lost / expected if expected > 0 else 0.0,
+            "duplicates": self.duplicates[slot],
+        }
+        if stream_id is not None and received > 1:
+            record["jitter_us"] = round(self.jitter[slot] / 1000.0, 3)
+        return record
+
+    def report(self):
+        # a record per flow still tracked, printed for the first few, and
+        # the totals
+        slots = [slot for slot, key in enumerate(self.keys) if key is not None]
+        slots.sort(key=lambda slot: (self.keys[slot][0], self.keys[slot][1] or 0))
+        for slot in slots:
+            record = self.record_of(slot)
+            text = None
+            if len(slots) <= STREAM_LINE_LIMIT:
+                text = "flow {0}{1}: received {2} ({3} bytes) {4:.1f} pps lost {5} ({6:.2f}%)".format(
+                    record["source"],
+                    (
+                        ""
+                        if record["stream"] is None
+                        else " stream {0}".format(record["stream"])
+                    ),
+                    record["packets"],
+                    record["bytes"],
+                    record["pps"],
+                    record["lost"],
+                    record["loss_pct"],
+                )
+                if "jitter_us" in record:
+                    text += " jitter {0}".format(format_usec(record["jitter_us"]))
+            self.emit(record, text)
+        text = "flows: {0} active from {1} sources, {2} expired".format(
+            len(slots), len(self.index), self.evicted
+        )
+        if self.untracked:
+            text += (
+                ", {0} packets of further flows not tracked (table full at {1})".format(
+                    self.untracked, self.max_flows
+                )
+            )
+        self.emit(
+            {
+                "type": "summary",
+                "role": "flows",
+                "flows": len(slots),
+                "packets": self.untracked,
+            },
+            text,
+        )
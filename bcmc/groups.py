@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# groups.py: provide multicast group lists, socket sharding and counters
+
+# stdlib imports
+import socket
+import struct
+from array import array
+
+# app imports
+from .helpers import SYSTEM
+
+# refuse to expand lists beyond this many groups
+MAX_GROUPS = 65536
+
+# ipaddress is imported only once groups are given, it takes a few ms
+_MULTICAST = "224.0.0.0/4"
+
+
+def _multicast(text):
+    import ipaddress
+
+    address = ipaddress.IPv4Address(text)
+    if address not in ipaddress.ip_network(_MULTICAST):
+        raise ValueError("{0} is not a multicast address".format(text))
+    return address
+
+
+def expand_groups(value):
+    # expand "239.0.0.2", "239.1.0.0/20", "239.1.0.1-239.1.0.50" and comma
+    # separated mixes of those into a list of unique group addresses
+    import ipaddress
+
+    multicast = ipaddress.ip_network(_MULTICAST)
+    groups = []
+    seen = set()
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "/" in item:
+            network = ipaddress.IPv4Network(item, strict=False)
+            if not network.subnet_of(multicast):
+                raise ValueError("{0} is not a multicast range".format(item))
+            first, last = network.network_address, network.broadcast_address
+        elif "-" in item:
+            first, last = (_multicast(part.strip()) for part in item.split("-", 1))
+            if last < first:
+                raise ValueError("{0} is an empty range".format(item))
+        else:
+            first = last = _multicast(item)
+        if int(last) - int(first) + len(groups) >= MAX_GROUPS:
+            raise ValueError("more than {0} groups requested".format(MAX_GROUPS))
+        for number in range(int(first), int(last) + 1):
+            if number not in seen:
+                seen.add(number)
+                groups.append(str(ipaddress.IPv4Address(number)))
+    if not groups:
+        raise ValueError("no groups given")
+    return groups
+
+
+def max_memberships():
+    # number of groups one socket may join before the kernel refuses
+    if SYSTEM == "Linux":
+        try:
+            with open("/proc/sys/net/ipv4/igmp_max_memberships") as limit:
+                return max(1, int(limit.read()))
+        except (OSError, ValueError):
+            return 20
+    if SYSTEM == "Darwin":
+        # IP_MAX_MEMBERSHIPS in <netinet/in.h>
+        return 4095
+    return 20
+
+
+def shard(groups, size):
+    # split groups into consecutive chunks of at most size
+    return [groups[start : start + size] for start in range(0, len(groups), size)]
+
+
+def group_key(group):
+    # the group address as read from IP_PKTINFO: raw network order bytes
+    # interpreted in native byte order
+    return struct.unpack("=I", socket.inet_aton(group))[0]
+
+
+class GroupTable:
+    # per-group packet and byte counters in flat arrays indexed through a
+    # single dict, instead of one Python object per group
+
+    def __init__(self, groups):
+        self.groups = list(groups)
+        self.index = {group_key(group): i for i, group in enumerate(self.groups)}
+        self.packets = array("Q", bytes(8 * len(self.groups)))
+        self.bytes = array("Q", bytes(8 * len(self.groups)))
+        # datagrams whose destination could not be matched to a group
+        self.unmatched = 0
+
+    def record(self, key, size):
+        index = self.index.get(key)
+        if index is None:
+            self.unmatched += 1
+            return
+        self.packets[index] += 1
+        self.bytes[index] += size
+
+    def memory(self):
+        # approximate bytes held by the counter arrays
+        return self.packets.itemsize * len(self.packets) + self.bytes.itemsize * len(
+            self.bytes
+        )
+
+    def active(self):
+        return sum(1 for packets in self.packets if packets)
+
+    def summary(self, limit=16):
+        return [line for _record, line in self.records(limit)]
+
+    def records(self, limit=16):
+        # (result record, text line) pairs; per group up to limit groups,
+        # totals beyond that
+        records = []
+        if len(self.groups) <= limit:
+            for i, group in enumerate(self.groups):
+                records.append(
+                    (
+                        {
+                            "type": "summary",
+                            "role": "group",
+                            "group": group,
+                            "packets": self.packets[i],
+                            "bytes": self.bytes[i],
+                        },
+                        "group {0}: received {1} ({2} bytes)".format(
+                            group, self.packets[i], self.bytes[i]
+                        ),
+                    )
+                )
+        else:
+            record = {
+                "type": "summary",
+                "role": "groups",
+                "packets": sum(self.packets),
+                "bytes": sum(self.bytes),
+            }
+            records.append(
+                (
+                    record,
+                    "groups: {0} of {1} received traffic, {2} packets ({3} bytes)".format(
+                        self.active(),
+                        len(self.groups),
+                        record["packets"],
+                        record["bytes"],
+                    ),
+                )
+            )
+        if self.unmatched:
+            records.append(
+                (
+                    {"type": "summary", "role": "unmatched", "packets": self.unmatched},
+                    "unmatched destination: {0} packets".format(self.unmatched),
+                )
+            )
+        return records
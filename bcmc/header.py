@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# header.py: provide the binary sequence header for bcmc payloads
+
+# stdlib imports
+import struct
+
+# fixed-offset header written by the servers in front of the payload:
+#
+#   magic        2s  b"bc"
+#   version      B   header version
+#   flags        B   reserved, 0
+#   stream id    I   identifies the sending stream
+#   sequence     Q   starts at 1 and increments per packet
+#   timestamp    Q   send time in nanoseconds since the epoch
+#   length       I   number of payload bytes following the header
+HEADER = struct.Struct("!2sBBIQQI")
+HEADER_SIZE = HEADER.size
+HEADER_MAGIC = b"bc"
+HEADER_VERSION = 1
+
+# offsets of the fields patched per packet by the servers
+SEQUENCE_OFFSET = 8
+TIMESTAMP_OFFSET = 16
+SEQUENCE_TIMESTAMP = struct.Struct("!QQ")
+
+_unpack_from = HEADER.unpack_from
+
+
+def pack_header_into(buffer, offset, stream_id, sequence, timestamp_ns, length):
+    # write a complete header into buffer at offset
+    HEADER.pack_into(
+        buffer,
+        offset,
+        HEADER_MAGIC,
+        HEADER_VERSION,
+        0,
+        stream_id,
+        sequence,
+        timestamp_ns,
+        length,
+    )
+
+
+def parse_header(data, size=None):
+    # return (stream_id, sequence, timestamp_ns, length) or None when the
+    # datagram does not start with a bcmc header; size is the datagram
+    # length when data is a larger receive buffer
+    if (len(data) if size is None else size) < HEADER_SIZE:
+        return None
+    magic, version, _flags, stream_id, sequence, timestamp_ns, length = _unpack_from(
+        data
+    )
+    if magic != HEADER_MAGIC or version != HEADER_VERSION:
+        return None
+    return stream_id, sequence, timestamp_ns, length
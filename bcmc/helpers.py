@@ -2,8 +2,226 @@
 #
 # helpers.py: helper functions for bcmc
 
+# stdlib imports
+import functools
+import json
+import math
+import socket
+import struct
+import sys
+import threading
+import time
+
+# app imports
+from .mmsg import SO_RCVBUFFORCE, SO_SNDBUFFORCE
+
+try:
+    import fcntl
+    import resource
+except ImportError:
+    # not available on Windows
+    fcntl = None  # type: ignore[assignment]
+    resource = None  # type: ignore[assignment]
+
+# what platform.system() returns, without importing platform (and the
+# milliseconds that takes at start-up)
+SYSTEM = {"linux": "Linux", "darwin": "Darwin", "win32": "Windows"}.get(
+    sys.platform, sys.platform
+)
+
+# TCP port of the control channel (control.py), here so that setting up
+# the command line does not import it
+DEFAULT_CONTROL_PORT = 2003
+
+# ioctl reading an interface's IPv4 address, see <linux/sockios.h>
+SIOCGIFADDR = 0x8915
+
+# an address of TEST-NET-1 (RFC 5737): routed like any remote host, never
+# answered
+_ROUTE_PROBE = ("192.0.2.1", 9)
+
 
 class ServiceExit(Exception):
     """
     Exception to trigger clean exit of running threads
     """
+
+
+class SendGuard:
+    # keeps a stop request from landing between a send and its accounting.
+    # a send loop sets held around the two; a SIGINT or SIGTERM arriving
+    # meanwhile only sets the loop's stop event, and the loop raises
+    # ServiceExit itself when it finds deferred set. outside held the signal handler
+    # raises ServiceExit at once, as everywhere else. signal handlers run on
+    # the main thread only, so only a loop there uses the shared guard
+
+    __slots__ = ("held", "stop_event", "deferred")
+
+    def __init__(self):
+        self.held = False
+        self.stop_event = None
+        self.deferred = False
+
+    @classmethod
+    def acquire(cls, stop_event):
+        # the guard for a send loop on the calling thread
+        guard = send_guard
+        if threading.current_thread() is not threading.main_thread():
+            guard = cls()
+        guard.held = False
+        guard.stop_event = stop_event
+        guard.deferred = False
+        return guard
+
+    def release(self):
+        # the loop is done, whichever way it ended
+        self.held = False
+        self.stop_event = None
+
+    def defer(self):
+        # from the signal handler: True if the stop was left to the loop
+        if not self.held or self.stop_event is None:
+            return False
+        self.deferred = True
+        self.stop_event.set()
+        return True
+
+
+# the guard of the send loop running on the main thread, if any
+send_guard = SendGuard()
+
+
+def max_rss():
+    # peak resident set size of this process in bytes, None if unknown
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def set_buffer_size(sock, option, size):
+    # set SO_RCVBUF or SO_SNDBUF and return the size the kernel granted.
+    # Linux reports twice the request (the rest is bookkeeping) and caps it
+    # at net.core.rmem_max/wmem_max unless the FORCE variant is permitted
+    sock.setsockopt(socket.SOL_SOCKET, option, size)
+    effective = sock.getsockopt(socket.SOL_SOCKET, option)
+    if effective < size and SYSTEM == "Linux":
+        force = SO_RCVBUFFORCE if option == socket.SO_RCVBUF else SO_SNDBUFFORCE
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, force, size)
+            effective = sock.getsockopt(socket.SOL_SOCKET, option)
+        except OSError:
+            # needs CAP_NET_ADMIN
+            pass
+    return effective
+
+
+_SCALE = {"k": 1e3, "m": 1e6, "g": 1e9}
+
+
+def quantity(value, name, minimum=0.0):
+    # a number from a config file, as a number or a string like 2.5k or
+    # 1kpps; raises ValueError naming the field
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text.endswith("pps"):
+            text = text[:-3].strip()
+        scale = 1.0
+        if text and text[-1] in _SCALE:
+            scale = _SCALE[text[-1]]
+            text = text[:-1]
+        try:
+            value = float(text) * scale
+        except ValueError:
+            raise ValueError("{0} must be a number, not {1!r}".format(name, value))
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("{0} must be a number, not {1!r}".format(name, value))
+    if not math.isfinite(value) or value < minimum:
+        raise ValueError("{0} must be at least {1:g}".format(name, minimum))
+    return float(value)
+
+
+def load_config(path):
+    # the top-level table of a .json or .toml (Python 3.11+ or tomli) file
+    with open(path, "rb") as source:
+        data = source.read()
+    if path.endswith(".toml"):
+        try:
+            import tomllib  # type: ignore[import-not-found, unused-ignore]
+        except ImportError:
+            try:
+                import tomli as tomllib  # type: ignore[import-not-found, no-redef]
+            except ImportError:
+                raise ValueError(
+                    "TOML files need Python 3.11+ or the tomli package; use JSON instead"
+                )
+        config = tomllib.loads(data.decode())
+    else:
+        config = json.loads(data)
+    if not isinstance(config, dict):
+        raise ValueError("{0} does not hold a table/object".format(path))
+    return config
+
+
+def interface_addresses():
+    # {interface name: IPv4 address} of the local interfaces that have one,
+    # read from the kernel (Linux only; empty elsewhere)
+    if SYSTEM != "Linux" or fcntl is None:
+        return {}
+    addresses = {}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _index, name in socket.if_nameindex():
+            try:
+                request = fcntl.ioctl(
+                    sock.fileno(), SIOCGIFADDR, struct.pack("256s", name.encode()[:15])
+                )
+            except OSError:
+                # no IPv4 address on this interface
+                continue
+            addresses[name] = socket.inet_ntoa(request[20:24])
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    return addresses
+
+
+@functools.lru_cache(maxsize=None)
+def local_address():
+    # the IPv4 address of this host's main interface, found without DNS:
+    # socket.gethostbyname(socket.gethostname()) blocks for seconds where
+    # the resolver is broken. connecting a UDP socket only looks up the
+    # route and sends nothing; without a default route the first
+    # non-loopback interface address is taken. looked up once per process
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(_ROUTE_PROBE)
+        address = sock.getsockname()[0]
+        if address != "0.0.0.0":
+            return address
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    for name, address in interface_addresses().items():
+        if not address.startswith("127."):
+            return address
+    return "127.0.0.1"
+
+
+def format_clock(ns):
+    # HH:MM:SS.ffff local time of a time_ns() value for per-packet lines,
+    # without importing datetime
+    seconds, nanos = divmod(ns, 1000000000)
+    return "{0}.{1:04d}".format(
+        time.strftime("%H:%M:%S", time.localtime(seconds)), nanos // 100000
+    )
+
+
+def format_rss():
+    rss = max_rss()
+    if rss is None:
+        return "unknown"
+    return "{0:.1f} MiB".format(rss / (1024 * 1024))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# histogram.py: provide fixed-memory log-bucketed latency histograms
+
+# stdlib imports
+from array import array
+
+# percentiles shown in latency summaries
+PERCENTILES = (50.0, 99.0, 99.9)
+
+
+class LogHistogram:
+    # HDR-style histogram of non-negative integers. values below
+    # 2 ** significant_bits get a bucket each; above that every power of two
+    # range is split into 2 ** (significant_bits - 1) equal buckets, so a
+    # recorded value is off by less than 1 / 2 ** (significant_bits - 1) of
+    # itself. the bucket array is allocated once; record() only does integer
+    # arithmetic and one array increment
+
+    __slots__ = (
+        "significant_bits",
+        "sub_buckets",
+        "half",
+        "highest",
+        "counts",
+        "zero",
+        "count",
+        "total",
+        "min",
+        "max",
+    )
+
+    def __init__(self, significant_bits=6, highest=(1 << 30) - 1):
+        # highest is the largest trackable value; larger ones are clamped
+        self.significant_bits = significant_bits
+        self.sub_buckets = 1 << significant_bits
+        self.half = significant_bits - 1
+        self.highest = highest
+        self.counts = array("Q", bytes(8 * (self.index(highest) + 1)))
+        # kept around so reset() can clear the counts without allocating
+        self.zero = array("Q", bytes(8 * len(self.counts)))
+        self.count = 0
+        self.total = 0
+        self.min = highest
+        self.max = 0
+
+    def index(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.significant_bits
+        return (shift << self.half) + (value >> shift)
+
+    def value_at(self, index):
+        # highest value that lands in bucket index
+        if index < self.sub_buckets:
+            return index
+        shift = (index >> self.half) - 1
+        mantissa = index - (shift << self.half)
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        elif value > self.highest:
+            value = self.highest
+        if value < self.sub_buckets:
+            self.counts[value] += 1
+        else:
+            shift = value.bit_length() - self.significant_bits
+            self.counts[(shift << self.half) + (value >> shift)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value < self.min:
+            self.min = value
+
+    def add(self, other):
+        # fold another histogram with the same layout into this one
+        if not other.count:
+            return
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+        if other.min < self.min:
+            self.min = other.min
+
+    def reset(self):
+        self.counts[:] = self.zero
+        self.count = 0
+        self.total = 0
+        self.min = self.highest
+        self.max = 0
+
+    def percentile(self, percent):
+        # smallest bucket value at or below which percent of the values are
+        if not self.count:
+            return 0
+        target = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count:
+                seen += count
+                if seen >= target:
+                    return min(self.value_at(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+def format_usec(usec):
+    if usec >= 1000000:
+        return "{0:.2f} s".format(usec / 1000000.0)
+    if usec >= 1000:
+        return "{0:.2f} ms".format(usec / 1000.0)
+    return "{0:.0f} us".format(usec)
+
+
+def format_percentiles(histogram):
+    # "p50 120 us p99 340 us p99.9 900 us max 1.20 ms"
+    parts = [
+        "p{0:g} {1}".format(percent, format_usec(histogram.percentile(percent)))
+        for percent in PERCENTILES
+    ]
+    parts.append("max {0}".format(format_usec(histogram.max)))
+    return " ".join(parts)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+# metrics.py: provide the Prometheus metrics endpoint for bcmc
+
+# stdlib imports
+import bisect
+import itertools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# app imports
+from .histogram import PERCENTILES
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name, type and help of every metric family, in exposition order
+FAMILIES = (
+    ("bcmc_sent_packets_total", "counter", "Packets sent by a server."),
+    ("bcmc_sent_bytes_total", "counter", "Payload bytes sent by a server."),
+    ("bcmc_target_pps", "gauge", "Packet rate a server is paced to, 0 if unpaced."),
+    (
+        "bcmc_pacing_lag_seconds",
+        "gauge",
+        "How far a server's next send is behind its deadline; negative while ahead.",
+    ),
+    ("bcmc_received_packets_total", "counter", "Packets received by a listener."),
+    ("bcmc_received_bytes_total", "counter", "Bytes received by a listener."),
+    (
+        "bcmc_kernel_drops_total",
+        "counter",
+        "Datagrams the kernel dropped from a listener's full socket queues.",
+    ),
+    ("bcmc_stream_packets_total", "counter", "Packets of a stream."),
+    ("bcmc_stream_bytes_total", "counter", "Bytes of a stream."),
+    (
+        "bcmc_stream_lost",
+        "gauge",
+        "Packets missing from a stream's sequence; goes down when a late packet fills a gap.",
+    ),
+    ("bcmc_stream_duplicates_total", "counter", "Duplicate packets of a stream."),
+    (
+        "bcmc_stream_out_of_order_total",
+        "counter",
+        "Late packets that filled a gap in a stream.",
+    ),
+    (
+        "bcmc_stream_jitter_seconds",
+        "gauge",
+        "RFC 3550 interarrival jitter of a stream.",
+    ),
+    (
+        "bcmc_stream_delay_seconds",
+        "summary",
+        "One-way delay of a stream up to the last report interval.",
+    ),
+    ("bcmc_scrape_duration_seconds", "gauge", "Time taken to render this page."),
+)
+
+
+def _labels(labels):
+    return ",".join(
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+def quantiles(histogram, percents=PERCENTILES):
+    # percentiles of a LogHistogram with the bucket walk done in C, so a
+    # scrape of thousands of streams holds the interpreter only briefly
+    counts = histogram.counts
+    total = histogram.count
+    cumulative = list(itertools.accumulate(counts))
+    values = []
+    for percent in percents:
+        target = max(1, int(total * percent / 100.0 + 0.5))
+        index = bisect.bisect_left(cumulative, target)
+        values.append(min(histogram.value_at(index), histogram.max))
+    return values
+
+
+class MetricsServer:
+    # serve the live counters of the servers and listeners of this process
+    # at http://host:port/metrics in the Prometheus text format. nothing is
+    # added to the send and receive loops: a scrape reads the counters they
+    # already keep. each read is of a single int or float, or a C-level copy
+    # of a dict or array, which the GIL makes atomic, so the hot loops never
+    # wait on a lock; values of one scrape may be a packet apart
+
+    def __init__(self, port, host="127.0.0.1"):
+        self.host = host
+        self.port = port
+        self.servers = []
+        self.listeners = []
+        self.stream_servers = []
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def _handler(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes would flood the console
+                pass
+
+        return Handler
+
+    def add_server(self, server, kind):
+        self.servers.append((server, kind))
+
+    def add_listener(self, listener, kind):
+        self.listeners.append((listener, kind))
+
+    def add_streams(self, streams):
+        self.stream_servers.append(streams)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def render(self):
+        started = time.perf_counter()
+        samples = {name: [] for name, _kind, _help in FAMILIES}
+        for server, kind in self.servers:
+            self.collect_server(samples, server, kind)
+        for streams in self.stream_servers:
+            self.collect_streams(samples, streams)
+        for listener, kind in self.listeners:
+            self.collect_listener(samples, listener, kind)
+        samples["bcmc_scrape_duration_seconds"].append(
+            ("", (), time.perf_counter() - started)
+        )
+        lines = []
+        for name, kind, text in FAMILIES:
+            if not samples[name]:
+                continue
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for suffix, labels, value in samples[name]:
+                if labels:
+                    lines.append(
+                        "{0}{1}{{{2}}} {3}".format(name, suffix, _labels(labels), value)
+                    )
+                else:
+                    lines.append("{0}{1} {2}".format(name, suffix, value))
+        lines.append("")
+        return "\n".join(lines)
+
+    def collect_server(self, samples, server, kind):
+        pacer = server.pacer
+        labels = (("role", "server"), ("kind", kind), ("stream", server.stream_id))
+        samples["bcmc_sent_packets_total"].append(("", labels, pacer.packets))
+        samples["bcmc_sent_bytes_total"].append(("", labels, pacer.bytes))
+        samples["bcmc_target_pps"].append(("", labels, pacer.rate or 0))
+        deadline = pacer.deadline
+        if deadline is not None:
+            samples["bcmc_pacing_lag_seconds"].append(
+                ("", labels, time.perf_counter() - deadline)
+            )
+
+    def collect_streams(self, samples, streams):
+        sent = streams.sent.tolist()
+        for index, packets in enumerate(sent):
+            host, port = streams.destinations[index]
+            labels = (
+                ("role", "server"),
+                ("kind", streams.kinds[index]),
+                ("stream", streams.ids[index]),
+                ("group", "{0}:{1}".format(host, port)),
+            )
+            samples["bcmc_sent_packets_total"].append(("", labels, packets))
+            samples["bcmc_sent_bytes_total"].append(
+                ("", labels, packets * streams.sizes[index])
+            )
+            samples["bcmc_target_pps"].append(
+                ("", labels, 1.0 / streams.periods[index])
+            )
+
+    def collect_listener(self, samples, listener, kind):
+        labels = (("role", "listener"), ("kind", kind))
+        samples["bcmc_received_packets_total"].append(("", labels, listener.received))
+        samples["bcmc_received_bytes_total"].append(
+            ("", labels, listener.received_bytes)
+        )
+        drops = listener.kernel_drops()
+        if drops is not None:
+            samples["bcmc_kernel_drops_total"].append(("", labels, drops))
+        for stats in list(listener.streams.streams.values()):
+            stream = labels + (("stream", stats.stream_id),)
+            samples["bcmc_stream_packets_total"].append(("", stream, stats.received))
+            samples["bcmc_stream_bytes_total"].append(("", stream, stats.bytes))
+            samples["bcmc_stream_lost"].append(("", stream, stats.lost))
+            samples["bcmc_stream_duplicates_total"].append(
+                ("", stream, stats.duplicates)
+            )
+            samples["bcmc_stream_out_of_order_total"].append(
+                ("", stream, stats.out_of_order)
+            )
+            delay = stats.delay_total
+            if not delay.count:
+                continue
+            samples["bcmc_stream_jitter_seconds"].append(
+                ("", stream, stats.jitter / 1e9)
+            )
+            family = samples["bcmc_stream_delay_seconds"]
+            for percent, value in zip(PERCENTILES, quantiles(delay)):
+                family.append(
+                    (
+                        "",
+                        stream + (("quantile", "{0:g}".format(percent / 100.0)),),
+                        value / 1e6,
+                    )
+                )
+            family.append(("_sum", stream, delay.total / 1e6))
+            family.append(("_count", stream, delay.count))
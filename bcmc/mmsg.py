@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# mmsg.py: provide ctypes bindings for the Linux sendmmsg/recvmmsg syscalls
+
+# stdlib imports
+import ctypes
+import struct
+import sys
+
+# recvmmsg()/sendmmsg() flag, see <sys/socket.h>
+MSG_DONTWAIT = 0x40
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load(name, argtypes):
+    # return the libc function or None when the platform does not have it.
+    # the interpreter is linked against libc, so its own symbol table has
+    # the function; ctypes.util.find_library would run ldconfig at start-up
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+
+sendmmsg = _load(
+    "sendmmsg",
+    [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int],
+)
+recvmmsg = _load(
+    "recvmmsg",
+    [
+        ctypes.c_int,
+        ctypes.POINTER(MMsgHdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+        ctypes.c_void_p,
+    ],
+)
+
+# Linux socket options the socket module does not export, see <linux/in.h>
+IP_PKTINFO = 8
+IP_MULTICAST_ALL = 49
+
+# and <asm-generic/socket.h>: kernel receive timestamps (struct timespec) and
+# the socket's receive queue drop count (uint32) as ancillary data, and the
+# buffer size options that may exceed net.core.rmem_max/wmem_max
+SO_TIMESTAMPNS = 35
+SO_RXQ_OVFL = 40
+SO_SNDBUFFORCE = 32
+SO_RCVBUFFORCE = 33
+
+# struct cmsghdr is { size_t cmsg_len; int cmsg_level; int cmsg_type; }
+CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+CMSGHDR = struct.Struct("=" + ("Q" if CMSG_ALIGN == 8 else "I") + "ii")
@@ -3,16 +3,34 @@
 # multicast.py: provide multicast class for bcmc
 
 # stdlib imports
-import platform
 import socket
 import struct
 import sys
 import threading
 import time
-from datetime import datetime
 
 # app imports
-from .helpers import ServiceExit
+from .batch import BatchSender
+from .flows import DEFAULT_IDLE, FlowTable
+from .groups import GroupTable, group_key, max_memberships, shard
+from .header import HEADER_SIZE, parse_header
+from .helpers import (
+    SYSTEM,
+    SendGuard,
+    ServiceExit,
+    format_clock,
+    format_rss,
+    local_address,
+    set_buffer_size,
+)
+from .mmsg import IP_MULTICAST_ALL, IP_PKTINFO
+from .output import PrintOutput
+from .pacer import Pacer
+from .payload import PayloadBuffer
+from .receiver import KERNEL_CONTROL_SIZE, ReceiveLoop, enable_kernel_stamps
+from .report import ListenerReport, ServerReport
+from .stages import PACE, PARSE, RECEIVE_STAGES, REPORT, SEND_STAGES, StageTimer
+from .stats import StreamTable
 
 
 class MulticastServer:
@@ -28,8 +46,25 @@ class MulticastServer:
         family=socket.AF_INET,
         host=None,
         payload=None,
+        header=False,
+        stream_id=0,
+        rate=None,
+        bandwidth=None,
+        burst=1,
+        sequence_start=1,
+        sequence_step=1,
+        verbose=True,
+        counters=None,
+        report_interval=0,
+        output=None,
+        stats_detail=False,
+        sndbuf=0,
+        traffic=None,
     ):
-        self.group = group
+        # group is a single address or a list sent to round robin, one
+        # stream id per group counting up from stream_id
+        self.groups = [group] if isinstance(group, str) else list(group)
+        self.group = self.groups[0]
         self.port = int(port)
         self.padding = int(padding)
         self.interval = float(interval)
@@ -42,6 +77,36 @@ class MulticastServer:
         self.hostname = socket.gethostname()
         self.pyv = sys.version_info.major
         self.payload = payload
+        self.header = header
+        self.stream_id = int(stream_id)
+        self.pacer = Pacer.from_args(self.interval, rate, bandwidth)
+        self.burst = max(1, int(burst))
+        # workers interleave one sequence space with start/step
+        self.sequence_start = int(sequence_start)
+        self.sequence_step = int(sequence_step)
+        self.verbose = verbose
+        # optional (memoryview, slot) that packet and byte totals are
+        # published to, see workers.py
+        self.counters = counters
+        # text and result records go through an output.Output when given
+        self.output = output or PrintOutput()
+        self.write = self.output.write
+        self.reporter = ServerReport(self.output.emit, float(report_interval or 0))
+        # per-stage timers of the send loop with --stats-detail
+        self.stages = StageTimer("server", SEND_STAGES) if stats_detail else None
+        # a scripted traffic profile (see traffic.py) sets every deadline
+        self.traffic = None
+        if traffic is not None:
+            from .traffic import TrafficSchedule
+
+            self.traffic = TrafficSchedule(traffic, self.burst)
+            self.write(
+                "Traffic profile: {0} phases, {1} deadlines precomputed in {2:.1f} ms".format(
+                    len(self.traffic.phases),
+                    len(self.traffic),
+                    self.traffic.build_time * 1000,
+                )
+            )
 
         self.multicast_group = (self.group, self.port)
 
@@ -58,16 +123,47 @@ class MulticastServer:
 
         self.set_platform_socket_options()
 
+        if sndbuf:
+            self.write(
+                "Send buffer: {0} bytes requested, {1} bytes effective".format(
+                    sndbuf,
+                    set_buffer_size(self.mc_server_sock, socket.SO_SNDBUF, sndbuf),
+                )
+            )
+
+        # one preallocated buffer per packet of a burst, per group
+        self.targets = []
+        for index, group in enumerate(self.groups):
+            packets = [
+                self.build_payload(group, self.stream_id + index)
+                for _ in range(self.burst)
+            ]
+            sender = BatchSender(
+                self.mc_server_sock,
+                (group, self.port),
+                [packet.buffer for packet in packets],
+            )
+            self.targets.append((packets, sender))
+        self.packets, self.sender = self.targets[0]
+        self.packet = self.packets[0]
+
         if self.pyv == 3:
-            print("Sending with socket: {0}".format(self.mc_server_sock))
+            self.write("Sending with socket: {0}".format(self.mc_server_sock))
 
     def set_platform_socket_options(self):
         ttl = struct.pack("b", self.ttl)
         self.mc_server_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
 
+        if self.host:
+            # send out of the interface that owns this address instead of
+            # the one the routing table picks for the group
+            self.mc_server_sock.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.host)
+            )
+
         if self.dscp:
             self.tos = int(self.dscp) << 2
-            print(
+            self.write(
                 "Attempt to apply markings to multicast server socket with DSCP ({0}) and TOS ({1})".format(
                     self.dscp, self.tos
                 )
@@ -83,77 +179,131 @@ class MulticastServer:
             else:
                 raise ValueError("Invalid family %d" % self.family)
 
-        if platform.system() == "Windows":
+        if SYSTEM == "Windows":
             return
 
-        if platform.system() == "Linux":
+        if SYSTEM == "Linux":
             # Enable port reuse so we can run multiple clients and servers on single (host, port).
             self.mc_server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             return
 
-        if platform.system() == "Darwin":
+        if SYSTEM == "Darwin":
             # Enable port reuse so we can run multiple clients and servers on single (host, port).
             self.mc_server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             return
 
         raise ValueError(
-            "{0} does not appear to be a supported platform".format(platform.system())
+            "{0} does not appear to be a supported platform".format(SYSTEM)
+        )
+
+    def build_payload(self, group, stream_id):
+        # resolve everything that does not change per packet once, up front
+        if self.debug:
+            origin = "multicast from {0} ({1}) to {2}:{3}".format(
+                self.hostname,
+                socket.inet_ntoa(
+                    self.mc_server_sock.getsockopt(
+                        socket.IPPROTO_IP, socket.IP_MULTICAST_IF, 4
+                    )
+                ),
+                group,
+                self.port,
+            )
+        else:
+            origin = "multicast from {0} to {1}:{2}".format(
+                self.hostname, group, self.port
+            )
+        return PayloadBuffer(
+            origin,
+            padding=self.padding,
+            payload=self.payload,
+            header=self.header,
+            stream_id=stream_id,
         )
 
     def multicast(self):
-        counter = 0
+        # the payload text names the group, so datagram sizes differ by group
+        targets = [
+            (packets, sender.send, packets[0].size) for packets, sender in self.targets
+        ]
+        turns = len(targets)
+        turn = 0
+        step = self.sequence_step
+        sequences = [self.sequence_start - step] * turns
+        burst = self.burst
+        size = self.packet.size
+        pacer = self.pacer
+        verbose = self.verbose
+        counters, slot = self.counters or (None, 0)
+        write = self.write
+        reporter = self.reporter
+        time_ns = time.time_ns
+        stages = self.stages
+        traffic = self.traffic
+        clock = time.perf_counter_ns
+        guard = SendGuard.acquire(self.stop_event)
+        pacer.start()
+        report_at = reporter.start(time_ns())
+        if stages is not None:
+            stages.start()
         try:
             while not self.stop_event.is_set():
-                counter += 1
-                extra = ""
-                if self.padding:
-                    extra = " " * self.padding
-                now = datetime.now().strftime("%H:%M:%S.%f")[:-2]
-                if self.debug:
-                    payload_message = (
-                        "multicast from {0} ({1}) to {2}:{3} message {4} at {5}".format(
-                            self.hostname,
-                            socket.inet_ntoa(
-                                self.mc_server_sock.getsockopt(
-                                    socket.IPPROTO_IP, socket.IP_MULTICAST_IF, 4
-                                )
-                            ),
-                            self.multicast_group[0],
-                            self.multicast_group[1],
-                            counter,
-                            now,
+                if stages is not None:
+                    begin = clock()
+                if traffic is not None and not traffic.advance(pacer):
+                    break
+                pacer.wait()
+                if stages is not None:
+                    paced = clock()
+                now = time_ns()
+                packets, send, size = targets[turn]
+                sequence = sequences[turn]
+                for packet in packets:
+                    sequence += step
+                    packet.update(sequence, now)
+                sequences[turn] = sequence
+                if stages is not None:
+                    built = clock()
+                # a stop arriving from here on waits until the send is counted
+                guard.held = True
+                send()
+                if stages is not None:
+                    stages.lap(PACE, begin, paced, built, clock())
+                pacer.sent(size, burst)
+                if counters is not None:
+                    counters[slot] = pacer.packets
+                    counters[slot + 1] = pacer.bytes
+                guard.held = False
+                if turns > 1:
+                    turn = (turn + 1) % turns
+                if report_at and now >= report_at:
+                    report_at = reporter.tick(pacer, now)
+                if not verbose:
+                    continue
+                if burst == 1:
+                    write(
+                        "Sending multicast ({0} bytes) -> {1}".format(
+                            size, packets[0].message()
                         )
                     )
                 else:
-                    payload_message = (
-                        "multicast from {0} to {1}:{2} message {3} at {4}".format(
-                            self.hostname,
-                            self.multicast_group[0],
-                            self.multicast_group[1],
-                            counter,
-                            now,
+                    write(
+                        "Sending multicast burst of {0} ({1} bytes each) -> {2}".format(
+                            burst, size, packets[0].message()
                         )
                     )
-                if self.payload:
-                    payload = self.payload
-                else:
-                    payload = payload_message + "{0}".format(extra)
-                self.mc_server_sock.sendto(payload.encode(), self.multicast_group)
-                print(
-                    "Sending multicast ({0} bytes) -> {1}".format(
-                        len(payload), payload_message
-                    )
-                )
-                time.sleep(self.interval)
+            if guard.deferred:
+                # stopped during a send: end the run as the signal would have
+                raise ServiceExit
         except socket.error as error:
             if "too long" in str(error).lower():
-                print(
+                self.write(
                     "Error: message with payload size of {0} too long to send.".format(
-                        len(payload)
+                        size
                     )
                 )
             else:
-                print(
+                self.write(
                     "Error: {0} on interface for {1}".format(
                         error,
                         socket.inet_ntoa(
@@ -165,93 +315,320 @@ class MulticastServer:
                 )
             raise ServiceExit
         finally:
+            guard.release()
             self.mc_server_sock.close()
+            if self.traffic is not None:
+                self.output.emit(
+                    self.pacer.summary_record(),
+                    self.pacer.summary(self.traffic.label()),
+                )
+                self.traffic.report(self.pacer, self.output.emit)
+            else:
+                self.output.emit(self.pacer.summary_record(), self.pacer.summary())
+            if self.stages is not None:
+                self.stages.emit(self.output.emit)
+            if self.burst > 1:
+                # fold the per-group senders into the first one for the report
+                for _packets, sender in self.targets[1:]:
+                    self.sender.packets += sender.packets
+                    self.sender.syscalls += sender.syscalls
+                self.write(self.sender.summary())
 
 
 class MulticastListener(threading.Thread):
-    def __init__(self, group, port, debug=False, host=None):
+    def __init__(
+        self,
+        group,
+        port,
+        debug=False,
+        host=None,
+        verbose=True,
+        report_interval=0,
+        output=None,
+        capture=None,
+        stats_detail=False,
+        kernel_timestamps=True,
+        rcvbuf=0,
+        flows=False,
+        flow_idle=DEFAULT_IDLE,
+        soak=None,
+    ):
         threading.Thread.__init__(self)
         self.port = int(port)
         self.host = host
+        # with an explicit address, groups are joined on its interface
+        self.interface = host
         if not self.host:
-            self.host = socket.gethostbyname(socket.gethostname())
-        self.group = group
+            self.host = local_address()
+        # group is a single address or a list from groups.expand_groups()
+        self.groups = [group] if isinstance(group, str) else list(group)
+        self.group = self.groups[0]
         self.buffer_size = 10240
         self.horizontal_rule = 0
         self.debug = debug
         self.stop_event = threading.Event()
         self.pyv = sys.version_info.major
+        self.streams = StreamTable()
+        # per-packet lines only when verbose; otherwise a summary line per
+        # report_interval seconds
+        self.verbose = verbose
+        self.report_interval = float(report_interval or 0)
+        self.output = output or PrintOutput()
+        self.write = self.output.write
+        self.reporter = ListenerReport(self.output.emit, self.streams)
+        self.packet_log = self.output.packet_log
+        # optional pcap.PcapWriter receiving a copy of every datagram
+        self.capture = capture
+        self.received = 0
+        self.received_bytes = 0
+        # per-stage timers of the receive loop with --stats-detail
+        self.stages = StageTimer("listener", RECEIVE_STAGES) if stats_detail else None
+        # per (source, source port, stream id) counters with --flows
+        self.flows = FlowTable(self.output.emit, flow_idle) if flows else None
+        # optional soak.SoakMonitor for --soak
+        self.soak = soak
+        self.table = GroupTable(self.groups)
 
-        # setup client socket
-        self.mc_client_sock = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
-        )
+        # join the groups on as few sockets as the per-socket membership
+        # limit allows
+        started = time.perf_counter()
+        self.sockets = []
+        self.default_keys = {}
+        for shard_groups in shard(self.groups, max_memberships()):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.sockets.append(sock)
+            self.set_platform_socket_options(sock, shard_groups)
+            if len(shard_groups) == 1:
+                self.default_keys[sock] = group_key(shard_groups[0])
+        self.join_time = time.perf_counter() - started
+        self.mc_client_sock = self.sockets[0]
 
-        # Socket set to non-blocking
-        self.mc_client_sock.setblocking(0)
+        if rcvbuf:
+            effective = [
+                set_buffer_size(sock, socket.SO_RCVBUF, rcvbuf) for sock in self.sockets
+            ]
+            self.write(
+                "Receive buffer: {0} bytes requested, {1} bytes effective".format(
+                    rcvbuf, min(effective)
+                )
+            )
+        # on Linux take arrival times and socket drop counts from the kernel
+        self.kernel_timestamps = kernel_timestamps and all(
+            [enable_kernel_stamps(sock) for sock in self.sockets]
+        )
 
-        self.set_platform_socket_options()
+        self.receiver = ReceiveLoop(
+            self.sockets,
+            self.on_packet,
+            self.buffer_size,
+            control_size=self.control_size(),
+            on_tick=self.tick,
+            # a capture is flushed from tick(), interval reports or not
+            tick_interval=self.report_interval
+            or (capture.flush_ns / 1e9 if capture is not None else 0),
+            stages=self.stages,
+        )
 
         if self.pyv == 3:
-            print("Listening with socket: {0}".format(self.mc_client_sock))
-
-    def set_platform_socket_options(self):
-        if platform.system() == "Windows":
-            self.mc_client_sock.bind((self.host, self.port))
-            self.mc_client_sock.setsockopt(
-                socket.IPPROTO_IP,
-                socket.IP_ADD_MEMBERSHIP,
-                socket.inet_aton(self.group) + socket.inet_aton(self.host),
+            self.write("Listening with socket: {0}".format(self.mc_client_sock))
+        if len(self.groups) > 1:
+            self.write(
+                "Joined {0} groups on {1} sockets in {2:.1f} ms ({3} KiB of counters, max RSS {4})".format(
+                    len(self.groups),
+                    len(self.sockets),
+                    self.join_time * 1000,
+                    self.table.memory() // 1024,
+                    format_rss(),
+                )
             )
+
+    def control_size(self):
+        # ancillary buffer per datagram; IP_PKTINFO tells the groups apart
+        # when a socket has joined more than one of them
+        if self.kernel_timestamps:
+            return KERNEL_CONTROL_SIZE
+        if len(self.default_keys) == len(self.sockets):
+            return 0
+        return 64
+
+    def set_platform_socket_options(self, sock, groups):
+        if SYSTEM == "Windows":
+            sock.bind((self.host, self.port))
+            for group in groups:
+                sock.setsockopt(
+                    socket.IPPROTO_IP,
+                    socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(group) + socket.inet_aton(self.host),
+                )
             return
 
         # Enable port reuse so we can run multiple clients and servers on single (host, port).
-        self.mc_client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        if platform.system() == "Linux":
-            self.mc_client_sock.bind(("", self.port))
-            mreq = struct.pack("4sl", socket.inet_aton(self.group), socket.INADDR_ANY)
-            self.mc_client_sock.setsockopt(
-                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq
-            )
+        if SYSTEM == "Linux":
+            # only deliver the groups joined on this socket, not every group
+            # joined by any socket bound to the port
+            sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+            sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            sock.bind(("", self.port))
+            for group in groups:
+                sock.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.membership(group)
+                )
             return
 
-        if platform.system() == "Darwin":
-            self.mc_client_sock.bind(("", self.port))
-            mreq = struct.pack("4sl", socket.inet_aton(self.group), socket.INADDR_ANY)
-            self.mc_client_sock.setsockopt(
-                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq
-            )
+        if SYSTEM == "Darwin":
+            sock.bind(("", self.port))
+            for group in groups:
+                sock.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.membership(group)
+                )
             return
 
         raise ValueError(
-            "{0} does not appear to be a supported platform".format(platform.system())
+            "{0} does not appear to be a supported platform".format(SYSTEM)
         )
 
+    def membership(self, group):
+        # struct ip_mreq for joining group on the --bind interface, or on
+        # the interface the kernel picks
+        if self.interface:
+            return socket.inet_aton(group) + socket.inet_aton(self.interface)
+        return struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+
     def start(self):
-        self.thread = threading.Thread(target=self.run)
-        self.thread.start()
-        header = "Listening for multicasts on group {0} port {1}".format(
-            self.group, self.port
-        )
+        threading.Thread.start(self)
+        self.announce()
+
+    def announce(self):
+        if len(self.groups) > 1:
+            header = (
+                "Listening for multicasts on {0} groups ({1} to {2}) port {3}".format(
+                    len(self.groups), self.groups[0], self.groups[-1], self.port
+                )
+            )
+        else:
+            header = "Listening for multicasts on group {0} port {1}".format(
+                self.group, self.port
+            )
         self.horizontal_rule = "-" * len(header)
-        print(header)
-        print(self.horizontal_rule)
+        self.write(header)
+        self.write(self.horizontal_rule)
 
     def run(self):
-        while not self.stop_event.is_set():
-            try:
-                payload, address = self.mc_client_sock.recvfrom(self.buffer_size)
-                self.on_packet(payload, address)
-            except socket.error:
-                pass
-        self.mc_client_sock.close()
-
-    def on_packet(self, payload, address):
-        now = datetime.now().strftime("%H:%M:%S.%f")[:-2]
-        data = payload.decode()
-        print(
-            "Receiving ({0} bytes) time {1} from {2}:{3}:\n -> {4}\n".format(
-                len(data), now, address[0], address[1], data.strip()
+        try:
+            self.reporter.start()
+            self.receiver.run()
+        finally:
+            for sock in self.sockets:
+                sock.close()
+            self.report()
+
+    def tick(self):
+        if self.report_interval:
+            self.reporter.tick(
+                self.received, self.received_bytes, drops=self.kernel_drops()
+            )
+        if self.flows is not None:
+            self.flows.expire(time.time_ns())
+        if self.capture is not None:
+            self.capture.expire(time.time_ns())
+        if self.soak is not None:
+            self.soak.tick(time.time_ns(), self.streams.lost())
+
+    def kernel_drops(self):
+        # None unless the kernel reports socket drops
+        if not self.kernel_timestamps:
+            return None
+        return self.receiver.kernel_drops()
+
+    def report(self):
+        self.reporter.summary(
+            self.received, self.received_bytes, drops=self.kernel_drops()
+        )
+        if self.stages is not None:
+            self.stages.emit(self.output.emit)
+        if self.flows is not None:
+            self.flows.report()
+        if self.soak is not None:
+            self.soak.report(self.streams.lost())
+        for stats in self.streams:
+            stats.roll()
+            text = stats.summary()
+            latency = stats.latency_summary()
+            if latency:
+                text += "\n" + latency
+            self.output.emit(stats.summary_record(), text)
+        for record, line in self.table.records():
+            self.output.emit(record, line)
+        if len(self.groups) > 1:
+            self.write("max RSS {0}".format(format_rss()))
+
+    def stop(self):
+        self.stop_event.set()
+        self.receiver.stop()
+
+    def on_packet(self, view, nbytes, address):
+        # view is a receive ring slot holding nbytes of datagram
+        stages = self.stages
+        if stages is not None:
+            begin = time.perf_counter_ns()
+        self.received += 1
+        self.received_bytes += nbytes
+        receiver = self.receiver
+        key = receiver.destination or self.default_keys.get(receiver.sock, 0)
+        arrival_ns = receiver.arrival_ns or time.time_ns()
+        header = parse_header(view, nbytes)
+        if stages is not None:
+            parsed = time.perf_counter_ns()
+        self.table.record(key, nbytes)
+        if self.capture is not None:
+            self.capture.write(arrival_ns, view, nbytes, address, key, self.port)
+        packet_log = self.packet_log
+        if header:
+            stream_id, sequence, timestamp_ns, _length = header
+            stats = self.streams.record(stream_id, sequence, nbytes, timestamp_ns)
+            if timestamp_ns:
+                stats.record_transit(timestamp_ns, arrival_ns)
+            if packet_log is not None:
+                packet_log.log(
+                    arrival_ns, address, key, stream_id, sequence, timestamp_ns, nbytes
+                )
+            if self.flows is not None:
+                self.flows.record(
+                    address, stream_id, sequence, nbytes, timestamp_ns, arrival_ns
+                )
+        else:
+            if packet_log is not None:
+                packet_log.log(arrival_ns, address, key, None, None, None, nbytes)
+            if self.flows is not None:
+                self.flows.record(address, None, None, nbytes, 0, arrival_ns)
+        if self.soak is not None:
+            self.soak.record(
+                arrival_ns,
+                nbytes,
+                arrival_ns - header[2] if header and header[2] else None,
+            )
+        if stages is not None:
+            recorded = time.perf_counter_ns()
+            stages.lap(PARSE, begin, parsed, recorded)
+        if not self.verbose:
+            return
+        if header:
+            offset = HEADER_SIZE
+            label = " stream {0} seq {1}".format(stream_id, sequence)
+        else:
+            offset = 0
+            label = ""
+        if len(self.groups) > 1:
+            label += " to {0}".format(socket.inet_ntoa(struct.pack("=I", key)))
+        # decode only for display
+        now = format_clock(arrival_ns)
+        data = bytes(view[offset:nbytes]).decode(errors="replace")
+        self.write(
+            "Receiving ({0} bytes) time {1} from {2}:{3}{4}:\n -> {5}\n".format(
+                nbytes, now, address[0], address[1], label, data.strip()
             )
         )
+        if stages is not None:
+            stages.add(REPORT, time.perf_counter_ns() - recorded)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+#
+# output.py: provide text, JSON Lines and CSV result output for bcmc
+
+# stdlib imports
+import collections
+import csv
+import io
+import json
+import socket
+import struct
+import sys
+import threading
+
+# app imports
+from .report import ConsoleWriter
+
+FORMATS = ("text", "json", "csv")
+
+# columns of CSV result records; JSON records carry the same keys, leaving
+# out the ones that do not apply
+FIELDS = (
+    "type",
+    "role",
+    "stream",
+    "group",
+    "start",
+    "end",
+    "seconds",
+    "packets",
+    "bytes",
+    "pps",
+    "bps",
+    "lost",
+    "loss_pct",
+    "duplicates",
+    "out_of_order",
+    "resets",
+    "kernel_drops",
+    "network_lost",
+    "early",
+    "jitter_us",
+    "delay_p50_us",
+    "delay_p99_us",
+    "delay_p999_us",
+    "delay_max_us",
+    "ipdv_p50_us",
+    "ipdv_p99_us",
+    "target_pps",
+    "target_bps",
+    "workers",
+    "client",
+    "receivers",
+    "delivery_pct",
+    "stage",
+    "calls",
+    "mean_ns",
+    "share_pct",
+    "phase",
+    "shape",
+    "planned",
+    "source",
+    "flows",
+    "outages",
+    "downtime",
+    "runs",
+    "file",
+    "skipped",
+    "reorder_max",
+    "loss_runs",
+    "long_runs",
+    "longest_run",
+    "gap_p50_us",
+    "gap_p99_us",
+    "gap_max_us",
+)
+
+# columns of the per-packet log
+PACKET_FIELDS = (
+    "arrival_ns",
+    "source",
+    "port",
+    "group",
+    "stream",
+    "sequence",
+    "sent_ns",
+    "bytes",
+)
+
+# per-packet lines, and for datagrams without a bcmc header
+_CSV_PACKET = "%d,%s,%d,%s,%d,%d,%d,%d\n"
+_CSV_BARE_PACKET = "%d,%s,%d,%s,,,,%d\n"
+_JSON_PACKET = (
+    '{"arrival_ns":%d,"source":"%s","port":%d,"group":"%s",'
+    '"stream":%d,"sequence":%d,"sent_ns":%d,"bytes":%d}\n'
+)
+_JSON_BARE_PACKET = (
+    '{"arrival_ns":%d,"source":"%s","port":%d,"group":"%s",'
+    '"stream":null,"sequence":null,"sent_ns":null,"bytes":%d}\n'
+)
+
+# binary per-packet log, chosen by a .bin file name: a header, then one
+# fixed-size little-endian record per packet, so the log can be memory-mapped
+# and read as columns (bcmc analyze)
+#
+#   arrival_ns   q   arrival time in nanoseconds since the epoch
+#   sent_ns      q   send time from the bcmc header, 0 without one
+#   sequence     Q   sequence number, 0 without a header
+#   stream       I   stream id, 0 without a header
+#   bytes        I   datagram size
+#   source       4s  source IPv4 address
+#   group        4s  destination group, 0.0.0.0 for broadcast
+#   port         H   source port
+#   flags        H   bit 0: the datagram had a bcmc header
+PACKET_LOG_MAGIC = b"BCMCPKTS"
+PACKET_LOG_VERSION = 1
+PACKET_LOG_HEADER = struct.Struct("<8sII")
+PACKET_RECORD = struct.Struct("<qqQII4s4sHH4x")
+FLAG_HEADER = 1
+
+# buffer size of the files written to
+FILE_BUFFER = 1 << 20
+
+
+def _csv_line(values):
+    line = io.StringIO()
+    csv.writer(line, lineterminator="").writerow(values)
+    return line.getvalue()
+
+
+class Output:
+    # route human-readable text and structured result records. in text mode
+    # records are shown as their text; otherwise records are encoded as JSON
+    # Lines or CSV rows and go to path (or stdout), and the human-readable
+    # text moves to stderr if it would otherwise be mixed in with them
+
+    def __init__(self, format="text", path=None, packet_log=None):
+        if format not in FORMATS:
+            raise ValueError("unknown output format {0}".format(format))
+        self.format = format
+        self.path = path
+        self.file = open(path, "a", buffering=FILE_BUFFER) if path else None
+        self.results = ConsoleWriter(self.file or sys.stdout)
+        if path is None and format == "text":
+            self.console = self.results
+        else:
+            self.console = ConsoleWriter(sys.stdout if path is not None else sys.stderr)
+        self.packet_log = PacketLog(packet_log, format) if packet_log else None
+        # functions called with every result record, e.g. the control
+        # channel; they run on the emitting thread
+        self.observers = []
+        # appending to a file that already has rows: its header is there
+        if format == "csv" and not (self.file and self.file.tell()):
+            self.results.write(_csv_line(FIELDS))
+
+    def start(self):
+        for writer in self.writers():
+            writer.start()
+
+    def writers(self):
+        writers = [self.results]
+        if self.console is not self.results:
+            writers.append(self.console)
+        if self.packet_log is not None:
+            writers.append(self.packet_log)
+        return writers
+
+    def write(self, line):
+        # human-readable text
+        self.console.write(line)
+
+    def flush(self):
+        # write out what is queued now, for callers that did not start()
+        for writer in self.writers():
+            writer.flush()
+
+    def observe(self, observer):
+        self.observers.append(observer)
+
+    def emit(self, record, text):
+        # a result record and its text form; records with text None only
+        # appear in JSON and CSV output
+        for observer in self.observers:
+            observer(record)
+        if self.format == "text":
+            if text is not None:
+                self.results.write(text)
+        elif self.format == "json":
+            self.results.write(json.dumps(record, separators=(",", ":")))
+        else:
+            self.results.write(_csv_line([record.get(field, "") for field in FIELDS]))
+
+    def close(self):
+        for writer in self.writers():
+            writer.close()
+        if self.file is not None:
+            self.file.close()
+
+
+class PrintOutput:
+    # stand-in when no Output is set up: everything is printed as text
+
+    format = "text"
+    packet_log = None
+
+    def write(self, line):
+        print(line)
+
+    def emit(self, record, text):
+        if text is not None:
+            print(text)
+
+
+class PacketLog(threading.Thread):
+    # per-packet record log. the receive path only appends a tuple to a
+    # deque; this thread formats and writes them in batches. when it falls
+    # more than max_backlog packets behind, packets are left out of the log
+    # and counted instead of slowing down the receive loop
+
+    def __init__(self, path, format="csv", flush_interval=0.2, max_backlog=1000000):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        if path.endswith(".bin"):
+            self.format = "binary"
+        else:
+            self.format = "json" if format == "json" else "csv"
+        self.file = open(
+            path, "ab" if self.format == "binary" else "a", buffering=FILE_BUFFER
+        )
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.records = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.stop_event = threading.Event()
+        self.groups = {0: ""}
+        self.sources = {}
+        if self.format == "csv" and not self.file.tell():
+            self.file.write(",".join(PACKET_FIELDS) + "\n")
+        elif self.format == "binary" and not self.file.tell():
+            self.file.write(
+                PACKET_LOG_HEADER.pack(
+                    PACKET_LOG_MAGIC, PACKET_LOG_VERSION, PACKET_RECORD.size
+                )
+            )
+
+    def log(self, arrival_ns, address, key, stream_id, sequence, sent_ns, size):
+        # key is the raw destination from IP_PKTINFO, 0 if unknown; the
+        # header fields are None for datagrams without a bcmc header
+        if len(self.records) >= self.max_backlog:
+            self.dropped += 1
+            return
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = socket.inet_ntoa(struct.pack("=I", key))
+        self.records.append(
+            (
+                arrival_ns,
+                address[0],
+                address[1],
+                group,
+                stream_id,
+                sequence,
+                sent_ns,
+                size,
+            )
+        )
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.stop_event.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        records = self.records
+        count = len(records)
+        if not count:
+            return
+        if self.format == "binary":
+            self.flush_binary(count)
+            return
+        if self.format == "json":
+            line, bare = _JSON_PACKET, _JSON_BARE_PACKET
+        else:
+            line, bare = _CSV_PACKET, _CSV_BARE_PACKET
+        lines = []
+        append = lines.append
+        popleft = records.popleft
+        for _ in range(count):
+            record = popleft()
+            if record[4] is None:
+                append(bare % (record[0], record[1], record[2], record[3], record[7]))
+            else:
+                append(line % record)
+        self.file.write("".join(lines))
+        self.written += count
+
+    def flush_binary(self, count):
+        # the group was formatted by log(); back to its 4 address bytes
+        pack = PACKET_RECORD.pack
+        sources = self.sources
+        popleft = self.records.popleft
+        chunks = []
+        append = chunks.append
+        for _ in range(count):
+            arrival_ns, host, port, group, stream_id, sequence, sent_ns, size = (
+                popleft()
+            )
+            source = sources.get(host)
+            if source is None:
+                source = sources[host] = socket.inet_aton(host)
+            address = sources.get(group)
+            if address is None:
+                address = sources[group] = socket.inet_aton(group or "0.0.0.0")
+            if stream_id is None:
+                append(pack(arrival_ns, 0, 0, 0, size, source, address, port, 0))
+            else:
+                append(
+                    pack(
+                        arrival_ns,
+                        sent_ns,
+                        sequence,
+                        stream_id,
+                        size,
+                        source,
+                        address,
+                        port,
+                        FLAG_HEADER,
+                    )
+                )
+        self.file.write(b"".join(chunks))
+        self.written += count
+
+    def close(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        self.file.close()
+        if self.dropped:
+            sys.stderr.write(
+                "packet log could not keep up: {0} packets left out of {1}\n".format(
+                    self.dropped, self.path
+                )
+            )
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# pacer.py: provide the send rate pacer for bcmc servers
+
+# stdlib imports
+import time
+
+
+class Pacer:
+    # schedule packets against absolute deadlines on a monotonic clock so the
+    # cost of building and sending a packet does not lower the achieved rate
+
+    # gaps shorter than this are busy-waited; sleep() overshoots by tens to
+    # hundreds of microseconds depending on the OS
+    spin_threshold = 0.001
+
+    def __init__(self, rate=None, bandwidth=None):
+        # rate is in packets per second, bandwidth in bits per second; with
+        # neither set the pacer does not wait at all
+        self.rate = float(rate) if rate else None
+        self.bandwidth = float(bandwidth) if bandwidth else None
+        self.period = 1.0 / self.rate if self.rate else 0.0
+        self.bit_period = 1.0 / self.bandwidth if self.bandwidth else 0.0
+        # never fall further behind than this; after a stall (suspend, slow
+        # console) the pacer resumes at the target rate instead of bursting
+        self.max_lag = max(0.1, 10 * self.period)
+        self.started = None
+        self.deadline = None
+        self.origin = None
+        self.packets = 0
+        self.bytes = 0
+
+    @classmethod
+    def from_args(cls, interval=None, rate=None, bandwidth=None):
+        # --rate wins over --bandwidth which wins over --interval
+        if rate:
+            return cls(rate=rate)
+        if bandwidth:
+            return cls(bandwidth=bandwidth)
+        if interval and float(interval) > 0:
+            return cls(rate=1.0 / float(interval))
+        return cls()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.deadline = self.started
+        # time base of schedule()
+        self.origin = self.started
+        self.packets = 0
+        self.bytes = 0
+
+    def wait(self):
+        # block until the deadline of the next packet
+        if self.deadline is None:
+            self.start()
+        deadline = self.deadline
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_threshold:
+            time.sleep(remaining - self.spin_threshold)
+        if remaining > 0:
+            perf_counter = time.perf_counter
+            while perf_counter() < deadline:
+                pass
+        elif -remaining > self.max_lag:
+            self.deadline = time.perf_counter()
+
+    def delay(self):
+        # seconds until the next deadline without blocking, for callers that
+        # wait elsewhere (e.g. an event loop); 0 or less means it is due
+        if self.deadline is None:
+            self.start()
+        remaining = self.deadline - time.perf_counter()
+        if -remaining > self.max_lag:
+            self.deadline = time.perf_counter()
+            return 0.0
+        return remaining
+
+    def schedule(self, offset):
+        # set the next deadline to offset seconds after start(), e.g. from
+        # the timestamps of a capture being replayed. when that is already
+        # more than max_lag in the past the schedule shifts rather than
+        # bursting to catch up
+        if self.started is None:
+            self.start()
+        deadline = self.origin + offset
+        lag = time.perf_counter() - deadline
+        if lag > self.max_lag:
+            self.origin += lag
+            deadline += lag
+        self.deadline = deadline
+
+    def sent(self, size, count=1):
+        # account for count sent packets of size bytes and move the deadline on
+        self.packets += count
+        self.bytes += size * count
+        if self.bandwidth:
+            self.deadline += size * count * 8 * self.bit_period
+        else:
+            self.deadline += self.period * count
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return time.perf_counter() - self.started
+
+    def achieved_pps(self):
+        elapsed = self.elapsed()
+        return self.packets / elapsed if elapsed > 0 else 0.0
+
+    def achieved_bps(self):
+        elapsed = self.elapsed()
+        return self.bytes * 8 / elapsed if elapsed > 0 else 0.0
+
+    def target(self):
+        if self.rate:
+            return "{0:.1f} pps".format(self.rate)
+        if self.bandwidth:
+            return "{0}".format(format_bits(self.bandwidth))
+        return "unpaced"
+
+    def summary(self, target=None):
+        # target describes the schedule when it was not set by rate/bandwidth
+        return "Sent {0} packets ({1} bytes) in {2:.3f}s: achieved {3:.1f} pps {4} (target {5})".format(
+            self.packets,
+            self.bytes,
+            self.elapsed(),
+            self.achieved_pps(),
+            format_bits(self.achieved_bps()),
+            target or self.target(),
+        )
+
+    def summary_record(self):
+        record = {
+            "type": "summary",
+            "role": "server",
+            "seconds": round(self.elapsed(), 6),
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "pps": self.achieved_pps(),
+            "bps": self.achieved_bps(),
+        }
+        if self.rate:
+            record["target_pps"] = self.rate
+        if self.bandwidth:
+            record["target_bps"] = self.bandwidth
+        return record
+
+
+def format_bits(bps):
+    for unit, scale in (("Gbit/s", 1e9), ("Mbit/s", 1e6), ("Kbit/s", 1e3)):
+        if bps >= scale:
+            return "{0:.2f} {1}".format(bps / scale, unit)
+    return "{0:.0f} bit/s".format(bps)
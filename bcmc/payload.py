@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# payload.py: provide the preallocated payload buffer for bcmc servers
+
+# stdlib imports
+import struct
+import time
+
+# app imports
+from .header import (
+    HEADER_SIZE,
+    SEQUENCE_OFFSET,
+    SEQUENCE_TIMESTAMP,
+    pack_header_into,
+)
+
+# ASCII renderings of 0..99 so digits can be patched without formatting
+_TWO_DIGITS = [b"%02d" % i for i in range(100)]
+
+COUNTER_WIDTH = 10
+_COUNTER = struct.Struct("%ds" % COUNTER_WIDTH)
+_FRACTION = struct.Struct("4s")
+_TIME_TEMPLATE = b"00:00:00.0000"
+# the text timestamp has a resolution of 100 microseconds
+_TICKS_PER_SECOND = 10000
+_NS_PER_TICK = 1000000000 // _TICKS_PER_SECOND
+
+
+class PayloadBuffer:
+    # build the datagram once and patch only the sequence and timestamp
+    # fields in place for every packet, so the send loop hands the same
+    # bytearray to sendto() without formatting or encoding anything
+
+    def __init__(self, origin, padding=0, payload=None, header=False, stream_id=0):
+        # origin is the leading text, e.g. "multicast from host to 239.0.0.2:2002"
+        self.header = header
+        body = HEADER_SIZE if header else 0
+        if payload:
+            text = payload.encode()
+            self.counter_offset = None
+            self.time_offset = None
+            self.fraction_offset = None
+            self.message_end = body + len(text)
+        else:
+            prefix = "{0} message ".format(origin).encode()
+            text = prefix + b"0" * COUNTER_WIDTH + b" at " + _TIME_TEMPLATE
+            self.counter_offset = body + len(prefix)
+            self.time_offset = self.counter_offset + COUNTER_WIDTH + len(b" at ")
+            self.fraction_offset = self.time_offset + len(b"00:00:00.")
+            self.message_end = body + len(text)
+            text += b" " * padding
+        self.body_offset = body
+        self.buffer = bytearray(body + len(text))
+        self.buffer[body:] = text
+        self.view = memoryview(self.buffer)
+        self.size = len(self.buffer)
+        if header:
+            pack_header_into(self.buffer, 0, stream_id, 0, 0, len(text))
+        self._hour = None
+        self._second = None
+        self._offset_ticks = 0
+
+    def update(self, sequence, now_ns):
+        # patch the per-packet fields for sequence sent at now_ns
+        buffer = self.buffer
+        if self.header:
+            SEQUENCE_TIMESTAMP.pack_into(buffer, SEQUENCE_OFFSET, sequence, now_ns)
+        if self.counter_offset is None:
+            return
+        _COUNTER.pack_into(buffer, self.counter_offset, b"%010d" % sequence)
+        seconds, fraction = divmod(
+            now_ns // _NS_PER_TICK + self._offset_ticks, _TICKS_PER_SECOND
+        )
+        if seconds != self._second:
+            self._write_clock(seconds, now_ns)
+        _FRACTION.pack_into(buffer, self.fraction_offset, b"%04d" % fraction)
+
+    def _write_clock(self, seconds, now_ns):
+        # re-render HH:MM:SS only when the second rolls over
+        hours = seconds // 3600
+        if hours != self._hour:
+            # the local UTC offset can only change on an hour boundary (DST)
+            offset = time.localtime(now_ns // 1000000000).tm_gmtoff
+            self._offset_ticks = offset * _TICKS_PER_SECOND
+            seconds = now_ns // 1000000000 + offset
+            hours = seconds // 3600
+            self._hour = hours
+        self._second = seconds
+        minutes, second = divmod(seconds, 60)
+        view = self.view
+        offset = self.time_offset
+        view[offset : offset + 2] = _TWO_DIGITS[hours % 24]
+        view[offset + 3 : offset + 5] = _TWO_DIGITS[minutes % 60]
+        view[offset + 6 : offset + 8] = _TWO_DIGITS[second]
+
+    def message(self):
+        # decode the text part of the payload, used for console output only
+        return bytes(self.view[self.body_offset : self.message_end]).decode(
+            errors="replace"
+        )
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+#
+# pcap.py: provide pcap capture writing and reading for bcmc
+
+# stdlib imports
+import collections
+import mmap
+import os
+import socket
+import struct
+import threading
+
+# nanosecond-resolution pcap, raw IPv4 packets (LINKTYPE_RAW)
+PCAP_MAGIC_NS = 0xA1B23C4D
+LINKTYPE_RAW = 101
+SNAPLEN = 65535
+PCAP_HEADER = struct.Struct("<IHHiIII")
+RECORD_HEADER = struct.Struct("<IIII")
+
+# the listener only sees UDP payloads, so each record gets a synthesized
+# IPv4 and UDP header: no options, checksums left at 0 (not computed)
+_IP_UDP = struct.Struct("!BBHHHBBH4s4sHHHH")
+IP_UDP_SIZE = _IP_UDP.size
+# a record is written as its timestamp followed by a cached template of
+# the remaining record header fields and the IPv4/UDP header
+_TIMESTAMP = struct.Struct("<II")
+_LENGTHS = struct.Struct("<II")
+_TEMPLATE_SIZE = _LENGTHS.size + IP_UDP_SIZE
+_RECORD_PREFIX = RECORD_HEADER.size + IP_UDP_SIZE
+_MAX_PAYLOAD = SNAPLEN - IP_UDP_SIZE
+_MAX_TEMPLATES = 4096
+
+BROADCAST_KEY = struct.unpack("=I", socket.inet_aton("255.255.255.255"))[0]
+
+
+def pcap_header():
+    return PCAP_HEADER.pack(PCAP_MAGIC_NS, 2, 4, 0, 0, SNAPLEN, LINKTYPE_RAW)
+
+
+class PcapWriter(threading.Thread):
+    # the receive path copies each datagram into a preallocated chunk; full
+    # chunks are handed to this thread, which writes each with a single
+    # write() call and returns it to the free list. if the disk falls so far
+    # behind that max_chunks are all in flight, packets are left out of the
+    # capture and counted instead of blocking the receive loop
+
+    def __init__(
+        self,
+        path,
+        rotate_bytes=0,
+        rotate_seconds=0,
+        chunk_size=4 << 20,
+        max_chunks=64,
+        flush_seconds=1.0,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.rotate_bytes = int(rotate_bytes or 0)
+        self.rotate_ns = int((rotate_seconds or 0) * 1e9)
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        # a partly filled chunk is handed over after this long, by write()
+        # or expire(), so the file stays current when traffic is slow
+        self.flush_ns = int(flush_seconds * 1e9)
+        self.free = collections.deque(bytearray(chunk_size) for _ in range(2))
+        self.allocated = len(self.free)
+        self.full = collections.deque()
+        self.ready = threading.Event()
+        self.stopped = False
+        self.chunk = self.free.popleft()
+        self.view = memoryview(self.chunk)
+        self.used = 0
+        self.flush_at = 0
+        self.rotate_at = None
+        # bytes in the current file, including the ones still in chunks
+        self.file_bytes = PCAP_HEADER.size
+        # (source address, destination key, size) -> record template
+        self.templates = {}
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.files = []
+        self.file = None
+        self.open_next()
+
+    def file_name(self, index):
+        if not (self.rotate_bytes or self.rotate_ns):
+            return self.path
+        stem, extension = os.path.splitext(self.path)
+        return "{0}-{1:04d}{2}".format(stem, index, extension or ".pcap")
+
+    def open_next(self):
+        if self.file is not None:
+            self.file.close()
+        name = self.file_name(len(self.files) + 1)
+        self.file = open(name, "wb", buffering=0)
+        self.file.write(pcap_header())
+        self.files.append(name)
+
+    def template(self, source, destination, port, size, nbytes):
+        # record lengths plus IPv4/UDP header, everything but the timestamp
+        template = _LENGTHS.pack(
+            IP_UDP_SIZE + size, IP_UDP_SIZE + nbytes
+        ) + _IP_UDP.pack(
+            0x45,
+            0,
+            IP_UDP_SIZE + size,
+            0,
+            0,
+            64,
+            socket.IPPROTO_UDP,
+            0,
+            socket.inet_aton(source[0]),
+            struct.pack("=I", destination),
+            source[1],
+            port,
+            8 + size,
+            0,
+        )
+        if len(self.templates) >= _MAX_TEMPLATES:
+            self.templates.clear()
+        self.templates[(source, destination, nbytes)] = template
+        return template
+
+    def write(self, arrival_ns, data, nbytes, source, destination, port):
+        # append one datagram received at arrival_ns from source (ip, port)
+        # to destination (raw network order address as in IP_PKTINFO):port
+        size = nbytes if nbytes <= _MAX_PAYLOAD else _MAX_PAYLOAD
+        length = _RECORD_PREFIX + size
+        if self.rotate_ns:
+            if self.rotate_at is None:
+                self.rotate_at = arrival_ns + self.rotate_ns
+            elif arrival_ns >= self.rotate_at:
+                self.rotate_at = arrival_ns + self.rotate_ns
+                self.seal(True)
+        if self.rotate_bytes and self.file_bytes + length > self.rotate_bytes:
+            if self.file_bytes > PCAP_HEADER.size:
+                self.seal(True)
+        used = self.used
+        if used + length > self.chunk_size:
+            self.seal(False)
+            used = 0
+        elif arrival_ns >= self.flush_at:
+            if used:
+                self.seal(False)
+                used = 0
+            self.flush_at = arrival_ns + self.flush_ns
+        view = self.view
+        if view is None:
+            self.take()
+            view = self.view
+            if view is None:
+                self.dropped += 1
+                return
+        template = self.templates.get((source, destination, nbytes))
+        if template is None:
+            template = self.template(source, destination, port, size, nbytes)
+        _TIMESTAMP.pack_into(
+            view, used, arrival_ns // 1000000000, arrival_ns % 1000000000
+        )
+        start = used + 8
+        view[start : start + _TEMPLATE_SIZE] = template
+        start += _TEMPLATE_SIZE
+        view[start : start + size] = data[:size]
+        self.used = used + length
+        self.file_bytes += length
+        self.packets += 1
+        self.bytes += nbytes
+
+    def expire(self, now_ns):
+        # hand over a partly filled chunk that is due, for callers outside
+        # the packet path: without traffic write() never gets to it
+        if self.used and now_ns >= self.flush_at:
+            self.seal(False)
+            self.flush_at = now_ns + self.flush_ns
+
+    def take(self):
+        # switch to a free chunk, allocating one more if none is free
+        if self.free:
+            self.chunk = self.free.popleft()
+        elif self.allocated < self.max_chunks:
+            self.chunk = bytearray(self.chunk_size)
+            self.allocated += 1
+        else:
+            self.chunk = None
+            self.view = None
+            return
+        self.view = memoryview(self.chunk)
+
+    def seal(self, rotate):
+        # hand the current chunk to the writer thread; with rotate the next
+        # record goes to a new file
+        self.view = None
+        self.full.append((self.chunk, self.used, rotate))
+        self.ready.set()
+        self.used = 0
+        if rotate:
+            self.file_bytes = PCAP_HEADER.size
+        self.take()
+
+    def run(self):
+        while True:
+            self.ready.wait(0.5)
+            self.ready.clear()
+            while self.full:
+                chunk, used, rotate = self.full.popleft()
+                if used:
+                    self.file.write(memoryview(chunk)[:used])
+                if chunk is not None:
+                    self.free.append(chunk)
+                if rotate:
+                    self.open_next()
+            if self.stopped and not self.full:
+                break
+
+    def close(self):
+        # call once nothing writes any more
+        if self.stopped:
+            return
+        self.seal(False)
+        self.stopped = True
+        self.ready.set()
+        if self.is_alive():
+            self.join()
+        else:
+            self.run()
+        self.file.close()
+
+    def summary(self):
+        line = "pcap: {0} packets ({1} bytes) written to {2}".format(
+            self.packets,
+            self.bytes,
+            (
+                self.files[0]
+                if len(self.files) == 1
+                else "{0} files {1} .. {2}".format(
+                    len(self.files), self.files[0], self.files[-1]
+                )
+            ),
+        )
+        if self.dropped:
+            line += ", {0} packets left out (disk too slow)".format(self.dropped)
+        return line
+
+
+class PcapError(Exception):
+    """
+    Exception raised for files that cannot be read as pcap captures
+    """
+
+
+# magic as read little-endian -> (byte order, ticks per second)
+_MAGICS = {
+    0xA1B2C3D4: ("<", 1000000),
+    0xA1B23C4D: ("<", 1000000000),
+    0xD4C3B2A1: (">", 1000000),
+    0x4D3CB2A1: (">", 1000000000),
+}
+_PCAPNG_MAGIC = 0x0A0D0D0A
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_VLANS = (0x8100, 0x88A8, 0x9100)
+_UINT16 = struct.Struct("!H")
+
+
+class PcapReader:
+    # iterate over the UDP/IPv4 datagrams of a pcap file without loading it:
+    # the file is mmap'd and records are decoded one at a time, so memory
+    # use does not grow with the capture size. payloads are memoryviews into
+    # the mapping and are only valid until the next record is read
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            self.file.close()
+            raise PcapError("{0} is empty".format(path))
+        if len(self.map) < PCAP_HEADER.size:
+            self.close()
+            raise PcapError("{0} is too short for a pcap file".format(path))
+        magic = struct.unpack_from("<I", self.map, 0)[0]
+        if magic == _PCAPNG_MAGIC:
+            self.close()
+            raise PcapError(
+                "{0} is pcapng; convert it with: editcap -F pcap {0} out.pcap".format(
+                    path
+                )
+            )
+        if magic not in _MAGICS:
+            self.close()
+            raise PcapError("{0} is not a pcap file".format(path))
+        order, self.ticks = _MAGICS[magic]
+        header = struct.unpack_from(order + "IHHiIII", self.map, 0)
+        self.linktype = header[6] & 0xFFFF
+        self.record_header = struct.Struct(order + "IIII")
+        # records read, and records that were not a complete UDP/IPv4 datagram
+        self.records = 0
+        self.skipped = 0
+
+    def __iter__(self):
+        # yield (timestamp_ns, (destination ip bytes, port), payload)
+        data = self.map
+        view = memoryview(data)
+        unpack_record = self.record_header.unpack_from
+        record_size = self.record_header.size
+        scale = 1000000000 // self.ticks
+        network = self.network_offset
+        end = len(data)
+        offset = PCAP_HEADER.size
+        try:
+            while offset + record_size <= end:
+                seconds, fraction, captured, original = unpack_record(data, offset)
+                offset += record_size
+                start = offset
+                offset += captured
+                if offset > end:
+                    # the capture was cut off mid-record
+                    break
+                self.records += 1
+                ip = network(data, start, captured)
+                if ip < 0 or ip + 20 > offset or captured != original:
+                    self.skipped += 1
+                    continue
+                header_length = (data[ip] & 0x0F) * 4
+                udp = ip + header_length
+                if (
+                    data[ip] >> 4 != 4
+                    or data[ip + 9] != socket.IPPROTO_UDP
+                    or _UINT16.unpack_from(data, ip + 6)[0] & 0x3FFF
+                    or udp + 8 > offset
+                ):
+                    # not IPv4/UDP, or a fragment
+                    self.skipped += 1
+                    continue
+                length = _UINT16.unpack_from(data, udp + 4)[0]
+                if length < 8 or udp + length > offset:
+                    self.skipped += 1
+                    continue
+                yield (
+                    seconds * 1000000000 + fraction * scale,
+                    (data[ip + 16 : ip + 20], _UINT16.unpack_from(data, udp + 2)[0]),
+                    view[udp + 8 : udp + length],
+                )
+        finally:
+            view.release()
+
+    def network_offset(self, data, start, captured):
+        # offset of the IPv4 header of the record at start, -1 if none
+        linktype = self.linktype
+        if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+            return start
+        if linktype == LINKTYPE_ETHERNET:
+            offset = start + 12
+            limit = start + captured - 2
+            while offset <= limit:
+                ethertype = _UINT16.unpack_from(data, offset)[0]
+                if ethertype == _ETHERTYPE_IPV4:
+                    return offset + 2
+                if ethertype not in _ETHERTYPE_VLANS:
+                    return -1
+                offset += 4
+            return -1
+        if linktype == LINKTYPE_LINUX_SLL:
+            if captured >= 16 and _UINT16.unpack_from(data, start + 14)[0] == 0x0800:
+                return start + 16
+            return -1
+        if linktype == LINKTYPE_LINUX_SLL2:
+            if captured >= 20 and _UINT16.unpack_from(data, start)[0] == 0x0800:
+                return start + 20
+            return -1
+        if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+            # address family in host (NULL) or network (LOOP) byte order
+            if captured >= 4 and data[start : start + 4] in (
+                b"\x02\x00\x00\x00",
+                b"\x00\x00\x00\x02",
+            ):
+                return start + 4
+            return -1
+        return -1
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# profiling.py: provide the --profile hook for bcmc send and receive loops
+
+# stdlib imports
+import cProfile
+import io
+import pstats
+import threading
+
+# functions listed in the shutdown report
+REPORT_LIMIT = 30
+
+
+class Profiler:
+    # run the send loops, listener threads and event loop under cProfile and
+    # merge every thread's profile into one report at shutdown. cProfile
+    # only sees the thread that enabled it, so each thread gets its own
+
+    def __init__(self, path=None, sort="cumulative", limit=REPORT_LIMIT):
+        # with a path the merged stats are saved there for pstats/snakeviz,
+        # otherwise report() returns the top functions as text
+        self.path = path
+        self.sort = sort
+        self.limit = limit
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def run(self, function, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ builds cProfile on sys.monitoring: only one
+            # profiler can be active, and it already covers every thread
+            return function(*args, **kwargs)
+        with self.lock:
+            self.profiles.append(profile)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+
+    def attach(self, thread):
+        # profile a threading.Thread's run() once it is started
+        thread.run = lambda run=thread.run: self.run(run)
+
+    def report(self):
+        # the report text, or a note where the stats were saved; call once
+        # every profiled thread has finished
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return "profile: nothing was profiled"
+        text = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=text)
+        if self.path:
+            stats.dump_stats(self.path)
+            return "profile of {0} thread(s) written to {1}".format(
+                len(profiles), self.path
+            )
+        stats.strip_dirs().sort_stats(self.sort).print_stats(self.limit)
+        return "profile of {0} thread(s), top {1} by {2} time:\n{3}".format(
+            len(profiles), self.limit, self.sort, text.getvalue().strip("\n")
+        )
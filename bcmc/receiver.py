@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+#
+# receiver.py: provide the readiness-based receive loop for bcmc listeners
+
+# stdlib imports
+import ctypes
+import selectors
+import socket
+import struct
+import time
+
+# app imports
+from .helpers import SYSTEM
+from .mmsg import (
+    CMSG_ALIGN,
+    CMSGHDR,
+    IP_PKTINFO,
+    MSG_DONTWAIT,
+    SO_RXQ_OVFL,
+    SO_TIMESTAMPNS,
+    IOVec,
+    MMsgHdr,
+    MsgHdr,
+    recvmmsg,
+)
+from .stages import RECV, REPORT, WAIT
+
+# size of struct sockaddr_in
+_SOCKADDR_SIZE = 16
+# struct in_pktinfo is { int ipi_ifindex; in_addr ipi_spec_dst; in_addr ipi_addr; }
+_PKTINFO_ADDR_OFFSET = 8
+_UINT32 = struct.Struct("=I")
+# struct timespec is { time_t tv_sec; long tv_nsec; }
+_TIMESPEC = struct.Struct("@ll")
+
+# ancillary buffer per datagram with kernel timestamps on: room for
+# SO_TIMESTAMPNS, SO_RXQ_OVFL and IP_PKTINFO
+KERNEL_CONTROL_SIZE = 128
+
+
+def enable_kernel_stamps(sock):
+    # ask Linux for receive timestamps and drop counts as ancillary data;
+    # False where they are not available
+    if SYSTEM != "Linux":
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+    except OSError:
+        return False
+    return True
+
+
+class RecvRing:
+    # preallocated receive slots; datagrams are received straight into them
+    # and handed out as memoryviews, so the hot path allocates no buffers.
+    # a slot is overwritten once the ring wraps, so handlers that keep data
+    # past on_packet() must copy it
+
+    def __init__(self, slots=64, slot_size=10240):
+        self.slot_size = slot_size
+        self.buffers = [bytearray(slot_size) for _ in range(slots)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.index = 0
+
+    def __len__(self):
+        return len(self.buffers)
+
+
+class MMsgReceiver:
+    # receive up to one ring's worth of datagrams per recvmmsg() syscall
+
+    def __init__(self, ring, control_size=0):
+        count = len(ring)
+        self.ring = ring
+        self.count = count
+        self.control_size = control_size
+        self._control = (ctypes.c_char * max(1, control_size * count))()
+        self._names = (ctypes.c_char * (_SOCKADDR_SIZE * count))()
+        self._iovecs = (IOVec * count)()
+        self._messages = (MMsgHdr * count)()
+        # keep the ctypes views alive; they pin the bytearrays in place
+        self._views = []
+        for index, buffer in enumerate(ring.buffers):
+            view = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+            self._views.append(view)
+            self._iovecs[index].iov_base = ctypes.addressof(view)
+            self._iovecs[index].iov_len = len(buffer)
+            header = self._messages[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._names) + index * _SOCKADDR_SIZE
+            header.msg_namelen = _SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self._iovecs[index])
+            header.msg_iovlen = 1
+            if control_size:
+                header.msg_control = (
+                    ctypes.addressof(self._control) + index * control_size
+                )
+                header.msg_controllen = control_size
+        # read results through memoryviews instead of ctypes attribute
+        # access, which costs about a microsecond per field
+        stride = ctypes.sizeof(MMsgHdr) // 4
+        offset = MMsgHdr.msg_len.offset // 4
+        self.lengths = memoryview(self._messages).cast("B").cast("I")[offset::stride]
+        self._ports = memoryview(self._names).cast("B").cast("H")[1::8]
+        self._hosts = memoryview(self._names).cast("B").cast("I")[1::4]
+        self._addresses = {}
+        # the kernel shrinks msg_controllen to what it wrote; restore it
+        # before every call from a prefilled array
+        size_t = "Q" if CMSG_ALIGN == 8 else "I"
+        stride = ctypes.sizeof(MMsgHdr) // CMSG_ALIGN
+        offset = MMsgHdr.msg_hdr.offset + MsgHdr.msg_controllen.offset
+        self.control_lengths = (
+            memoryview(self._messages)
+            .cast("B")
+            .cast(size_t)[offset // CMSG_ALIGN :: stride]
+        )
+        self._control_reset = (
+            memoryview((ctypes.c_size_t * count)(*([control_size] * count)))
+            .cast("B")
+            .cast(size_t)
+        )
+        self.control = memoryview(self._control).cast("B")
+
+    def receive(self, fd):
+        # return the number of datagrams now in the ring, 0 when none queued
+        if self.control_size:
+            self.control_lengths[:] = self._control_reset
+        result = recvmmsg(fd, self._messages, self.count, MSG_DONTWAIT, None)
+        return result if result > 0 else 0
+
+    def address(self, index):
+        # decode the sender's sockaddr_in, cached per distinct sender
+        key = (self._hosts[index], self._ports[index])
+        address = self._addresses.get(key)
+        if address is None:
+            start = index * _SOCKADDR_SIZE
+            address = (
+                socket.inet_ntoa(self._names[start + 4 : start + 8]),
+                socket.ntohs(self._ports[index]),
+            )
+            self._addresses[key] = address
+        return address
+
+
+class ReceiveLoop:
+    # block in the selector until a socket is readable or stop() is called,
+    # instead of spinning on a non-blocking recvfrom()
+
+    # upper bound of datagrams handled per socket per wakeup, so one busy
+    # socket cannot starve the others or delay noticing a stop request
+    drain_budget = 1024
+
+    def __init__(
+        self,
+        sockets,
+        on_packet,
+        buffer_size=10240,
+        slots=64,
+        use_recvmmsg=True,
+        control_size=0,
+        on_tick=None,
+        tick_interval=0,
+        stages=None,
+    ):
+        # on_packet(view, nbytes, address) gets a memoryview of a ring slot
+        # holding nbytes of datagram. with control_size set, ancillary data
+        # is requested too and decoded into the per-packet attributes below
+        # before on_packet() runs. on_tick() is called every tick_interval
+        # seconds from the receiving thread, traffic or not. stages is a
+        # stages.StageTimer for --stats-detail; on_packet() times its own
+        # parse and record stages
+        self.sockets = list(sockets)
+        self.on_packet = on_packet
+        self.on_tick = on_tick
+        self.tick_interval = tick_interval if on_tick else 0
+        self.stages = stages
+        self.buffer_size = buffer_size
+        self.control_size = control_size
+        self.stopped = False
+        self.ring = RecvRing(slots, buffer_size)
+        self.batch = None
+        if use_recvmmsg and recvmmsg is not None:
+            self.batch = MMsgReceiver(self.ring, control_size)
+        self.selector = selectors.DefaultSelector()
+
+        # per-packet attributes, valid during on_packet()
+        self.sock = None
+        # IPv4 destination from IP_PKTINFO in network byte order, 0 if unknown
+        self.destination = 0
+        # kernel receive time from SO_TIMESTAMPNS in ns since the epoch, 0
+        # if unknown
+        self.arrival_ns = 0
+        # socket -> receive queue drops from SO_RXQ_OVFL; the kernel only
+        # sends the count once a socket has dropped something
+        self.overflows = {}
+
+        # a socketpair lets another thread wake the selector immediately
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ)
+
+        for sock in self.sockets:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def run(self):
+        if self.batch is not None:
+            drain = self.drain_batch
+        elif self.control_size and hasattr(socket.socket, "recvmsg_into"):
+            drain = self.drain_msg
+        else:
+            drain = self.drain
+        select = self.selector.select
+        tick_interval = self.tick_interval
+        timeout = None
+        stages = self.stages
+        clock = time.perf_counter_ns
+        if tick_interval:
+            next_tick = time.perf_counter() + tick_interval
+        try:
+            while not self.stopped:
+                if tick_interval:
+                    timeout = max(0.0, next_tick - time.perf_counter())
+                if stages is not None:
+                    begin = clock()
+                events = select(timeout)
+                if stages is not None:
+                    stages.add(WAIT, clock() - begin)
+                for key, _mask in events:
+                    if key.fileobj is self.wake_recv:
+                        self.stopped = True
+                        break
+                    self.sock = key.fileobj
+                    drain(key.fileobj)
+                if tick_interval:
+                    now = time.perf_counter()
+                    if now >= next_tick and not self.stopped:
+                        if stages is not None:
+                            begin = clock()
+                        self.on_tick()
+                        if stages is not None:
+                            stages.add(REPORT, clock() - begin)
+                        next_tick += tick_interval
+                        if next_tick <= now:
+                            # fell behind; skip the missed ticks
+                            next_tick = now + tick_interval
+        finally:
+            self.close()
+
+    def drain(self, sock):
+        # empty the socket queue before going back to sleep in select()
+        recvfrom_into = sock.recvfrom_into
+        on_packet = self.on_packet
+        views = self.ring.views
+        slots = len(views)
+        index = self.ring.index
+        stages = self.stages
+        clock = time.perf_counter_ns
+        for _ in range(self.drain_budget):
+            view = views[index]
+            if stages is not None:
+                begin = clock()
+            try:
+                nbytes, address = recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                # e.g. ICMP port unreachable reported on Windows; nothing to read
+                break
+            if stages is not None:
+                stages.add(RECV, clock() - begin)
+            on_packet(view, nbytes, address)
+            index = (index + 1) % slots
+        self.ring.index = index
+
+    def drain_msg(self, sock):
+        # like drain(), with ancillary data through recvmsg_into()
+        recvmsg_into = sock.recvmsg_into
+        on_packet = self.on_packet
+        control_size = self.control_size
+        views = self.ring.views
+        slots = len(views)
+        index = self.ring.index
+        stages = self.stages
+        clock = time.perf_counter_ns
+        for _ in range(self.drain_budget):
+            view = views[index]
+            if stages is not None:
+                begin = clock()
+            try:
+                nbytes, ancdata, _flags, address = recvmsg_into([view], control_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                break
+            if stages is not None:
+                stages.add(RECV, clock() - begin)
+            for level, kind, data in ancdata:
+                self.on_control(level, kind, data, 0)
+            on_packet(view, nbytes, address)
+            index = (index + 1) % slots
+        self.ring.index = index
+
+    def drain_batch(self, sock):
+        # like drain(), but one recvmmsg() fills the whole ring at once
+        batch = self.batch
+        on_packet = self.on_packet
+        views = self.ring.views
+        lengths = batch.lengths
+        address = batch.address
+        control_size = self.control_size
+        control = batch.control
+        control_lengths = batch.control_lengths
+        fd = sock.fileno()
+        received = 0
+        stages = self.stages
+        clock = time.perf_counter_ns
+        while received < self.drain_budget:
+            if stages is not None:
+                begin = clock()
+            count = batch.receive(fd)
+            if stages is not None:
+                stages.add(RECV, clock() - begin)
+            for index in range(count):
+                if control_size:
+                    start = index * control_size
+                    self.walk_control(control, start, start + control_lengths[index])
+                on_packet(views[index], lengths[index], address(index))
+            received += count
+            if count < batch.count:
+                break
+
+    def walk_control(self, data, offset, end):
+        # decode a cmsghdr chain laid out in data[offset:end]
+        header_size = CMSGHDR.size
+        while offset + header_size <= end:
+            length, level, kind = CMSGHDR.unpack_from(data, offset)
+            if length < header_size:
+                return
+            self.on_control(level, kind, data, offset + header_size)
+            offset += (length + CMSG_ALIGN - 1) & ~(CMSG_ALIGN - 1)
+
+    def on_control(self, level, kind, data, start):
+        # record one ancillary item whose payload begins at data[start]
+        if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+            self.destination = _UINT32.unpack_from(data, start + _PKTINFO_ADDR_OFFSET)[
+                0
+            ]
+        elif level == socket.SOL_SOCKET:
+            if kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = _TIMESPEC.unpack_from(data, start)
+                self.arrival_ns = seconds * 1000000000 + nanoseconds
+            elif kind == SO_RXQ_OVFL:
+                self.overflows[self.sock] = _UINT32.unpack_from(data, start)[0]
+
+    def kernel_drops(self):
+        # datagrams the kernel dropped because a socket's queue was full
+        return sum(self.overflows.values())
+
+    def stop(self):
+        # safe to call from any thread, including signal handlers
+        self.stopped = True
+        try:
+            self.wake_send.send(b"\x00")
+        except socket.error:
+            pass
+
+    def close(self):
+        self.selector.close()
+        self.wake_recv.close()
+        self.wake_send.close()
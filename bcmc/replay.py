@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# replay.py: provide pcap replay for bcmc servers
+
+# stdlib imports
+import socket
+import time
+
+# app imports
+from .broadcast import BroadcastServer
+from .helpers import SendGuard, ServiceExit
+from .pcap import PcapError, PcapReader
+from .stages import PACE
+
+
+def replay(server, path, speed=1.0):
+    # send the UDP datagrams of the pcap file at path through a broadcast or
+    # multicast server's socket, rewritten to the server's destinations:
+    # each distinct original destination is assigned the next configured
+    # group (round robin) and the server's port. with a --rate/--bandwidth
+    # pacer the capture timing is ignored; otherwise packets keep their
+    # original spacing divided by speed, or go out back to back with speed 0
+    try:
+        reader = PcapReader(path)
+    except (OSError, PcapError) as error:
+        server.write("Error: cannot replay {0}: {1}".format(path, error))
+        raise ServiceExit
+    if isinstance(server, BroadcastServer):
+        sock, kind = server.bc_server_sock, "broadcast"
+    else:
+        sock, kind = server.mc_server_sock, "multicast"
+    destinations = [sender.destination for _packets, sender in server.targets]
+    assigned = {}
+    pacer = server.pacer
+    paced = bool(pacer.rate or pacer.bandwidth)
+    timed = not paced and speed > 0
+    verbose = server.verbose
+    write = server.write
+    reporter = server.reporter
+    counters, slot = server.counters or (None, 0)
+    sendto = sock.sendto
+    time_ns = time.time_ns
+    stages = server.stages
+    clock = time.perf_counter_ns
+    guard = SendGuard.acquire(server.stop_event)
+    first = None
+    records = iter(reader)
+    if paced:
+        timing = pacer.target()
+    elif timed:
+        timing = "{0:g}x capture timing".format(speed)
+    else:
+        timing = "maximum rate"
+    write("Replaying {0} to {1} at {2}".format(path, kind, timing))
+    pacer.start()
+    report_at = reporter.start(time_ns())
+    if stages is not None:
+        stages.start()
+    try:
+        for timestamp_ns, original, payload in records:
+            if server.stop_event.is_set():
+                break
+            if stages is not None:
+                begin = clock()
+            if timed:
+                if first is None:
+                    first = timestamp_ns
+                pacer.schedule((timestamp_ns - first) / 1e9 / speed)
+            pacer.wait()
+            if stages is not None:
+                waited = clock()
+            destination = assigned.get(original)
+            if destination is None:
+                destination = assigned[original] = destinations[
+                    len(assigned) % len(destinations)
+                ]
+            size = len(payload)
+            if stages is not None:
+                built = clock()
+            # a stop arriving from here on waits until the send is counted
+            guard.held = True
+            sendto(payload, destination)
+            if stages is not None:
+                stages.lap(PACE, begin, waited, built, clock())
+            payload = None
+            pacer.sent(size)
+            if counters is not None:
+                counters[slot] = pacer.packets
+                counters[slot + 1] = pacer.bytes
+            guard.held = False
+            now = time_ns()
+            if report_at and now >= report_at:
+                report_at = reporter.tick(pacer, now)
+            if verbose:
+                write(
+                    "Replaying {0} ({1} bytes) -> {2}:{3}".format(
+                        kind, size, destination[0], destination[1]
+                    )
+                )
+        if guard.deferred:
+            # stopped during a send: end the run as the signal would have
+            raise ServiceExit
+    except socket.error as error:
+        write("Error: {0} while replaying {1}".format(error, path))
+        raise ServiceExit
+    finally:
+        guard.release()
+        payload = None
+        records.close()
+        sock.close()
+        server.output.emit(
+            pacer.summary_record(), pacer.summary(None if paced else timing)
+        )
+        if stages is not None:
+            stages.emit(server.output.emit)
+        write(
+            "Replayed {0} of {1} records from {2} ({3} not complete UDP/IPv4 datagrams)".format(
+                pacer.packets, reader.records, path, reader.skipped
+            )
+        )
+        reader.close()
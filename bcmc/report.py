@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# report.py: provide interval reporting and the buffered console writer
+
+# stdlib imports
+import collections
+import sys
+import threading
+import time
+
+# app imports
+from .histogram import format_usec
+from .pacer import format_bits
+
+# above this many streams interval reports show totals only
+STREAM_LINE_LIMIT = 16
+
+
+def format_bytes(count):
+    for unit, scale in (("GiB", 1 << 30), ("MiB", 1 << 20), ("KiB", 1 << 10)):
+        if count >= scale:
+            return "{0:.2f} {1}".format(count / scale, unit)
+    return "{0} bytes".format(count)
+
+
+def interval_label(start, end):
+    return "[{0:7.2f}-{1:7.2f} s]".format(start, end)
+
+
+class ConsoleWriter(threading.Thread):
+    # the send and receive loops hand lines to write(), which appends to a
+    # deque and returns; this thread writes them out in batches. when the
+    # console cannot keep up, lines beyond max_backlog are dropped and
+    # counted instead of slowing down the caller
+
+    def __init__(self, stream=None, flush_interval=0.1, max_backlog=100000):
+        threading.Thread.__init__(self, daemon=True)
+        self.stream = stream or sys.stdout
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.lines = collections.deque()
+        self.dropped = 0
+        self.stop_event = threading.Event()
+
+    def write(self, line):
+        if len(self.lines) >= self.max_backlog:
+            self.dropped += 1
+            return
+        self.lines.append(line)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.stop_event.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        lines = self.lines
+        batch = []
+        while lines:
+            batch.append(lines.popleft())
+        if batch:
+            batch.append("")
+            self.stream.write("\n".join(batch))
+            self.stream.flush()
+
+    def close(self):
+        # stop the thread and write out whatever is still queued
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        if self.dropped:
+            self.stream.write(
+                "console could not keep up: {0} lines dropped\n".format(self.dropped)
+            )
+            self.dropped = 0
+        self.stream.flush()
+
+
+def interval_record(role, start, end, packets, nbytes):
+    elapsed = end - start
+    return {
+        "type": "interval",
+        "role": role,
+        "start": round(start, 6),
+        "end": round(end, 6),
+        "packets": packets,
+        "bytes": nbytes,
+        "pps": packets / elapsed if elapsed > 0 else 0.0,
+        "bps": nbytes * 8 / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+class ServerReport:
+    # one record per interval from the pacer's running totals
+
+    def __init__(self, emit, interval):
+        # emit(record, text) is Output.emit or a stand-in
+        self.emit = emit
+        self.interval_ns = int(interval * 1e9)
+        self.started = 0
+        self.last = 0
+        self.packets = 0
+        self.bytes = 0
+
+    def start(self, now_ns):
+        # returns the time the first report is due, 0 when disabled
+        self.started = self.last = now_ns
+        if not self.interval_ns:
+            return 0
+        return now_ns + self.interval_ns
+
+    def tick(self, pacer, now_ns):
+        # report the interval ending now and return when the next one is due
+        start = (self.last - self.started) / 1e9
+        end = (now_ns - self.started) / 1e9
+        packets = pacer.packets - self.packets
+        sent = pacer.bytes - self.bytes
+        record = interval_record("server", start, end, packets, sent)
+        self.emit(
+            record,
+            "{0} sent {1} packets ({2}) {3:.1f} pps {4}".format(
+                interval_label(start, end),
+                packets,
+                format_bytes(sent),
+                record["pps"],
+                format_bits(record["bps"]),
+            ),
+        )
+        self.packets = pacer.packets
+        self.bytes = pacer.bytes
+        self.last = now_ns
+        return now_ns + self.interval_ns
+
+
+class ListenerReport:
+    # interval and final records for a listener from its running totals and
+    # its StreamTable; per-stream counters are kept as snapshots so the hot
+    # path only ever adds to cumulative counts
+
+    def __init__(self, emit, streams):
+        self.emit = emit
+        self.streams = streams
+        self.started = None
+        self.last = None
+        self.packets = 0
+        self.bytes = 0
+        self.drops = 0
+        # stream id -> [received, bytes, lost] at the previous report
+        self.previous = {}
+
+    def start(self, now=None):
+        self.started = self.last = time.perf_counter() if now is None else now
+
+    def tick(self, packets, nbytes, now=None, drops=None):
+        # report the interval ending now. drops is the running count of
+        # datagrams the kernel dropped from full socket queues, None where
+        # it is not known
+        now = time.perf_counter() if now is None else now
+        if self.started is None:
+            self.start(now)
+            return
+        start = self.last - self.started
+        end = now - self.started
+        self.emit_totals(
+            start,
+            end,
+            packets - self.packets,
+            nbytes - self.bytes,
+            drops=None if drops is None else drops - self.drops,
+        )
+        streams = list(self.streams)
+        for stats in streams:
+            previous = self.previous.get(stats.stream_id)
+            if previous is None:
+                previous = self.previous[stats.stream_id] = [0, 0, 0]
+            if len(streams) <= STREAM_LINE_LIMIT:
+                self.emit_stream(start, end, stats, previous)
+            previous[0] = stats.received
+            previous[1] = stats.bytes
+            previous[2] = stats.lost
+            stats.roll()
+        self.packets = packets
+        self.bytes = nbytes
+        self.drops = drops or 0
+        self.last = now
+
+    def emit_totals(self, start, end, packets, nbytes, kind="interval", drops=None):
+        record = interval_record("listener", start, end, packets, nbytes)
+        record["type"] = kind
+        text = "{0} received {1} packets ({2}) {3:.1f} pps {4}".format(
+            interval_label(start, end),
+            packets,
+            format_bytes(nbytes),
+            record["pps"],
+            format_bits(record["bps"]),
+        )
+        if drops is not None:
+            record["kernel_drops"] = drops
+            text += " kernel drops {0}".format(drops)
+        if kind == "summary" and drops is not None:
+            # whatever the streams lost beyond the socket's own drops went
+            # missing in the network (or was never sent)
+            lost = sum(stats.lost for stats in self.streams)
+            record["lost"] = lost
+            record["network_lost"] = max(0, lost - drops)
+            text += "\nlost {0} packets: {1} dropped by the receive socket, {2} in the network".format(
+                lost, drops, record["network_lost"]
+            )
+        self.emit(record, text)
+
+    def emit_stream(self, start, end, stats, previous):
+        received = stats.received - previous[0]
+        nbytes = stats.bytes - previous[1]
+        lost = stats.lost - previous[2]
+        expected = received + lost
+        record = interval_record("stream", start, end, received, nbytes)
+        record["stream"] = stats.stream_id
+        record["lost"] = lost
+        record["loss_pct"] = 100.0 * lost / expected if expected > 0 else 0.0
+        line = "{0} stream {1}: {2} packets ({3}) {4:.1f} pps {5} lost {6} ({7:.2f}%)".format(
+            interval_label(start, end),
+            stats.stream_id,
+            received,
+            format_bytes(nbytes),
+            record["pps"],
+            format_bits(record["bps"]),
+            lost,
+            record["loss_pct"],
+        )
+        if stats.delay.count:
+            record["jitter_us"] = round(stats.jitter / 1000.0, 3)
+            record["delay_p50_us"] = stats.delay.percentile(50.0)
+            record["delay_p99_us"] = stats.delay.percentile(99.0)
+            line += " jitter {0} delay p50 {1} p99 {2}".format(
+                format_usec(record["jitter_us"]),
+                format_usec(record["delay_p50_us"]),
+                format_usec(record["delay_p99_us"]),
+            )
+        self.emit(record, line)
+
+    def summary(self, packets, nbytes, now=None, drops=None):
+        # the whole-run totals record
+        now = time.perf_counter() if now is None else now
+        started = self.started if self.started is not None else now
+        self.emit_totals(
+            0.0, now - started, packets, nbytes, kind="summary", drops=drops
+        )
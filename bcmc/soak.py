@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+#
+# soak.py: provide the bounded-memory soak mode for bcmc listeners
+
+# stdlib imports
+import collections
+import json
+import os
+import time
+from array import array
+from datetime import datetime
+
+# app imports
+from .helpers import format_rss
+from .histogram import LogHistogram, format_percentiles, format_usec
+
+CHECKPOINT_VERSION = 1
+
+# seconds of per-second counters kept
+WINDOW_SECONDS = 3600
+# minutes of delay histograms kept
+WINDOW_MINUTES = 60
+# outages kept with their timestamps; older ones are only counted
+RECENT_OUTAGES = 1000
+
+# packets seen before gaps are judged against the typical spacing
+WARMUP_PACKETS = 16
+# gaps shorter than this are never an outage, so bursts and jittery low
+# rate senders do not raise false alarms
+MIN_OUTAGE = 0.05
+
+
+def format_time(ns):
+    return datetime.fromtimestamp(ns / 1e9).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+class SoakMonitor:
+    # rolling windows, outage detection and checkpoints for listeners left
+    # running for days. everything is allocated up front: per-second packet,
+    # byte and loss counters in rings of WINDOW_SECONDS, one delay histogram
+    # per minute in a ring of WINDOW_MINUTES and the most recent outages in
+    # a bounded deque, so memory stays flat however long it runs. record()
+    # does O(1) work per packet; rolling a ring slot and writing the
+    # checkpoint happen at most once a second from tick()
+
+    def __init__(self, path, emit, gap=10.0, checkpoint_interval=60.0):
+        # path is the checkpoint file, resumed when it exists; a silence of
+        # more than gap typical packet spacings is an outage
+        self.path = path
+        self.emit = emit
+        self.gap = float(gap)
+        self.checkpoint_ns = int(checkpoint_interval * 1e9)
+        self.packets = array("Q", bytes(8 * WINDOW_SECONDS))
+        self.bytes = array("Q", bytes(8 * WINDOW_SECONDS))
+        self.lost = array("Q", bytes(8 * WINDOW_SECONDS))
+        self.delays = [LogHistogram() for _ in range(WINDOW_MINUTES)]
+        # the second and minute the current ring slots belong to
+        self.second = None
+        self.minute = None
+        self.outages = collections.deque(maxlen=RECENT_OUTAGES)
+        # running totals; the checkpoint adds those of earlier runs
+        self.totals = {
+            "packets": 0,
+            "bytes": 0,
+            "lost": 0,
+            "outages": 0,
+            "downtime": 0.0,
+            "longest": 0.0,
+            "longest_at": None,
+            "seconds": 0.0,
+            "runs": 0,
+            "first_start": None,
+        }
+        self.previous = dict(self.totals)
+        self.received = 0
+        self.received_bytes = 0
+        self.started = time.time_ns()
+        self.last_ns = None
+        # typical spacing of packets in ns, an exponential moving average
+        self.spacing = 0.0
+        self.seen = 0
+        self.silent = False
+        self.lost_seen = 0
+        self.checkpoint_at = self.started + self.checkpoint_ns
+        self.resumed = self.load()
+
+    def load(self):
+        # resume the totals of earlier runs from the checkpoint
+        try:
+            with open(self.path) as source:
+                state = json.load(source)
+        except FileNotFoundError:
+            self.previous["first_start"] = self.started
+            return False
+        except (OSError, ValueError) as error:
+            raise ValueError(
+                "cannot resume from {0}: {1}".format(self.path, error)
+            ) from None
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(
+                "{0} is not a bcmc soak checkpoint of version {1}".format(
+                    self.path, CHECKPOINT_VERSION
+                )
+            )
+        totals = state.get("totals", {})
+        for key in self.previous:
+            if key in totals:
+                self.previous[key] = totals[key]
+        for outage in state.get("recent_outages", []):
+            self.outages.append(tuple(outage))
+        # a restart that took longer than an outage is one
+        self.last_ns = state.get("last_ns")
+        self.spacing = state.get("spacing", 0.0)
+        self.seen = WARMUP_PACKETS if self.last_ns else 0
+        return True
+
+    def record(self, arrival_ns, size, transit_ns=None):
+        # account for one datagram; transit_ns is its one-way delay when the
+        # sender stamped it
+        second = arrival_ns // 1000000000
+        if self.second is None or second > self.second:
+            self.roll(second)
+        self.received += 1
+        self.received_bytes += size
+        slot = second % WINDOW_SECONDS
+        self.packets[slot] += 1
+        self.bytes[slot] += size
+        if transit_ns is not None:
+            self.delays[(second // 60) % WINDOW_MINUTES].record(transit_ns // 1000)
+        last = self.last_ns
+        self.last_ns = arrival_ns
+        if last is None:
+            return
+        gap = arrival_ns - last
+        if self.seen >= WARMUP_PACKETS and gap > self.threshold():
+            self.outage(last, arrival_ns)
+            return
+        self.seen += 1
+        self.spacing += (gap - self.spacing) / 64.0
+
+    def threshold(self):
+        # ns of silence that count as an outage
+        return max(self.gap * self.spacing, MIN_OUTAGE * 1e9)
+
+    def roll(self, second):
+        # clear the ring slots of the seconds (and minutes) being entered,
+        # including any skipped while no packets came in
+        previous = self.second
+        self.second = second
+        if previous is None or second - previous >= WINDOW_SECONDS:
+            start = second - WINDOW_SECONDS + 1
+        else:
+            start = previous + 1
+        for skipped in range(max(start, 0), second + 1):
+            slot = skipped % WINDOW_SECONDS
+            self.packets[slot] = 0
+            self.bytes[slot] = 0
+            self.lost[slot] = 0
+        minute = second // 60
+        if minute != self.minute:
+            first = (
+                minute - WINDOW_MINUTES + 1
+                if self.minute is None or minute - self.minute >= WINDOW_MINUTES
+                else self.minute + 1
+            )
+            for skipped in range(max(first, 0), minute + 1):
+                self.delays[skipped % WINDOW_MINUTES].reset()
+            self.minute = minute
+
+    def outage(self, start_ns, end_ns):
+        seconds = (end_ns - start_ns) / 1e9
+        self.outages.append((start_ns, end_ns))
+        self.totals["outages"] += 1
+        self.totals["downtime"] += seconds
+        if seconds > self.totals["longest"]:
+            self.totals["longest"] = seconds
+            self.totals["longest_at"] = start_ns
+        self.silent = False
+        self.emit(
+            {
+                "type": "outage",
+                "role": "listener",
+                "start": format_time(start_ns),
+                "end": format_time(end_ns),
+                "seconds": round(seconds, 6),
+            },
+            "outage: no packets from {0} to {1} ({2:.3f}s)".format(
+                format_time(start_ns), format_time(end_ns), seconds
+            ),
+        )
+
+    def book(self, now_ns, lost):
+        # add the loss the listener counted since the last call to the
+        # current second
+        second = now_ns // 1000000000
+        if self.second is None or second > self.second:
+            self.roll(second)
+        if lost > self.lost_seen:
+            self.lost[second % WINDOW_SECONDS] += lost - self.lost_seen
+            self.totals["lost"] += lost - self.lost_seen
+        self.lost_seen = lost
+
+    def tick(self, now_ns, lost):
+        # once per report interval: book the loss, flag a silence in
+        # progress and checkpoint when due
+        self.book(now_ns, lost)
+        if (
+            not self.silent
+            and self.last_ns is not None
+            and self.seen >= WARMUP_PACKETS
+            and now_ns - self.last_ns > self.threshold()
+        ):
+            self.silent = True
+            self.emit(
+                {
+                    "type": "outage",
+                    "role": "listener",
+                    "start": format_time(self.last_ns),
+                },
+                "outage: no packets since {0}".format(format_time(self.last_ns)),
+            )
+        if now_ns >= self.checkpoint_at:
+            self.checkpoint_at = now_ns + self.checkpoint_ns
+            self.checkpoint(now_ns)
+            self.status(now_ns)
+
+    def combined(self, now_ns):
+        # totals of this and earlier runs
+        totals = dict(self.totals)
+        totals["packets"] = self.received
+        totals["bytes"] = self.received_bytes
+        totals["seconds"] = (now_ns - self.started) / 1e9
+        totals["runs"] = 1
+        for key in (
+            "packets",
+            "bytes",
+            "lost",
+            "outages",
+            "downtime",
+            "seconds",
+            "runs",
+        ):
+            totals[key] += self.previous[key]
+        if self.previous["longest"] > totals["longest"]:
+            totals["longest"] = self.previous["longest"]
+            totals["longest_at"] = self.previous["longest_at"]
+        totals["first_start"] = self.previous["first_start"]
+        return totals
+
+    def checkpoint(self, now_ns=None):
+        # write the state atomically: a crash leaves the old checkpoint
+        now_ns = now_ns or time.time_ns()
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "written": now_ns,
+            "totals": self.combined(now_ns),
+            "last_ns": self.last_ns,
+            "spacing": self.spacing,
+            "recent_outages": list(self.outages),
+        }
+        temporary = "{0}.tmp".format(self.path)
+        try:
+            with open(temporary, "w") as target:
+                json.dump(state, target)
+                target.flush()
+                os.fsync(target.fileno())
+            os.replace(temporary, self.path)
+        except OSError as error:
+            self.emit(
+                {"type": "error", "role": "listener"},
+                "soak: cannot write checkpoint {0}: {1}".format(self.path, error),
+            )
+
+    def window(self, now_ns):
+        # per-second rate range and loss over the window, and the delay
+        # percentiles of the histograms still in it
+        second = now_ns // 1000000000
+        span = min(WINDOW_SECONDS, max(1, second - self.started // 1000000000))
+        rates = [
+            self.packets[(second - offset) % WINDOW_SECONDS]
+            for offset in range(1, span + 1)
+        ]
+        lost = sum(self.lost)
+        delay = LogHistogram()
+        for histogram in self.delays:
+            delay.add(histogram)
+        return span, rates, lost, delay
+
+    def status(self, now_ns):
+        # the soak status line written with every checkpoint
+        totals = self.combined(now_ns)
+        span, rates, lost, delay = self.window(now_ns)
+        record = {
+            "type": "soak",
+            "role": "listener",
+            "seconds": round(totals["seconds"], 3),
+            "packets": totals["packets"],
+            "bytes": totals["bytes"],
+            "lost": totals["lost"],
+            "outages": totals["outages"],
+            "downtime": round(totals["downtime"], 6),
+            "runs": totals["runs"],
+        }
+        text = "soak: {0} packets in {1:.0f}s over {2} run(s), lost {3}, {4} outage(s) totalling {5:.3f}s; last {6}s: {7}-{8} pps, lost {9}".format(
+            totals["packets"],
+            totals["seconds"],
+            totals["runs"],
+            totals["lost"],
+            totals["outages"],
+            totals["downtime"],
+            span,
+            min(rates),
+            max(rates),
+            lost,
+        )
+        if delay.count:
+            record["delay_p50_us"] = delay.percentile(50.0)
+            record["delay_p99_us"] = delay.percentile(99.0)
+            text += ", delay {0}".format(format_percentiles(delay))
+        text += ", max RSS {0}".format(format_rss())
+        self.emit(record, text)
+
+    def report(self, lost):
+        # final checkpoint and summary when the listener stops
+        now_ns = time.time_ns()
+        self.book(now_ns, lost)
+        self.checkpoint(now_ns)
+        self.status(now_ns)
+        totals = self.combined(now_ns)
+        if totals["longest"]:
+            self.emit(
+                {
+                    "type": "outage",
+                    "role": "longest",
+                    "start": format_time(totals["longest_at"]),
+                    "seconds": round(totals["longest"], 6),
+                },
+                "soak: longest outage {0} from {1}; state saved to {2}".format(
+                    format_usec(totals["longest"] * 1e6),
+                    format_time(totals["longest_at"]),
+                    self.path,
+                ),
+            )
+        else:
+            self.emit(
+                {"type": "checkpoint", "role": "listener"},
+                "soak: no outages; state saved to {0}".format(self.path),
+            )
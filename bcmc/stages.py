@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# stages.py: provide per-stage counters and timers for the send and receive loops,
+# and the start-up milestones of --startup-timing
+
+# stdlib imports
+import time
+from array import array
+
+# app imports
+from .histogram import format_usec
+
+# stages of the send loop, in loop order
+PACE, BUILD, SEND = range(3)
+SEND_STAGES = ("pace", "build", "send")
+
+# stages of the receive loop
+WAIT, RECV, PARSE, RECORD, REPORT = range(5)
+RECEIVE_STAGES = ("wait", "recv", "parse", "record", "report")
+
+
+def format_nanos(nanos):
+    if nanos < 1000:
+        return "{0:.0f} ns".format(nanos)
+    return format_usec(nanos / 1000.0)
+
+
+class StageTimer:
+    # cumulative call counts and nanoseconds per stage of a hot loop. the
+    # loops keep a local `stages` that is None unless --stats-detail is
+    # given, so when disabled each stage boundary costs one `is not None`
+    # test; when enabled a boundary is a perf_counter_ns() call and the
+    # lap is two array additions per stage
+
+    __slots__ = ("role", "names", "calls", "nanos", "started")
+
+    def __init__(self, role, names):
+        self.role = role
+        self.names = names
+        self.calls = array("Q", bytes(8 * len(names)))
+        self.nanos = array("Q", bytes(8 * len(names)))
+        self.started = time.perf_counter_ns()
+
+    def start(self):
+        self.started = time.perf_counter_ns()
+
+    def add(self, stage, elapsed_ns, calls=1):
+        self.calls[stage] += calls
+        self.nanos[stage] += elapsed_ns
+
+    def lap(self, first, *marks):
+        # marks are the clock readings at consecutive stage boundaries,
+        # starting with the boundary ending stage first
+        calls = self.calls
+        nanos = self.nanos
+        previous = marks[0]
+        stage = first
+        for mark in marks[1:]:
+            calls[stage] += 1
+            nanos[stage] += mark - previous
+            previous = mark
+            stage += 1
+
+    def records(self):
+        # (record, text) per stage that ran, then the time not in any stage
+        elapsed = time.perf_counter_ns() - self.started
+        timed = 0
+        for stage, name in enumerate(self.names):
+            calls = self.calls[stage]
+            if not calls:
+                continue
+            nanos = self.nanos[stage]
+            timed += nanos
+            share = 100.0 * nanos / elapsed if elapsed > 0 else 0.0
+            record = {
+                "type": "stage",
+                "role": self.role,
+                "stage": name,
+                "calls": calls,
+                "seconds": round(nanos / 1e9, 6),
+                "mean_ns": round(nanos / calls, 1),
+                "share_pct": round(share, 2),
+            }
+            text = (
+                "{0} stage {1:<7} {2:>12} calls {3:>10.3f} s {4:6.2f}% mean {5}".format(
+                    self.role,
+                    name,
+                    calls,
+                    nanos / 1e9,
+                    share,
+                    format_nanos(nanos / calls),
+                )
+            )
+            yield record, text
+        other = max(0, elapsed - timed)
+        share = 100.0 * other / elapsed if elapsed > 0 else 0.0
+        record = {
+            "type": "stage",
+            "role": self.role,
+            "stage": "other",
+            "seconds": round(other / 1e9, 6),
+            "share_pct": round(share, 2),
+        }
+        yield record, "{0} stage {1:<7} {2:>12} {3:>16.3f} s {4:6.2f}%".format(
+            self.role, "other", "", other / 1e9, share
+        )
+
+    def emit(self, emit):
+        for record, text in self.records():
+            emit(record, text)
+
+
+class StartupTimer:
+    # milestones of a run's start-up for --startup-timing, measured from
+    # when bcmc's __main__ began (the interpreter's own start-up comes
+    # before that). a mark is one perf_counter() call, so marks are always
+    # taken and only reported with the option
+
+    def __init__(self, started):
+        self.started = started
+        self.marks = []
+        self.senders = []
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def watch(self, sender):
+        # a Pacer or StreamServer: its started time is when its send loop
+        # began and sent the first packet
+        self.senders.append(sender)
+
+    def records(self):
+        marks = list(self.marks)
+        sent = [sender.started for sender in self.senders if sender.started]
+        if sent:
+            marks.append(("first packet", min(sent)))
+        previous = self.started
+        for name, at in marks:
+            record = {
+                "type": "startup",
+                "role": "process",
+                "stage": name,
+                "seconds": round(at - self.started, 6),
+            }
+            text = "startup {0:<12} {1:>8.1f} ms (+{2:.1f} ms)".format(
+                name, (at - self.started) * 1e3, (at - previous) * 1e3
+            )
+            previous = at
+            yield record, text
+
+    def emit(self, emit):
+        for record, text in self.records():
+            emit(record, text)
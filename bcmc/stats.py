@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# stats.py: provide receiver-side delivery accounting for bcmc streams
+
+# app imports
+from .histogram import LogHistogram, format_percentiles, format_usec
+
+# number of sequence numbers behind the highest one seen for which
+# duplicates and late arrivals are still told apart
+REORDER_WINDOW = 1024
+_WINDOW_MASK = (1 << REORDER_WINDOW) - 1
+
+
+class StreamStats:
+    # per-stream counters fed by the sequence numbers of received packets
+
+    __slots__ = (
+        "stream_id",
+        "received",
+        "bytes",
+        "lost",
+        "duplicates",
+        "out_of_order",
+        "resets",
+        "highest",
+        "first",
+        "sent_ns",
+        "window",
+        "transit",
+        "jitter",
+        "early",
+        "delay",
+        "ipdv",
+        "delay_total",
+        "ipdv_total",
+    )
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.received = 0
+        self.bytes = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.resets = 0
+        self.highest = None
+        # the first sequence number since the start or the last reset;
+        # nothing below it was ever counted as lost
+        self.first = None
+        # the sender's timestamp of the highest sequence number, 0 if unknown
+        self.sent_ns = 0
+        # bit n set means sequence (highest - n) has been received
+        self.window = 0
+        # one-way delay (arrival - send time) of the previous packet in ns
+        self.transit = None
+        # RFC 3550 interarrival jitter estimate in ns
+        self.jitter = 0.0
+        # packets that arrived before they were sent: the clocks disagree
+        self.early = 0
+        # microsecond histograms of delay and of the per-packet delay
+        # variation |D| for the current interval; roll() folds them into the
+        # run totals
+        self.delay = LogHistogram()
+        self.ipdv = LogHistogram()
+        self.delay_total = LogHistogram()
+        self.ipdv_total = LogHistogram()
+
+    def record(self, sequence, size, sent_ns=0):
+        # sent_ns is the sender's timestamp from the header, 0 if unknown
+        self.received += 1
+        self.bytes += size
+        highest = self.highest
+        if highest is None:
+            self.highest = self.first = sequence
+            self.sent_ns = sent_ns
+            self.window = 1
+            return
+        if sequence > highest:
+            shift = sequence - highest
+            self.lost += shift - 1
+            if shift >= REORDER_WINDOW:
+                self.window = 1
+            else:
+                self.window = ((self.window << shift) | 1) & _WINDOW_MASK
+            self.highest = sequence
+            self.sent_ns = sent_ns
+            return
+        behind = highest - sequence
+        if behind >= REORDER_WINDOW or (self.sent_ns and sent_ns > self.sent_ns):
+            # too far back to be reordering, or sent after the highest one
+            # although numbered below it: the sender restarted
+            self.resets += 1
+            self.highest = self.first = sequence
+            self.sent_ns = sent_ns
+            self.window = 1
+            return
+        bit = 1 << behind
+        if self.window & bit:
+            self.duplicates += 1
+            return
+        self.window |= bit
+        self.out_of_order += 1
+        if sequence > self.first:
+            # a gap counted as lost has been filled by a late packet
+            self.lost -= 1
+
+    def record_transit(self, sent_ns, arrival_ns):
+        # one-way delay from the sender's header timestamp; only meaningful
+        # in absolute terms when both clocks are synchronized, but jitter is
+        # not affected by a constant clock offset
+        transit = arrival_ns - sent_ns
+        if transit < 0:
+            self.early += 1
+        self.delay.record(transit // 1000)
+        previous = self.transit
+        if previous is not None:
+            variation = transit - previous
+            if variation < 0:
+                variation = -variation
+            # J(i) = J(i-1) + (|D(i-1,i)| - J(i-1)) / 16
+            self.jitter += (variation - self.jitter) / 16.0
+            self.ipdv.record(variation // 1000)
+        self.transit = transit
+
+    def roll(self):
+        # end the current interval: fold its histograms into the totals
+        self.delay_total.add(self.delay)
+        self.ipdv_total.add(self.ipdv)
+        self.delay.reset()
+        self.ipdv.reset()
+
+    def latency_summary(self, total=True):
+        # delay and jitter percentiles for the run, or for the interval
+        # since the last roll() with total=False
+        delay = self.delay_total if total else self.delay
+        ipdv = self.ipdv_total if total else self.ipdv
+        if not delay.count:
+            return None
+        line = "stream {0} delay: {1}, jitter {2} (ipdv {3})".format(
+            self.stream_id,
+            format_percentiles(delay),
+            format_usec(self.jitter / 1000.0),
+            format_percentiles(ipdv),
+        )
+        if self.early:
+            line += (
+                ", {0} packets arrived before their send time (clock offset)".format(
+                    self.early
+                )
+            )
+        return line
+
+    def summary_record(self):
+        # run totals as a result record
+        record = {
+            "type": "summary",
+            "role": "stream",
+            "stream": self.stream_id,
+            "packets": self.received,
+            "bytes": self.bytes,
+            "lost": self.lost,
+            "duplicates": self.duplicates,
+            "out_of_order": self.out_of_order,
+            "resets": self.resets,
+        }
+        delay = self.delay_total
+        if delay.count:
+            record.update(
+                early=self.early,
+                jitter_us=round(self.jitter / 1000.0, 3),
+                delay_p50_us=delay.percentile(50.0),
+                delay_p99_us=delay.percentile(99.0),
+                delay_p999_us=delay.percentile(99.9),
+                delay_max_us=delay.max,
+                ipdv_p50_us=self.ipdv_total.percentile(50.0),
+                ipdv_p99_us=self.ipdv_total.percentile(99.0),
+            )
+        return record
+
+    def summary(self):
+        return "stream {0}: received {1} ({2} bytes) lost {3} duplicate {4} out-of-order {5}".format(
+            self.stream_id,
+            self.received,
+            self.bytes,
+            self.lost,
+            self.duplicates,
+            self.out_of_order,
+        )
+
+
+class StreamTable:
+    # map stream ids to their StreamStats
+
+    def __init__(self):
+        self.streams = {}
+
+    def record(self, stream_id, sequence, size, sent_ns=0):
+        stats = self.streams.get(stream_id)
+        if stats is None:
+            stats = self.streams[stream_id] = StreamStats(stream_id)
+        stats.record(sequence, size, sent_ns)
+        return stats
+
+    def __iter__(self):
+        return iter(sorted(self.streams.values(), key=lambda s: s.stream_id))
+
+    def __len__(self):
+        return len(self.streams)
+
+    def lost(self):
+        # packets lost over all streams
+        return sum(stats.lost for stats in self.streams.values())
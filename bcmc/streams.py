@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+#
+# streams.py: provide the many-stream server for bcmc
+#
+# streams are read from a JSON or TOML file; defaults apply to every stream
+# and a multicast group may be a range, giving one stream per address:
+#
+#   {"defaults": {"port": 2002, "rate": 100, "ttl": 3},
+#    "streams": [
+#      {"kind": "multicast", "group": "239.1.0.0/22", "rate": "1k", "dscp": 46},
+#      {"kind": "multicast", "group": "239.2.0.1", "port": 5000, "ttl": 8},
+#      {"kind": "broadcast", "port": 3000, "rate": 10, "payload": "hello"}]}
+
+# stdlib imports
+import socket
+import struct
+import threading
+import time
+from array import array
+
+# app imports
+from .groups import expand_groups
+from .helpers import (
+    SYSTEM,
+    SendGuard,
+    ServiceExit,
+    load_config,
+    quantity,
+    set_buffer_size,
+)
+from .output import PrintOutput
+from .pacer import format_bits
+from .payload import PayloadBuffer
+from .report import STREAM_LINE_LIMIT, format_bytes, interval_label, interval_record
+
+STREAM_KINDS = ("multicast", "broadcast")
+STREAM_FIELDS = (
+    "kind",
+    "group",
+    "port",
+    "rate",
+    "interval",
+    "dscp",
+    "ttl",
+    "padding",
+    "payload",
+    "stream_id",
+)
+
+# refuse configs expanding beyond this many streams
+MAX_STREAMS = 65536
+
+# slots of the timing wheel; a power of two so the slot is a mask away
+WHEEL_SLOTS = 4096
+
+# the wheel tick follows the fastest stream, within these bounds
+MIN_TICK = 0.0001
+MAX_TICK = 0.01
+
+BROADCAST_ADDRESS = "255.255.255.255"
+
+
+def _stream(spec, defaults):
+    # validate one stream entry and return it normalized, group expanded
+    if not isinstance(spec, dict):
+        raise ValueError("a stream must be a table/object, not {0!r}".format(spec))
+    unknown = set(spec) - set(STREAM_FIELDS)
+    if unknown:
+        raise ValueError("unknown stream field(s): {0}".format(", ".join(unknown)))
+    merged = dict(defaults)
+    merged.update(spec)
+    kind = str(merged.get("kind", "multicast")).lower()
+    if kind not in STREAM_KINDS:
+        raise ValueError(
+            "stream kind must be multicast or broadcast, not {0!r}".format(kind)
+        )
+    stream = {"kind": kind}
+    port = int(quantity(merged.get("port", 2002), "port", 1))
+    if port > 65535:
+        raise ValueError("port must be at most 65535")
+    stream["port"] = port
+    if merged.get("rate") is not None:
+        stream["rate"] = quantity(merged["rate"], "rate")
+    elif merged.get("interval") is not None:
+        interval = quantity(merged["interval"], "interval")
+        stream["rate"] = 1.0 / interval if interval else 0.0
+    else:
+        stream["rate"] = 1.0
+    if stream["rate"] <= 0:
+        raise ValueError("stream rate must be positive")
+    stream["dscp"] = int(quantity(merged.get("dscp", 0), "dscp"))
+    if stream["dscp"] > 63:
+        raise ValueError("dscp must be at most 63")
+    stream["ttl"] = int(quantity(merged.get("ttl", 3), "ttl", 1))
+    if stream["ttl"] > 255:
+        raise ValueError("ttl must be at most 255")
+    stream["padding"] = int(quantity(merged.get("padding", 0), "padding"))
+    stream["payload"] = merged.get("payload")
+    stream["stream_id"] = merged.get("stream_id")
+    if kind == "broadcast":
+        stream["groups"] = [BROADCAST_ADDRESS]
+    else:
+        group = merged.get("group")
+        if not group:
+            raise ValueError("a multicast stream needs a group")
+        stream["groups"] = expand_groups(str(group))
+    return stream
+
+
+def load_streams(path):
+    # the stream entries of a .json/.toml file
+    config = load_config(path)
+    defaults = config.get("defaults", {})
+    if not isinstance(defaults, dict):
+        raise ValueError("defaults must be a table/object")
+    specs = config.get("streams")
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("{0} has no list of streams".format(path))
+    streams = [_stream(spec, defaults) for spec in specs]
+    if sum(len(stream["groups"]) for stream in streams) > MAX_STREAMS:
+        raise ValueError("more than {0} streams configured".format(MAX_STREAMS))
+    return streams
+
+
+class StreamServer:
+    # send many independent streams from one thread. every stream has its
+    # own destination, rate and preallocated payload; sockets are shared by
+    # streams with the same kind, TTL and DSCP. sends are driven by a hashed
+    # timing wheel: a stream waits in the slot of its next deadline, each
+    # tick visits one slot, so the cost per send does not grow with the
+    # number of streams. per-stream state lives in parallel arrays indexed
+    # by stream number
+
+    def __init__(
+        self,
+        streams,
+        host=None,
+        header=False,
+        stream_id=0,
+        verbose=True,
+        report_interval=0,
+        output=None,
+        sndbuf=0,
+    ):
+        self.host = host
+        self.hostname = socket.gethostname()
+        self.header = header
+        self.verbose = verbose
+        self.sndbuf = sndbuf
+        self.stop_event = threading.Event()
+        self.output = output or PrintOutput()
+        self.write = self.output.write
+        self.report_interval = float(report_interval or 0)
+        self.sockets = {}
+        # per stream: destination, payload, sendto of its socket, the rate
+        # it was configured with and its stream id
+        self.destinations = []
+        self.payloads = []
+        self.senders = []
+        self.kinds = []
+        self.ids = []
+        self.periods = array("d")
+        self.sizes = array("Q")
+        next_id = int(stream_id)
+        for stream in streams:
+            sock = self.socket_for(stream)
+            if stream["stream_id"] is not None:
+                # a range of groups counts up from the given id
+                next_id = int(stream["stream_id"])
+            for group in stream["groups"]:
+                number = next_id
+                next_id += 1
+                payload = PayloadBuffer(
+                    "{0} from {1} to {2}:{3}".format(
+                        stream["kind"], self.hostname, group, stream["port"]
+                    ),
+                    padding=stream["padding"],
+                    payload=stream["payload"],
+                    header=header,
+                    stream_id=number,
+                )
+                self.destinations.append((group, stream["port"]))
+                self.payloads.append(payload)
+                self.senders.append(sock.sendto)
+                self.kinds.append(stream["kind"])
+                self.ids.append(number)
+                self.periods.append(1.0 / stream["rate"])
+                self.sizes.append(payload.size)
+        count = len(self.payloads)
+        # running counters and schedule, one entry per stream
+        self.sent = array("Q", bytes(8 * count))
+        self.deadlines = array("d", bytes(8 * count))
+        self.due = array("q", bytes(8 * count))
+        # the tick resolves the fastest stream's period a few times over;
+        # faster streams send several packets per visit
+        self.tick = min(MAX_TICK, max(MIN_TICK, min(self.periods) / 4))
+        self.wheel = [[] for _ in range(WHEEL_SLOTS)]
+        # like the Pacer, never fall further behind than this
+        self.max_lag = max(0.1, 10 * self.tick)
+        self.started = None
+        self.stopped = None
+        self.write(
+            "Streams: {0} streams on {1} sockets, {2:.1f} pps offered, timing wheel tick {3:.0f} us".format(
+                count,
+                len(self.sockets),
+                sum(1.0 / period for period in self.periods),
+                self.tick * 1e6,
+            )
+        )
+
+    def socket_for(self, stream):
+        # the shared socket of the stream's kind, TTL and DSCP
+        key = (stream["kind"], stream["ttl"], stream["dscp"])
+        sock = self.sockets.get(key)
+        if sock is not None:
+            return sock
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        except socket.error as e:
+            print("Socket could not be created. Error Code : %s" % e)
+            raise ServiceExit
+        sock.settimeout(0.2)
+        if stream["kind"] == "broadcast":
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        else:
+            sock.setsockopt(
+                socket.IPPROTO_IP,
+                socket.IP_MULTICAST_TTL,
+                struct.pack("b", stream["ttl"]),
+            )
+            if self.host:
+                sock.setsockopt(
+                    socket.IPPROTO_IP,
+                    socket.IP_MULTICAST_IF,
+                    socket.inet_aton(self.host),
+                )
+        if stream["dscp"]:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, stream["dscp"] << 2)
+        if SYSTEM in ("Linux", "Darwin"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.sndbuf:
+            set_buffer_size(sock, socket.SO_SNDBUF, self.sndbuf)
+        self.sockets[key] = sock
+        return sock
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def serve(self):
+        wheel = self.wheel
+        mask = WHEEL_SLOTS - 1
+        tick = self.tick
+        max_lag = self.max_lag
+        deadlines = self.deadlines
+        periods = self.periods
+        due = self.due
+        sent = self.sent
+        payloads = self.payloads
+        senders = self.senders
+        destinations = self.destinations
+        verbose = self.verbose
+        write = self.write
+        clock = time.perf_counter
+        time_ns = time.time_ns
+        sleep = time.sleep
+        count = len(payloads)
+        # spread the first sends over each stream's period rather than
+        # starting every stream at once
+        for index in range(count):
+            deadline = periods[index] * index / count
+            deadlines[index] = deadline
+            due[index] = int(deadline / tick) + 1
+            wheel[due[index] & mask].append(index)
+        self.started = origin = clock()
+        report_every = self.report_interval
+        report_at = report_every
+        reported = [0.0, 0, 0]
+        cursor = 0
+        guard = SendGuard.acquire(self.stop_event)
+        try:
+            while not self.stop_event.is_set():
+                elapsed = clock() - origin
+                current = int(elapsed / tick)
+                while cursor <= current:
+                    slot = cursor & mask
+                    bucket = wheel[slot]
+                    if bucket:
+                        waiting = wheel[slot] = []
+                        now_ns = time_ns()
+                        for index in bucket:
+                            if due[index] > cursor:
+                                # a slow stream, due on a later turn
+                                waiting.append(index)
+                                continue
+                            deadline = deadlines[index]
+                            if elapsed - deadline > max_lag:
+                                deadline = elapsed
+                            payload = payloads[index]
+                            sendto = senders[index]
+                            destination = destinations[index]
+                            period = periods[index]
+                            sequence = sent[index]
+                            # a stop arriving from here on waits until the
+                            # sends are counted
+                            guard.held = True
+                            while deadline <= elapsed:
+                                sequence += 1
+                                payload.update(sequence, now_ns)
+                                sendto(payload.buffer, destination)
+                                deadline += period
+                            sent[index] = sequence
+                            guard.held = False
+                            deadlines[index] = deadline
+                            target = int(deadline / tick) + 1
+                            due[index] = target
+                            wheel[target & mask].append(index)
+                            if verbose:
+                                write(
+                                    "Sending {0} ({1} bytes) -> {2}".format(
+                                        self.kinds[index],
+                                        payload.size,
+                                        payload.message(),
+                                    )
+                                )
+                    cursor += 1
+                if report_at and elapsed >= report_at:
+                    self.report(reported, elapsed)
+                    report_at += report_every
+                remaining = cursor * tick - (clock() - origin)
+                if remaining > 0:
+                    sleep(remaining)
+            if guard.deferred:
+                # stopped during a send: end the run as the signal would have
+                raise ServiceExit
+        except socket.error as error:
+            self.write("Error: {0} sending streams".format(error))
+            raise ServiceExit
+        finally:
+            guard.release()
+            self.stopped = clock()
+            for sock in self.sockets.values():
+                sock.close()
+            self.summary()
+
+    def totals(self):
+        packets = sum(self.sent)
+        nbytes = sum(sent * size for sent, size in zip(self.sent, self.sizes))
+        return packets, nbytes
+
+    def report(self, reported, elapsed):
+        # the interval record over all streams; reported holds the end,
+        # packets and bytes of the previous one
+        packets, nbytes = self.totals()
+        start = reported[0]
+        record = interval_record(
+            "server", start, elapsed, packets - reported[1], nbytes - reported[2]
+        )
+        self.output.emit(
+            record,
+            "{0} sent {1} packets ({2}) {3:.1f} pps {4} on {5} streams".format(
+                interval_label(start, elapsed),
+                record["packets"],
+                format_bytes(record["bytes"]),
+                record["pps"],
+                format_bits(record["bps"]),
+                len(self),
+            ),
+        )
+        reported[:] = [elapsed, packets, nbytes]
+
+    def summary(self):
+        # a record per stream (printed for the first few) and the totals
+        elapsed = (self.stopped or time.perf_counter()) - self.started
+        emit = self.output.emit
+        for index in range(len(self)):
+            sent = self.sent[index]
+            record = interval_record(
+                "stream", 0.0, elapsed, sent, sent * self.sizes[index]
+            )
+            record["type"] = "summary"
+            record["stream"] = self.ids[index]
+            record["group"] = "{0}:{1}".format(*self.destinations[index])
+            record["target_pps"] = 1.0 / self.periods[index]
+            text = None
+            if len(self) <= STREAM_LINE_LIMIT:
+                text = "stream {0} {1} to {2}: sent {3} packets {4:.1f} pps (target {5:.1f} pps)".format(
+                    record["stream"],
+                    self.kinds[index],
+                    record["group"],
+                    sent,
+                    record["pps"],
+                    record["target_pps"],
+                )
+            emit(record, text)
+        packets, nbytes = self.totals()
+        record = interval_record("server", 0.0, elapsed, packets, nbytes)
+        record["type"] = "summary"
+        record["target_pps"] = sum(1.0 / period for period in self.periods)
+        emit(
+            record,
+            "Sent {0} packets ({1} bytes) on {2} streams in {3:.3f}s: achieved {4:.1f} pps {5} (target {6:.1f} pps)".format(
+                packets,
+                nbytes,
+                len(self),
+                elapsed,
+                record["pps"],
+                format_bits(record["bps"]),
+                record["target_pps"],
+            ),
+        )
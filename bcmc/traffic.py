@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# traffic.py: provide scripted traffic profiles for bcmc servers
+#
+# a profile is a list of phases, each lasting duration seconds:
+#   constant  rate pps
+#   ramp      rate changing linearly from start_rate to end_rate pps
+#   burst     rate pps for on seconds, then silence for off seconds, repeated
+#   poisson   exponential inter-arrival times averaging rate pps, seeded
+#
+# given as a JSON or TOML file
+#   {"repeat": false, "phases": [{"kind": "ramp", "from": 100, "to": "5k",
+#    "duration": 30}, {"kind": "poisson", "rate": 1000, "duration": 10,
+#    "seed": 7}]}
+# or as shorthand on the command line
+#   constant:1k:10,ramp:100-5k:30,burst:20k:0.1/0.9:10,poisson:1k:10:7[,repeat]
+
+# stdlib imports
+import math
+import os
+import random
+import time
+from array import array
+
+# app imports
+from .helpers import load_config, quantity
+
+PHASE_KINDS = ("constant", "ramp", "burst", "poisson")
+
+# deadlines are precomputed at 8 bytes each; above this many the profile is
+# refused rather than allocating gigabytes (--burst divides the count)
+MAX_DEADLINES = 50000000
+
+
+def _phase(spec):
+    # validate one phase mapping and return it normalized
+    if not isinstance(spec, dict):
+        raise ValueError("a phase must be a table/object, not {0!r}".format(spec))
+    kind = str(spec.get("kind", "")).lower()
+    if kind == "const":
+        kind = "constant"
+    if kind not in PHASE_KINDS:
+        raise ValueError(
+            "phase kind must be one of {0}, not {1!r}".format(
+                ", ".join(PHASE_KINDS), spec.get("kind")
+            )
+        )
+    phase = {"kind": kind}
+    phase["duration"] = quantity(spec.get("duration"), "duration")
+    if phase["duration"] <= 0:
+        raise ValueError("{0} phase duration must be positive".format(kind))
+    if kind == "ramp":
+        phase["start_rate"] = quantity(spec.get("from", spec.get("start_rate")), "from")
+        phase["end_rate"] = quantity(spec.get("to", spec.get("end_rate")), "to")
+        if not phase["start_rate"] and not phase["end_rate"]:
+            raise ValueError("a ramp needs a non-zero from or to rate")
+        return phase
+    phase["rate"] = quantity(spec.get("rate"), "rate")
+    if phase["rate"] <= 0:
+        raise ValueError("{0} phase rate must be positive".format(kind))
+    if kind == "burst":
+        phase["on"] = quantity(spec.get("on"), "on")
+        phase["off"] = quantity(spec.get("off", 0), "off")
+        if phase["on"] <= 0:
+            raise ValueError("burst on time must be positive")
+    elif kind == "poisson":
+        seed = spec.get("seed")
+        # without a seed pick one, so the run can be repeated exactly
+        phase["seed"] = int(seed) if seed is not None else random.randrange(1 << 32)
+    return phase
+
+
+def parse_shorthand(text):
+    # constant:RATE:SECS ramp:FROM-TO:SECS burst:RATE:ON/OFF:SECS
+    # poisson:RATE:SECS[:SEED], comma separated, optionally ending in repeat
+    phases = []
+    repeat = False
+    for item in text.split(","):
+        fields = [field.strip() for field in item.strip().split(":")]
+        kind = fields[0].lower()
+        if kind == "repeat" and len(fields) == 1:
+            repeat = True
+            continue
+        try:
+            if kind in ("constant", "const") and len(fields) == 3:
+                spec = dict(kind=kind, rate=fields[1], duration=fields[2])
+            elif kind == "ramp" and len(fields) == 3 and "-" in fields[1]:
+                start, end = fields[1].split("-", 1)
+                spec = dict(
+                    kind=kind, start_rate=start, end_rate=end, duration=fields[2]
+                )
+            elif kind == "burst" and len(fields) == 4 and "/" in fields[2]:
+                on, off = fields[2].split("/", 1)
+                spec = dict(
+                    kind=kind, rate=fields[1], on=on, off=off, duration=fields[3]
+                )
+            elif kind == "poisson" and len(fields) in (3, 4):
+                spec = dict(kind=kind, rate=fields[1], duration=fields[2])
+                if len(fields) == 4:
+                    spec["seed"] = int(fields[3])
+            else:
+                raise ValueError("cannot read phase {0!r}".format(item))
+        except ValueError as error:
+            raise ValueError("{0} (see --help for the shorthand)".format(error))
+        phases.append(_phase(spec))
+    return {"phases": phases, "repeat": repeat}
+
+
+def load_profile(value):
+    # a profile from a .json/.toml file or from shorthand
+    if not (os.path.isfile(value) or value.endswith((".json", ".toml"))):
+        return parse_shorthand(value)
+    spec = load_config(value)
+    if not isinstance(spec.get("phases"), list):
+        raise ValueError("{0} has no list of phases".format(value))
+    if not spec["phases"]:
+        raise ValueError("{0} has no phases".format(value))
+    return {
+        "phases": [_phase(phase) for phase in spec["phases"]],
+        "repeat": bool(spec.get("repeat", False)),
+    }
+
+
+def describe(phase):
+    kind = phase["kind"]
+    if kind == "ramp":
+        text = "ramp {0:g}-{1:g} pps".format(phase["start_rate"], phase["end_rate"])
+    elif kind == "burst":
+        text = "burst {0:g} pps {1:g}s on/{2:g}s off".format(
+            phase["rate"], phase["on"], phase["off"]
+        )
+    elif kind == "poisson":
+        text = "poisson {0:g} pps seed {1}".format(phase["rate"], phase["seed"])
+    else:
+        text = "constant {0:g} pps".format(phase["rate"])
+    return "{0} for {1:g}s".format(text, phase["duration"])
+
+
+def mean_rate(phase):
+    # average packets per second the phase asks for
+    kind = phase["kind"]
+    if kind == "ramp":
+        return (phase["start_rate"] + phase["end_rate"]) / 2
+    if kind == "burst":
+        return phase["rate"] * min(1.0, phase["on"] / (phase["on"] + phase["off"]))
+    return phase["rate"]
+
+
+def _deadlines(phase, rate_divisor):
+    # send times in seconds from the start of the phase, for sends of
+    # rate_divisor packets each
+    kind = phase["kind"]
+    duration = phase["duration"]
+    if kind == "constant":
+        step = rate_divisor / phase["rate"]
+        return (index * step for index in range(int(duration / step + 1e-9)))
+    if kind == "ramp":
+        # the k-th send is where the integral of the rate reaches k
+        start = phase["start_rate"] / rate_divisor
+        end = phase["end_rate"] / rate_divisor
+        slope = (end - start) / duration
+        count = int((start + end) * duration / 2)
+        if not slope:
+            return (index / start for index in range(count))
+        return (
+            (math.sqrt(start * start + 2 * slope * index) - start) / slope
+            for index in range(count)
+        )
+    if kind == "burst":
+        step = rate_divisor / phase["rate"]
+        period = phase["on"] + phase["off"]
+        per_burst = max(1, int(phase["on"] / step))
+        cycles = int(math.ceil(duration / period))
+        return (
+            offset
+            for offset in (
+                cycle * period + index * step
+                for cycle in range(cycles)
+                for index in range(per_burst)
+            )
+            if offset < duration
+        )
+    return _poisson(phase["rate"] / rate_divisor, duration, phase["seed"])
+
+
+def _poisson(rate, duration, seed):
+    generator = random.Random(seed)
+    expovariate = generator.expovariate
+    offset = expovariate(rate)
+    while offset < duration:
+        yield offset
+        offset += expovariate(rate)
+
+
+class TrafficSchedule:
+    # every send deadline of a profile, precomputed into one array of
+    # offsets from the start, plus where each phase begins and ends in it.
+    # the send loop calls advance() before pacer.wait(); that hands the next
+    # offset to Pacer.schedule() and only does more at phase boundaries
+
+    def __init__(self, profile, burst=1):
+        # with --burst every deadline sends burst packets, so the deadlines
+        # come at rate / burst
+        self.phases = profile["phases"]
+        self.repeat = profile["repeat"]
+        self.burst = burst
+        expected = sum(mean_rate(phase) * phase["duration"] for phase in self.phases)
+        if expected / burst > MAX_DEADLINES:
+            raise ValueError(
+                "traffic profile needs about {0:.0f} deadlines, more than {1}; shorten it or raise --burst".format(
+                    expected / burst, MAX_DEADLINES
+                )
+            )
+        started = time.perf_counter()
+        self.offsets = array("d")
+        self.first = []
+        self.last = []
+        self.starts = []
+        position = 0.0
+        for phase in self.phases:
+            self.first.append(len(self.offsets))
+            self.starts.append(position)
+            self.offsets.extend(
+                position + offset for offset in _deadlines(phase, burst)
+            )
+            self.last.append(len(self.offsets))
+            position += phase["duration"]
+        if not self.offsets:
+            raise ValueError("traffic profile does not send any packets")
+        self.duration = position
+        self.build_time = time.perf_counter() - started
+        # progress: next offset, end of the current phase, offset base of
+        # the current repetition
+        self.phase = -1
+        self.index = 0
+        self.boundary = 0
+        self.base = 0.0
+        self.entered = 0.0
+        self.entered_packets = 0
+        # per phase, over all repetitions
+        self.entries = [0] * len(self.phases)
+        self.planned = [0] * len(self.phases)
+        self.sent = [0] * len(self.phases)
+        self.elapsed = [0.0] * len(self.phases)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def label(self):
+        return "traffic profile of {0} phases{1}".format(
+            len(self.phases), ", repeated" if self.repeat else ""
+        )
+
+    def advance(self, pacer):
+        # set the pacer's next deadline; False once the profile is over
+        index = self.index
+        if index >= self.boundary:
+            if not self.next_phase(pacer):
+                return False
+            index = self.index
+        pacer.schedule(self.base + self.offsets[index])
+        self.index = index + 1
+        return True
+
+    def next_phase(self, pacer):
+        # close the current phase at its scheduled end (or now, if running
+        # late) and enter the next phase that has sends in it
+        phase = self.phase
+        base = self.base
+        while True:
+            phase += 1
+            if phase == len(self.phases):
+                if not self.repeat:
+                    self.close(pacer, pacer.origin + base + self.duration)
+                    self.phase = None
+                    return False
+                phase = 0
+                base += self.duration
+            if self.last[phase] > self.first[phase]:
+                break
+        self.close(pacer, pacer.origin + base + self.starts[phase])
+        self.phase = phase
+        self.base = base
+        self.index = self.first[phase]
+        self.boundary = self.last[phase]
+        self.entries[phase] += 1
+        self.planned[phase] += (self.last[phase] - self.first[phase]) * self.burst
+        self.entered = max(
+            time.perf_counter(), pacer.origin + base + self.starts[phase]
+        )
+        self.entered_packets = pacer.packets
+        return True
+
+    def close(self, pacer, scheduled_end=None):
+        # account for the phase being left
+        if self.phase is None or self.phase < 0:
+            return
+        now = time.perf_counter()
+        end = max(now, scheduled_end) if scheduled_end is not None else now
+        self.sent[self.phase] += pacer.packets - self.entered_packets
+        self.elapsed[self.phase] += max(0.0, end - self.entered)
+        self.phase = None
+
+    def report(self, pacer, emit):
+        # per phase achieved versus intended rate, once sending has stopped
+        self.close(pacer)
+        for number, phase in enumerate(self.phases):
+            planned = self.planned[number]
+            if not planned:
+                continue
+            intended = planned / (phase["duration"] * self.entries[number])
+            elapsed = self.elapsed[number]
+            achieved = self.sent[number] / elapsed if elapsed > 0 else 0.0
+            record = {
+                "type": "phase",
+                "role": "server",
+                "phase": number + 1,
+                "shape": describe(phase),
+                "seconds": round(elapsed, 6),
+                "packets": self.sent[number],
+                "planned": planned,
+                "pps": achieved,
+                "target_pps": intended,
+            }
+            emit(
+                record,
+                "phase {0} {1}: intended {2:.1f} pps ({3} packets), achieved {4:.1f} pps ({5} packets in {6:.3f}s, {7:+.1f}%)".format(
+                    number + 1,
+                    describe(phase),
+                    intended,
+                    planned,
+                    achieved,
+                    self.sent[number],
+                    elapsed,
+                    100.0 * (achieved - intended) / intended if intended else 0.0,
+                ),
+            )
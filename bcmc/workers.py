@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# workers.py: provide multi-process sender sharding for bcmc servers
+
+# stdlib imports
+import multiprocessing
+import signal
+import sys
+import time
+
+# app imports
+from .broadcast import BroadcastServer
+from .helpers import ServiceExit
+from .multicast import MulticastServer
+from .output import PrintOutput
+from .pacer import format_bits
+from .report import interval_record
+
+# layout of the shared counter block: a stop flag followed by packets and
+# bytes per worker. each slot has a single writer, so no locks are needed
+_STOP = 0
+_FIELDS = 2
+
+
+def _counter_view(block):
+    return memoryview(block).cast("B").cast("Q")
+
+
+class SharedFlag:
+    # stop flag living in the shared counter block; polled by the send loops
+    # in place of a threading.Event
+
+    def __init__(self, view, slot):
+        self.view = view
+        self.slot = slot
+
+    def is_set(self):
+        return self.view[self.slot] != 0
+
+    def set(self):
+        self.view[self.slot] = 1
+
+
+def _scale(options, share):
+    # give a worker share (0..1] of the offered load
+    options = dict(options)
+    if options.get("rate"):
+        options["rate"] = options["rate"] * share
+    if options.get("bandwidth"):
+        options["bandwidth"] = options["bandwidth"] * share
+    if float(options["interval"]) > 0:
+        options["interval"] = float(options["interval"]) / share
+    return options
+
+
+def partition(options, workers):
+    # split server options into one set per worker. with at least as many
+    # multicast groups as workers each worker sends its own contiguous block
+    # of groups (keeping their stream ids); otherwise every worker sends to
+    # all destinations and they interleave one sequence space per stream
+    groups = options.get("group")
+    if isinstance(groups, list) and len(groups) >= workers:
+        shares = []
+        start = 0
+        for index in range(workers):
+            end = start + (len(groups) - start) // (workers - index)
+            share = _scale(options, (end - start) / len(groups))
+            share["group"] = groups[start:end]
+            share["stream_id"] = options.get("stream_id", 0) + start
+            shares.append(share)
+            start = end
+        return shares
+    shares = []
+    for index in range(workers):
+        share = _scale(options, 1.0 / workers)
+        share["sequence_start"] = index + 1
+        share["sequence_step"] = workers
+        shares.append(share)
+    return shares
+
+
+def _worker(kind, options, index, block):
+    # child processes leave SIGINT to the parent, which stops them through
+    # the shared flag
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # keep per-worker chatter out of result records written to stdout
+    sys.stdout = sys.stderr
+    counters = _counter_view(block)
+    options = dict(options, verbose=False, counters=(counters, 1 + index * _FIELDS))
+    try:
+        if kind == "multicast":
+            server = MulticastServer(**options)
+            server.stop_event = SharedFlag(counters, _STOP)
+            server.multicast()
+        else:
+            server = BroadcastServer(**options)
+            server.stop_event = SharedFlag(counters, _STOP)
+            server.broadcast()
+    except ServiceExit:
+        pass
+
+
+def run_workers(kind, options, workers, report_interval=1.0, output=None):
+    # run a broadcast or multicast server as workers processes and report the
+    # aggregate rate every report_interval seconds until stopped; the workers
+    # themselves stay quiet
+    output = output or PrintOutput()
+    options = dict(options, verbose=False, report_interval=0, output=None)
+    block = multiprocessing.RawArray("Q", 1 + workers * _FIELDS)
+    counters = _counter_view(block)
+    processes = [
+        multiprocessing.Process(
+            target=_worker, args=(kind, share, index, block), daemon=True
+        )
+        for index, share in enumerate(partition(options, workers))
+    ]
+
+    def totals():
+        packets = sum(counters[1 + i * _FIELDS] for i in range(workers))
+        sent = sum(counters[2 + i * _FIELDS] for i in range(workers))
+        return packets, sent
+
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    output.write("Started {0} {1} workers".format(workers, kind))
+    last_packets, last_bytes, last_time = 0, 0, started
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(report_interval or 1.0)
+            if not report_interval:
+                continue
+            packets, sent = totals()
+            now = time.perf_counter()
+            record = interval_record(
+                "server",
+                last_time - started,
+                now - started,
+                packets - last_packets,
+                sent - last_bytes,
+            )
+            record["workers"] = workers
+            output.emit(
+                record,
+                "[{0} workers] {1} packets, {2:.1f} pps {3}".format(
+                    workers, packets, record["pps"], format_bits(record["bps"])
+                ),
+            )
+            last_packets, last_bytes, last_time = packets, sent, now
+    except ServiceExit:
+        pass
+    finally:
+        SharedFlag(counters, _STOP).set()
+        for process in processes:
+            try:
+                process.join(2.0)
+            except ServiceExit:
+                # a repeated stop request, e.g. SIGINT sent to the process
+                # and again to its process group
+                pass
+            if process.is_alive():
+                process.terminate()
+        packets, sent = totals()
+        elapsed = time.perf_counter() - started
+        record = interval_record("server", 0.0, elapsed, packets, sent)
+        record.update(type="summary", seconds=round(elapsed, 6), workers=workers)
+        output.emit(
+            record,
+            "Workers sent {0} packets ({1} bytes) in {2:.3f}s: {3:.1f} pps {4}".format(
+                packets,
+                sent,
+                elapsed,
+                record["pps"],
+                format_bits(record["bps"]),
+            ),
+        )
@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+#
+# loopback.py: benchmark bcmc servers and listeners over loopback on Linux
+#
+# runs `python -m bcmc` server and client processes against each other on
+# this host across payload sizes, rates, group and stream counts, and writes
+# the sent/received rates, CPU time per packet, kernel receive drops and
+# startup times as JSON. for each traffic kind it then bisects --rate for
+# the highest rate of 64 byte datagrams delivered with at most --max-loss
+# percent loss, the maximum sustainable rate. with --baseline the run is
+# compared against an earlier result file and exits 1 when a metric
+# regressed by more than --threshold percent.
+#
+#   python benchmarks/loopback.py --output bench.json
+#   python benchmarks/loopback.py --baseline bench.json --threshold 10
+#
+# multicast runs are bound to 127.0.0.1 and need no network. broadcast runs
+# need a route for 255.255.255.255 and are skipped without one.
+
+# stdlib imports
+import argparse
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# the `python -m bcmc` children run the checkout; import from it too
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app imports
+from bcmc.header import HEADER_SIZE
+
+LOOPBACK = "127.0.0.1"
+BASE_GROUP = "239.77.0.0"
+
+# metric -> True when higher is better
+METRICS = {
+    "send_pps": True,
+    "recv_pps": True,
+    "server_cpu_us_per_packet": False,
+    "client_cpu_us_per_packet": False,
+}
+STARTUP_METRICS = ("version_s", "ready_s")
+
+# a paced probe that sends less than this share of its rate did not get
+# to test that rate
+ACHIEVED = 0.95
+
+
+def parse_list(value, kind=int):
+    return [kind(item) for item in value.split(",") if item]
+
+
+def parse_rate(value):
+    return None if value == "max" else float(value)
+
+
+def bcmc(*args):
+    return [sys.executable, "-m", "bcmc"] + [str(arg) for arg in args]
+
+
+def wait_child(process):
+    # reap a child and return its CPU seconds (user + system)
+    _pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+def udp_sockets(port):
+    # [(inode, drops)] of the UDP sockets bound to port, from /proc/net/udp
+    sockets = []
+    suffix = ":{0:04X}".format(port)
+    with open("/proc/net/udp") as table:
+        next(table)
+        for line in table:
+            fields = line.split()
+            if fields[1].endswith(suffix):
+                sockets.append((fields[9], int(fields[12])))
+    return sockets
+
+
+def read_records(path):
+    records = []
+    if os.path.exists(path):
+        with open(path) as results:
+            for line in results:
+                line = line.strip()
+                if line.startswith("{"):
+                    records.append(json.loads(line))
+    return records
+
+
+def broadcast_available():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.connect(("255.255.255.255", 9))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def group_spec(groups):
+    if groups == 1:
+        return BASE_GROUP
+    last = socket.inet_ntoa(
+        (int.from_bytes(socket.inet_aton(BASE_GROUP), "big") + groups - 1).to_bytes(
+            4, "big"
+        )
+    )
+    return "{0}-{1}".format(BASE_GROUP, last)
+
+
+def scenario_name(scenario):
+    return "{kind}-{size}B-{rate}-g{groups}-s{streams}".format(
+        kind=scenario["kind"],
+        size=scenario["size"],
+        rate="max" if scenario["rate"] is None else "{0:g}pps".format(scenario["rate"]),
+        groups=scenario["groups"],
+        streams=scenario["streams"],
+    )
+
+
+def scenarios(args):
+    # one factor at a time around a 64 byte, unpaced, single stream base
+    matrix = []
+
+    def add(kind, size=64, rate=None, groups=1, streams=1):
+        scenario = dict(kind=kind, size=size, rate=rate, groups=groups, streams=streams)
+        scenario["name"] = scenario_name(scenario)
+        if scenario["name"] not in [item["name"] for item in matrix]:
+            matrix.append(scenario)
+
+    for kind in args.kinds:
+        for size in args.sizes:
+            add(kind, size=size)
+        for rate in args.rates:
+            add(kind, rate=rate)
+        if kind == "multicast":
+            for groups in args.groups:
+                add(kind, groups=groups)
+        for streams in args.streams:
+            add(kind, streams=streams)
+    return matrix
+
+
+def startup(repeat=5):
+    # wall time of `bcmc --version`: interpreter start, imports, parsing
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(bcmc("--version"), stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def idle_cpu():
+    # CPU seconds of a process that only starts up and exits, subtracted
+    # from the per-packet CPU figures
+    process = subprocess.Popen(bcmc("--version"), stdout=subprocess.DEVNULL)
+    return wait_child(process)
+
+
+def run(scenario, args, workdir, baseline_cpu):
+    kind = scenario["kind"]
+    traffic = "-mc" if kind == "multicast" else "-bc"
+    port = args.port
+    client_out = os.path.join(workdir, "client.jsonl")
+    for name in os.listdir(workdir):
+        os.unlink(os.path.join(workdir, name))
+
+    client_args = [
+        "-c",
+        traffic,
+        "-p",
+        port,
+        "--report-interval",
+        0,
+        "--format",
+        "json",
+        "--output",
+        client_out,
+    ]
+    server_args = ["-s", traffic, "-p", port, "--header", "--report-interval", 0]
+    if kind == "multicast":
+        group = group_spec(scenario["groups"])
+        client_args += ["-b", LOOPBACK, "--group", group]
+        server_args += ["-b", LOOPBACK, "--group", group]
+    server_args += ["--payload", "x" * max(1, scenario["size"] - HEADER_SIZE)]
+    if scenario["rate"] is None:
+        server_args += ["-i", 0]
+    else:
+        server_args += ["--rate", scenario["rate"] / scenario["streams"]]
+
+    started = time.perf_counter()
+    client = subprocess.Popen(
+        bcmc(*client_args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    # ready once the listener has bound its port
+    ready = None
+    while time.perf_counter() - started < 10:
+        if udp_sockets(port):
+            ready = time.perf_counter() - started
+            break
+        time.sleep(0.002)
+    if ready is None:
+        client.kill()
+        wait_child(client)
+        return dict(scenario, error="listener did not start")
+    # let the group joins settle
+    time.sleep(0.2)
+
+    servers = []
+    for index in range(scenario["streams"]):
+        output = os.path.join(workdir, "server{0}.jsonl".format(index))
+        servers.append(
+            (
+                subprocess.Popen(
+                    bcmc(
+                        *(
+                            server_args
+                            + [
+                                "--stream-id",
+                                index * scenario["groups"],
+                                "--format",
+                                "json",
+                                "--output",
+                                output,
+                            ]
+                        )
+                    ),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                ),
+                output,
+            )
+        )
+    time.sleep(args.duration)
+    for server, _output in servers:
+        server.send_signal(signal.SIGINT)
+    server_cpu = sum(
+        max(0.0, wait_child(server) - baseline_cpu) for server, _ in servers
+    )
+    # let the listener drain its queue, then read its kernel drop counters
+    # while the sockets are still open
+    time.sleep(0.5)
+    drops = sum(count for _inode, count in udp_sockets(port))
+    client.send_signal(signal.SIGINT)
+    client_cpu = max(0.0, wait_child(client) - baseline_cpu)
+
+    sent = 0
+    seconds = 0.0
+    for _server, output in servers:
+        for record in read_records(output):
+            if record.get("type") == "summary" and record.get("role") == "server":
+                sent += record["packets"]
+                seconds = max(seconds, record["seconds"])
+    received = 0
+    lost = 0
+    for record in read_records(client_out):
+        if record.get("type") != "summary":
+            continue
+        if record.get("role") == "listener":
+            received = record["packets"]
+        elif record.get("role") == "stream":
+            lost += record["lost"]
+    result = dict(
+        scenario,
+        seconds=round(seconds, 3),
+        sent=sent,
+        received=received,
+        lost=lost,
+        loss_pct=round(100.0 * (sent - received) / sent, 3) if sent else 0.0,
+        send_pps=round(sent / seconds, 1) if seconds else 0.0,
+        recv_pps=round(received / seconds, 1) if seconds else 0.0,
+        server_cpu_us_per_packet=round(server_cpu / sent * 1e6, 3) if sent else None,
+        client_cpu_us_per_packet=(
+            round(client_cpu / received * 1e6, 3) if received else None
+        ),
+        kernel_drops=drops,
+        ready_s=round(ready, 4),
+    )
+    return result
+
+
+def search(kind, args, workdir, baseline_cpu, unpaced):
+    # bisect --rate between 0 and the unpaced send rate for the highest rate
+    # the listener keeps up with: loss at most args.max_loss percent and the
+    # server achieving the rate. returns the result record, whose probes
+    # list every rate tried
+    probes = []
+    record = dict(kind=kind, name="{0}-sustainable".format(kind), probes=probes)
+    if "error" in unpaced or not unpaced["send_pps"]:
+        return dict(record, error="no unpaced run to start from")
+    if unpaced["loss_pct"] <= args.max_loss:
+        # the listener keeps up with all the server can send
+        return dict(
+            record, sustainable_pps=unpaced["recv_pps"], loss_pct=unpaced["loss_pct"]
+        )
+    low, high = 0.0, unpaced["send_pps"]
+    best = None
+    for _ in range(args.search_steps):
+        rate = round((low + high) / 2)
+        scenario = dict(kind=kind, size=64, rate=float(rate), groups=1, streams=1)
+        scenario["name"] = scenario_name(scenario)
+        result = run(scenario, args, workdir, baseline_cpu)
+        if "error" in result:
+            return dict(record, error=result["error"])
+        kept_up = (
+            result["loss_pct"] <= args.max_loss
+            and result["send_pps"] >= ACHIEVED * rate
+        )
+        probes.append(
+            dict(rate=rate, loss_pct=result["loss_pct"], send_pps=result["send_pps"])
+        )
+        if kept_up:
+            low, best = rate, result
+        else:
+            high = rate
+    if best is None:
+        return dict(record, error="no rate tried stayed within the loss limit")
+    return dict(record, sustainable_pps=best["rate"], loss_pct=best["loss_pct"])
+
+
+def compare(results, baseline, threshold):
+    # print metric changes against baseline; return the regressions
+    regressions = []
+    previous = {item["name"]: item for item in baseline.get("scenarios", [])}
+    lines = []
+    for item in results["scenarios"]:
+        old = previous.get(item["name"])
+        if old is None or "error" in item or "error" in old:
+            continue
+        for metric, higher in METRICS.items():
+            new_value, old_value = item.get(metric), old.get(metric)
+            if not new_value or not old_value:
+                continue
+            change = 100.0 * (new_value - old_value) / old_value
+            worse = -change if higher else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append((item["name"], metric, change))
+            lines.append(
+                "{0:<40} {1:<26} {2:>12g} -> {3:>12g} {4:+7.1f}%{5}".format(
+                    item["name"], metric, old_value, new_value, change, flag
+                )
+            )
+    previous = {item["name"]: item for item in baseline.get("sustainable", [])}
+    for item in results["sustainable"]:
+        old = previous.get(item["name"], {})
+        new_value, old_value = item.get("sustainable_pps"), old.get("sustainable_pps")
+        if not new_value or not old_value:
+            continue
+        change = 100.0 * (new_value - old_value) / old_value
+        flag = ""
+        if -change > threshold:
+            flag = "  REGRESSION"
+            regressions.append((item["name"], "sustainable_pps", change))
+        lines.append(
+            "{0:<40} {1:<26} {2:>12g} -> {3:>12g} {4:+7.1f}%{5}".format(
+                item["name"], "sustainable_pps", old_value, new_value, change, flag
+            )
+        )
+    for metric in STARTUP_METRICS:
+        new_value = results["startup"].get(metric)
+        old_value = baseline.get("startup", {}).get(metric)
+        if not new_value or not old_value:
+            continue
+        change = 100.0 * (new_value - old_value) / old_value
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(("startup", metric, change))
+        lines.append(
+            "{0:<40} {1:<26} {2:>12g} -> {3:>12g} {4:+7.1f}%{5}".format(
+                "startup", metric, old_value, new_value, change, flag
+            )
+        )
+    for line in lines:
+        print(line)
+    return regressions
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(
+        description="benchmark bcmc over loopback and compare against a baseline"
+    )
+    parser.add_argument("--output", metavar="FILE", help="write results as JSON")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="compare against an earlier result file"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="percent a metric may get worse before it counts as a regression (10)",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=3.0, help="seconds per scenario (3)"
+    )
+    parser.add_argument(
+        "--kinds",
+        type=lambda value: parse_list(value, str),
+        default=["multicast", "broadcast"],
+        help="traffic kinds (multicast,broadcast)",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_list,
+        default=[64, 512, 1472, 4096, 9000],
+        help="datagram sizes in bytes, header included (64,512,1472,4096,9000)",
+    )
+    parser.add_argument(
+        "--rates",
+        type=lambda value: parse_list(value, parse_rate),
+        default=[10000.0, 50000.0],
+        help="paced rates in pps for the 64 byte runs (10000,50000)",
+    )
+    parser.add_argument(
+        "--groups",
+        type=parse_list,
+        default=[16, 256],
+        help="multicast group counts (16,256)",
+    )
+    parser.add_argument(
+        "--streams",
+        type=parse_list,
+        default=[4],
+        help="concurrent server processes, one stream each (4)",
+    )
+    parser.add_argument(
+        "--max-loss",
+        type=float,
+        default=0.1,
+        help="percent loss a sustainable rate may have (0.1)",
+    )
+    parser.add_argument(
+        "--search-steps",
+        type=int,
+        default=6,
+        help="bisection steps of the sustainable rate search; 0 skips it (6)",
+    )
+    parser.add_argument("--port", type=int, default=23456, help="UDP port used (23456)")
+    return parser
+
+
+def main():
+    args = setup_parser().parse_args()
+    if platform.system() != "Linux":
+        print("the loopback benchmark needs Linux (/proc/net/udp, os.wait4)")
+        return 2
+    if "broadcast" in args.kinds and not broadcast_available():
+        print("no route for 255.255.255.255, skipping broadcast runs")
+        args.kinds = [kind for kind in args.kinds if kind != "broadcast"]
+    if udp_sockets(args.port):
+        print("port {0} is in use; pick another with --port".format(args.port))
+        return 2
+
+    baseline_cpu = idle_cpu()
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "duration": args.duration,
+            "idle_cpu_s": round(baseline_cpu, 4),
+        },
+        "startup": {"version_s": round(startup(), 4)},
+        "scenarios": [],
+        "sustainable": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="bcmc-bench-") as workdir:
+        for scenario in scenarios(args):
+            result = run(scenario, args, workdir, baseline_cpu)
+            results["scenarios"].append(result)
+            if "error" in result:
+                print("{0:<40} error: {1}".format(result["name"], result["error"]))
+                continue
+            print(
+                "{0:<40} sent {1:>10.1f} pps  received {2:>10.1f} pps  loss {3:6.2f}%  "
+                "cpu/pkt tx {4} us rx {5} us  drops {6}".format(
+                    result["name"],
+                    result["send_pps"],
+                    result["recv_pps"],
+                    result["loss_pct"],
+                    result["server_cpu_us_per_packet"],
+                    result["client_cpu_us_per_packet"],
+                    result["kernel_drops"],
+                )
+            )
+        for kind in args.kinds if args.search_steps > 0 else []:
+            base = dict(kind=kind, size=64, rate=None, groups=1, streams=1)
+            base["name"] = scenario_name(base)
+            unpaced = next(
+                (item for item in results["scenarios"] if item["name"] == base["name"]),
+                None,
+            )
+            if unpaced is None:
+                unpaced = run(base, args, workdir, baseline_cpu)
+            result = search(kind, args, workdir, baseline_cpu, unpaced)
+            results["sustainable"].append(result)
+            if "error" in result:
+                print("{0:<40} error: {1}".format(result["name"], result["error"]))
+                continue
+            print(
+                "{0:<40} {1:>10.1f} pps with {2:.3f}% loss (at most {3:g}%, {4} probes)".format(
+                    result["name"],
+                    result["sustainable_pps"],
+                    result["loss_pct"],
+                    args.max_loss,
+                    len(result["probes"]),
+                )
+            )
+    ready = [item["ready_s"] for item in results["scenarios"] if "ready_s" in item]
+    if ready:
+        results["startup"]["ready_s"] = min(ready)
+    print(
+        "startup: bcmc --version {0:.3f} s, listener ready {1} s".format(
+            results["startup"]["version_s"], results["startup"].get("ready_s")
+        )
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+            output.write("\n")
+    if args.baseline:
+        with open(args.baseline) as previous:
+            baseline = json.load(previous)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(
+                "{0} metrics regressed by more than {1:g}%".format(
+                    len(regressions), args.threshold
+                )
+            )
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# test_analyze.py: check that bcmc analyze gives the same results chunked
+
+# stdlib imports
+import socket
+
+# 3rd party imports
+import pytest
+
+# app imports
+from bcmc.analyze import analyze
+from bcmc.output import (
+    FLAG_HEADER,
+    PACKET_LOG_HEADER,
+    PACKET_LOG_MAGIC,
+    PACKET_LOG_VERSION,
+    PACKET_RECORD,
+)
+
+pytest.importorskip("numpy")
+
+STREAM_FIELDS = (
+    "packets",
+    "lost",
+    "duplicates",
+    "out_of_order",
+    "reorder_max",
+)
+
+
+class Collect:
+    # stand-in for output.Output that keeps the records
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record, text=None):
+        self.records.append(record)
+
+    def write(self, text):
+        pass
+
+
+def write_log(path, streams):
+    # a binary packet log of streams, a list of sequence number lists per
+    # stream id, sent round robin
+    source = socket.inet_aton("10.0.0.1")
+    group = socket.inet_aton("239.1.1.1")
+    rows = []
+    for stream_id, sequences in enumerate(streams):
+        rows += [
+            (position, stream_id, sequence)
+            for position, sequence in enumerate(sequences)
+        ]
+    rows.sort()
+    with open(path, "wb") as file:
+        file.write(
+            PACKET_LOG_HEADER.pack(
+                PACKET_LOG_MAGIC, PACKET_LOG_VERSION, PACKET_RECORD.size
+            )
+        )
+        for index, (_position, stream_id, sequence) in enumerate(rows):
+            arrival = 1700000000000000000 + index * 1000000
+            file.write(
+                PACKET_RECORD.pack(
+                    arrival,
+                    arrival - 200000,
+                    sequence,
+                    stream_id,
+                    100,
+                    source,
+                    group,
+                    5000,
+                    FLAG_HEADER,
+                )
+            )
+
+
+def stream_results(path, chunk):
+    output = Collect()
+    analyze([str(path)], output, chunk=chunk)
+    return [
+        tuple(record[name] for name in STREAM_FIELDS)
+        for record in output.records
+        if record.get("role") == "stream"
+    ]
+
+
+def test_chunks_keep_duplicates_and_loss(tmp_path):
+    sequences = list(range(2000))
+    # lost: a run of 7 and three singles
+    for sequence in (500, 1200, 1201) + tuple(range(100, 107)):
+        sequences.remove(sequence)
+    # reordered: one packet late by three places
+    index = sequences.index(300)
+    sequences[index], sequences[index + 3] = sequences[index + 3], sequences[index]
+    # duplicates of packets several chunks back, and of one a chunk back
+    # that itself arrived late
+    sequences.insert(sequences.index(900), 250)
+    sequences.insert(sequences.index(1500), 1000)
+    sequences.insert(sequences.index(420), 300)
+    path = tmp_path / "log.bin"
+    write_log(path, [sequences, list(range(0, 4000, 2))])
+    exact = stream_results(path, 0)
+    assert exact[0] == (1993, 10, 3, 3, 3)
+    for chunk in (7, 100, 1000):
+        assert stream_results(path, chunk) == exact
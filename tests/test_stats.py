@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# test_stats.py: check the per-stream delivery accounting
+
+# app imports
+from bcmc.stats import REORDER_WINDOW, StreamStats
+
+SECOND = 1000000000
+
+
+def feed(stats, sequences, sent_ns=0, step=0):
+    for index, sequence in enumerate(sequences):
+        stats.record(sequence, 100, sent_ns + index * step if sent_ns else 0)
+
+
+def counters(stats):
+    return stats.lost, stats.duplicates, stats.out_of_order, stats.resets
+
+
+def test_duplicate():
+    stats = StreamStats(1)
+    feed(stats, [0, 1, 2, 2, 3, 1])
+    assert counters(stats) == (0, 2, 0, 0)
+
+
+def test_late_packet_fills_gap():
+    stats = StreamStats(1)
+    feed(stats, [0, 1, 3, 4, 2, 6])
+    assert counters(stats) == (1, 0, 1, 0)
+
+
+def test_late_packet_before_first_is_not_a_fill():
+    stats = StreamStats(1)
+    feed(stats, [10, 11, 13, 9, 8, 9, 12, 12, 14])
+    assert counters(stats) == (0, 2, 3, 0)
+
+
+def test_restart_detected_from_send_time():
+    stats = StreamStats(1)
+    feed(stats, range(300), 1 * SECOND, SECOND)
+    # the same sequence numbers again, sent later, with one lost
+    feed(stats, [0, 1, 3] + list(range(4, 300)), 400 * SECOND, SECOND)
+    assert counters(stats) == (1, 0, 0, 1)
+
+
+def test_late_packet_of_same_burst_is_not_a_restart():
+    stats = StreamStats(1)
+    # a burst shares one send time
+    for sequence in (0, 2, 1):
+        stats.record(sequence, 100, SECOND)
+    assert counters(stats) == (0, 0, 1, 0)
+
+
+def test_restart_without_send_time_needs_the_window():
+    stats = StreamStats(1)
+    feed(stats, range(REORDER_WINDOW + 10))
+    feed(stats, [0, 1, 2])
+    assert counters(stats) == (0, 0, 0, 1)